@@ -0,0 +1,272 @@
+# bean_stock.py
+# デリバリー用の豆在庫 (bean_inventory.stock) をメモリ上のカウンターで引き当てる write-behind 方式
+#
+# 朝の混雑時は POST /orders がすべて同じ数行の bean_inventory を UPDATE するので、
+# 注文が書き込みロックの順番待ちになります。環境変数 BEAN_STOCK_WRITE_BEHIND=1 で有効にすると、
+# - 在庫の確認と減算は、プロセス内のカウンター (ロック付きの辞書) だけで行います
+# - 減算はまずジャーナルファイルに1行追記 (fsync) してから、注文をコミットします。
+#   fsync はイベントループを止めないように別スレッドで行い、同時に来た注文の分は1回の fsync に
+#   まとめます (グループコミット。fsync の最中に追記された分は、次の1回でまとめて書き出す)
+# - flush() で溜まった増減を豆ごとにまとめ、1トランザクションで bean_inventory に反映します
+#   (main.py が BEAN_STOCK_FLUSH_INTERVAL_SECONDS ごとに実行します)
+# - 起動時の reconcile() で、前回反映しきれなかったジャーナルの分をDBに反映してから、
+#   カウンターをDBの在庫から作り直します
+#
+# ジャーナルの各行には通し番号があり、反映済みの番号は在庫の更新と同じトランザクションで
+# id_sequences テーブル (name = "bean_stock_journal") に記録します。反映の途中で落ちても、
+# 同じ増減が二重に反映されることはありません。
+# 注文のコミットより先にジャーナルに書くので、その間に落ちた場合は在庫が少なめに残ります (売り越しにはなりません)。
+#
+# 効果は fsync の速さと同時注文数しだいです。benchmarks/bean_stock_write_behind.py (--fsync-delay-ms 5) では、
+# 同時接続 8〜32 で条件付きUPDATEより RPS が 1.1〜1.5倍になった一方、同時接続 1 では fsync の分だけ
+# 遅くなりました。本番と同じディスクでベンチマークしてから有効にしてください。
+#
+# 注意: カウンターはプロセスごとなので、ワーカーが1つのときだけ有効にしてください。
+# アプリの実行中に bean_inventory を直接書き換えても、再起動するまでカウンターには反映されません。
+
+import asyncio
+import json
+import os
+import threading
+
+from sqlalchemy import bindparam, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+JOURNAL_SEQUENCE_NAME = "bean_stock_journal"
+
+
+class WriteBehindBeanStock:
+    def __init__(self, engine, inventory_table, sequence_table, journal_path: str, fsync: bool = True):
+        '''
+        engine: 同期エンジン (flush と reconcile は別スレッドから同期で実行する)
+        inventory_table: bean_inventory テーブル (name, stock 列を持つ)
+        sequence_table: id_sequences テーブル (反映済みのジャーナル番号を記録する)
+        fsync: False にするとジャーナルの fsync を省略する (OSが落ちると直前の減算を失うことがある)
+        '''
+        self._engine = engine
+        self._inventory = inventory_table
+        self._sequences = sequence_table
+        self.journal_path = journal_path
+        self.fsync = fsync
+        self._lock = threading.Lock()        # カウンターとジャーナルの追記
+        self._flush_lock = threading.Lock()  # flush / reconcile を同時に1つだけ実行する
+        self._stock = {}     # 豆の名前 -> 在庫数
+        self._pending = []   # ジャーナルに書いたがDBに未反映の (通し番号, 豆の名前, 増減)
+        self._seq = 0
+        self._journal = None
+        self._synced_seq = 0     # ここまでの通し番号は fsync 済み
+        self._sync_task = None   # 実行中の fsync (イベントループのスレッドからだけ触る)
+        self.reserved = 0
+        self.rejected = 0
+        self.flushes = 0
+        self.fsyncs = 0
+
+    # --- 注文からの呼び出し ---
+    async def reserve(self, bean_name: str, quantity: int = 1) -> bool:
+        '''
+        在庫が足りていれば quantity だけ減らしてジャーナルに記録し、記録が fsync されるまで待つ。
+        足りなければ何もせず False。イベントループのスレッドから呼ぶこと
+        '''
+        with self._lock:
+            stock = self._stock.get(bean_name)
+            if stock is None or stock < quantity:
+                self.rejected += 1
+                return False
+            self._stock[bean_name] = stock - quantity
+            try:
+                seq = self._append(bean_name, -quantity)
+            except Exception:
+                self._stock[bean_name] = stock
+                raise
+            self.reserved += 1
+        if self.fsync:
+            try:
+                await self._wait_synced(seq)
+            except BaseException:
+                self.release(bean_name, quantity)
+                raise
+        return True
+
+    def release(self, bean_name: str, quantity: int = 1):
+        '''
+        引き当てた在庫を戻す (注文のコミットに失敗したとき)。
+        戻す記録は fsync を待たない (落ちて失っても、在庫が少なめに残るだけ)
+        '''
+        with self._lock:
+            self._stock[bean_name] = self._stock.get(bean_name, 0) + quantity
+            self._append(bean_name, quantity)
+
+    def snapshot(self) -> dict:
+        '''現在の在庫 (豆の名前 -> 在庫数) のコピー'''
+        with self._lock:
+            return dict(self._stock)
+
+    # --- DBへの反映 ---
+    def flush(self) -> int:
+        '''未反映の増減をDBに反映し、反映したジャーナルの件数を返す'''
+        with self._flush_lock:
+            with self._lock:
+                records = list(self._pending)
+            if not records:
+                return 0
+            self._apply(records)
+            with self._lock:
+                # 反映している間に追記された分だけをジャーナルに残す
+                del self._pending[:len(records)]
+                self._rewrite_journal(self._pending)
+            self.flushes += 1
+            return len(records)
+
+    def reconcile(self) -> int:
+        '''
+        起動時に呼ぶ。ジャーナルのうちDBに未反映の分を反映してから、カウンターをDBの在庫で作り直す。
+        反映したジャーナルの件数を返す
+        '''
+        with self._flush_lock, self._lock:
+            self._close_journal()
+            with self._engine.connect() as conn:
+                applied_seq = conn.scalar(
+                    select(self._sequences.c.next_value).where(self._sequences.c.name == JOURNAL_SEQUENCE_NAME)
+                ) or 0
+            records = [record for record in self._read_journal() if record[0] > applied_seq]
+            if records:
+                self._apply(records)
+            with self._engine.connect() as conn:
+                self._stock = dict(conn.execute(select(self._inventory.c.name, self._inventory.c.stock)).all())
+            self._seq = max([applied_seq] + [record[0] for record in records])
+            self._pending = []
+            self._rewrite_journal([])
+            return len(records)
+
+    def close(self):
+        '''アプリ終了時に呼ぶ (残りを反映してジャーナルを閉じる)'''
+        self.flush()
+        with self._lock:
+            self._close_journal()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "beans": len(self._stock),
+                "pending_records": len(self._pending),
+                "journal_seq": self._seq,
+                "reserved": self.reserved,
+                "rejected": self.rejected,
+                "flushes": self.flushes,
+                "fsyncs": self.fsyncs,
+            }
+
+    # --- 以下は内部用 ---
+    def _apply(self, records):
+        '''増減を豆ごとにまとめて在庫に足し、反映済みの番号を記録する (1トランザクション、fsync まで行う)'''
+        deltas = {}
+        for _, bean_name, delta in records:
+            deltas[bean_name] = deltas.get(bean_name, 0) + delta
+        inventory, sequences = self._inventory, self._sequences
+        with self._engine.connect() as conn:
+            # このあとジャーナルから消すので、このコミットだけは synchronous=FULL でWALまで fsync する
+            # (アプリの接続は synchronous=NORMAL なので、コミットしても電源断で失われることがある)
+            previous = conn.exec_driver_sql("PRAGMA synchronous").scalar()
+            conn.exec_driver_sql("PRAGMA synchronous=FULL")
+            conn.commit()
+            try:
+                with conn.begin():
+                    changed = [{"_name": name, "_delta": delta} for name, delta in deltas.items() if delta]
+                    if changed:
+                        conn.execute(
+                            update(inventory)
+                            .where(inventory.c.name == bindparam("_name"))
+                            .values(stock=inventory.c.stock + bindparam("_delta")),
+                            changed,
+                        )
+                    stmt = sqlite_insert(sequences).values(name=JOURNAL_SEQUENCE_NAME, next_value=records[-1][0])
+                    conn.execute(stmt.on_conflict_do_update(
+                        index_elements=[sequences.c.name], set_={"next_value": stmt.excluded.next_value},
+                    ))
+            finally:
+                # プールに戻す接続は元の設定に戻す
+                conn.exec_driver_sql(f"PRAGMA synchronous={int(previous)}")
+                conn.commit()
+
+    def _append(self, bean_name, delta) -> int:
+        '''ジャーナルに1行書いて (fsync はしない) 通し番号を返す。ロックを取った状態で呼ぶ'''
+        if self._journal is None:
+            self._journal = open(self.journal_path, "a", encoding="utf-8")
+        self._seq += 1
+        self._journal.write(json.dumps([self._seq, bean_name, delta], ensure_ascii=False) + "\n")
+        self._journal.flush()
+        self._pending.append((self._seq, bean_name, delta))
+        return self._seq
+
+    async def _wait_synced(self, seq):
+        '''通し番号 seq までが fsync されるまで待つ (実行中の fsync があれば相乗りする)'''
+        while self._synced_seq < seq:
+            if self._sync_task is None:
+                self._sync_task = asyncio.ensure_future(self._sync_journal())
+            # ほかの注文も同じ fsync を待っているので、このリクエストが切断されても止めない
+            await asyncio.shield(self._sync_task)
+
+    async def _sync_journal(self):
+        try:
+            synced_seq = await asyncio.to_thread(self._fsync_journal)
+            self._synced_seq = max(self._synced_seq, synced_seq)
+            self.fsyncs += 1
+        finally:
+            self._sync_task = None
+
+    def _fsync_journal(self) -> int:
+        '''
+        (別スレッドで実行) ここまでに書いたジャーナルを fsync し、fsync 済みになった通し番号を返す。
+        fsync の間に flush() がジャーナルを閉じて書き直してもよいように、ファイルを dup して使う
+        (書き直したジャーナルは _rewrite_journal() が fsync 済み)
+        '''
+        with self._lock:
+            seq = self._seq
+            fd = os.dup(self._journal.fileno()) if self._journal is not None else None
+        if fd is not None:
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        return seq
+
+    def _read_journal(self):
+        records = []
+        try:
+            with open(self.journal_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        seq, bean_name, delta = json.loads(line)
+                    except ValueError:
+                        break  # 書き込み途中で落ちた最後の行 (その注文はコミットされていない)
+                    records.append((seq, bean_name, delta))
+        except FileNotFoundError:
+            pass
+        return records
+
+    def _rewrite_journal(self, records):
+        '''ジャーナルを records だけの内容に置き換える (ロックを取った状態で呼ぶ)'''
+        self._close_journal()
+        tmp_path = self.journal_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(list(record), ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.journal_path)
+
+    def _close_journal(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+
+def create_bean_stock_from_env(engine, inventory_table, sequence_table):
+    '''環境変数 BEAN_STOCK_WRITE_BEHIND が 1 なら作成する (無効なら None)'''
+    if os.getenv("BEAN_STOCK_WRITE_BEHIND", "0").lower() not in ("1", "on", "true"):
+        return None
+    return WriteBehindBeanStock(
+        engine, inventory_table, sequence_table,
+        journal_path=os.getenv("BEAN_STOCK_JOURNAL_PATH", "bean_stock.journal"),
+        fsync=os.getenv("BEAN_STOCK_JOURNAL_FSYNC", "1").lower() in ("1", "on", "true"),
+    )
@@ -0,0 +1,169 @@
+# benchmarks/admin_lists.py
+# 管理画面の一覧API (全注文・サブスクリプション契約・在庫) の CPU 時間とメモリの比較
+#
+# 変更前: ORMのオブジェクトを (顧客の全列ごと) 読み込み、Pydanticモデルや辞書を1件ずつ作ってから
+#         FastAPI の jsonable_encoder + JSONResponse でJSONにする
+# 変更後: 返す列だけを SELECT し、Row から直接作った辞書を FastJSONResponse (orjson) でJSONにする
+#
+# 変更前の実装はこのファイルに残してあり、ベンチマークの間だけ /bench-legacy/... としてアプリに追加します。
+# どちらも httpx の ASGITransport からプロセス内で呼び出し、
+# - CPU時間 (time.process_time) の1リクエストあたりの平均
+# - tracemalloc で測ったリクエスト中のメモリ確保量のピーク
+# を表示します (tracemalloc は処理を遅くするので、CPU時間とは別に測ります)。
+#
+# 使い方 (backend ディレクトリで):
+#   python -m benchmarks.admin_lists --orders 100000 --subscriptions 100000 --repeat 3
+
+import argparse
+import asyncio
+import time
+import tracemalloc
+from typing import List
+
+from benchmarks.common import load_app_with_temp_db
+
+ADMIN_EMAIL = "taro.yamada@example.com"
+PASSWORD = "pw"
+
+
+def add_legacy_routes(main):
+    '''変更前の実装を /bench-legacy/... に追加する'''
+    from fastapi import Depends, Query
+    from sqlalchemy import select
+    from sqlalchemy.orm import joinedload
+
+    async def legacy_all_orders(
+        limit: int = Query(main.ADMIN_ORDERS_DEFAULT_LIMIT, ge=1, le=main.ADMIN_ORDERS_MAX_LIMIT),
+        admin_user=Depends(main.get_current_admin_user),
+        db=Depends(main.get_async_db),
+    ):
+        stmt = select(main.OrderModel).options(joinedload(main.OrderModel.customer))
+        delivery_orders, next_delivery_cursor = await main.fetch_keyset_page(
+            db, stmt, main.OrderModel.date, main.OrderModel.id, None, limit
+        )
+        delivery_orders_response = []
+        for order in delivery_orders:
+            delivery_orders_response.append({
+                "id": order.id, "user_id": order.user_id, "date": order.date,
+                "time": order.time, "size": order.size, "beans": order.beans,
+                "status": order.status, "notes": order.notes,
+                "customer_name": order.customer.name if order.customer else "不明なユーザー",
+            })
+        stmt = select(main.BeanOrderModel).options(joinedload(main.BeanOrderModel.customer))
+        bean_orders, next_bean_cursor = await main.fetch_keyset_page(
+            db, stmt, main.BeanOrderModel.date, main.BeanOrderModel.order_id, None, limit
+        )
+        bean_orders_response = []
+        for order in bean_orders:
+            bean_orders_response.append({
+                "order_id": order.order_id, "user_id": order.user_id, "date": order.date,
+                "total_price": order.total_price, "shipping_address": order.shipping_address,
+                "status": order.status,
+                "customer_name": order.customer.name if order.customer else "不明なユーザー",
+            })
+        return {
+            "delivery_orders": delivery_orders_response, "bean_orders": bean_orders_response,
+            "next_delivery_cursor": next_delivery_cursor, "next_bean_cursor": next_bean_cursor,
+        }
+
+    async def legacy_subscriptions(admin_user=Depends(main.get_current_admin_user), db=Depends(main.get_async_db)):
+        C, I = main.SubscriptionContractModel, main.SubscriptionContractItemModel
+        result = await db.execute(
+            select(C).options(joinedload(C.customer), joinedload(C.items).joinedload(I.product))
+        )
+        response = []
+        for contract in result.unique().scalars().all():
+            items = [
+                main.SubscriptionContractItemResponse(
+                    product_id=item.product.id, quantity=item.quantity, product_name=item.product.name
+                )
+                for item in contract.items
+            ]
+            response.append(main.SubscriptionContractResponse(
+                id=contract.id, user_id=contract.user_id, plan_name=contract.plan_name,
+                interval=contract.interval, next_delivery_date=contract.next_delivery_date,
+                status=contract.status, renewal_count=contract.renewal_count,
+                customer_name=contract.customer.name, items=items,
+            ))
+        return response
+
+    async def legacy_inventory(admin_user=Depends(main.get_current_admin_user), db=Depends(main.get_async_db)):
+        roasted_beans = (await db.execute(select(main.ProductModel))).scalars().all()
+        delivery_beans = (await db.execute(select(main.BeanInventoryModel))).scalars().all()
+        return {"roasted_beans": roasted_beans, "delivery_beans": delivery_beans}
+
+    main.app.add_api_route("/bench-legacy/all_orders", legacy_all_orders, methods=["GET"])
+    main.app.add_api_route("/bench-legacy/subscriptions", legacy_subscriptions, methods=["GET"],
+                           response_model=List[main.SubscriptionContractResponse])
+    main.app.add_api_route("/bench-legacy/all_inventory", legacy_inventory, methods=["GET"])
+
+
+async def measure(client, url, headers, repeat):
+    '''(1リクエストあたりのCPU時間ms, メモリ確保のピークMB, レスポンスのバイト数) を返す'''
+    response = await client.get(url, headers=headers)  # ウォームアップ
+    response.raise_for_status()
+    size = len(response.content)
+
+    started = time.process_time()
+    for _ in range(repeat):
+        (await client.get(url, headers=headers)).raise_for_status()
+    cpu_ms = (time.process_time() - started) / repeat * 1000
+
+    tracemalloc.start()
+    await client.get(url, headers=headers)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return cpu_ms, peak / 1024 / 1024, size
+
+
+async def run(main, limit, repeat):
+    import httpx
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        response = await client.post("/token", data={"username": ADMIN_EMAIL, "password": PASSWORD})
+        response.raise_for_status()
+        headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+        cases = [
+            (f"all_orders (limit={limit})", f"/bench-legacy/all_orders?limit={limit}", f"/admin/all_orders?limit={limit}"),
+            ("subscriptions", "/bench-legacy/subscriptions", "/admin/subscriptions"),
+            ("all_inventory", "/bench-legacy/all_inventory", "/admin/all_inventory"),
+        ]
+        print(f"\n{'endpoint':<26}{'':<8}{'CPU ms/req':>12}{'peak MB':>10}{'bytes':>12}")
+        for name, before_url, after_url in cases:
+            before = await measure(client, before_url, headers, repeat)
+            after = await measure(client, after_url, headers, repeat)
+            for label, (cpu_ms, peak_mb, size) in (("before", before), ("after", after)):
+                print(f"{name:<26}{label:<8}{cpu_ms:>12.1f}{peak_mb:>10.1f}{size:>12}")
+            print(f"{'':<26}{'change':<8}{(after[0] - before[0]) / before[0] * 100:>+11.0f}%"
+                  f"{(after[1] - before[1]) / before[1] * 100:>+9.0f}%")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="管理画面の一覧APIの CPU 時間とメモリの比較")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--orders", type=int, default=100000, help="デリバリー注文の件数")
+    parser.add_argument("--bean-orders", type=int, default=100000)
+    parser.add_argument("--subscriptions", type=int, default=100000)
+    parser.add_argument("--limit", type=int, default=500, help="/admin/all_orders の1ページの件数")
+    parser.add_argument("--repeat", type=int, default=3, help="CPU時間を測るリクエストの回数")
+    args = parser.parse_args()
+
+    import generate_data
+
+    main, db_path = load_app_with_temp_db()
+    started_at = time.perf_counter()
+    counts = generate_data.generate(
+        main, users=args.users, orders=args.orders, bean_orders=args.bean_orders, subscriptions=args.subscriptions,
+    )
+    main.on_startup()
+    print(f"seeded {counts} in {time.perf_counter() - started_at:.1f}s ({db_path})")
+
+    add_legacy_routes(main)
+    asyncio.run(run(main, args.limit, args.repeat))
+    main.password_pool.shutdown()
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,128 @@
+# benchmarks/async_db.py
+# 同期セッション(変更前) と AsyncSession(変更後) のレイテンシ比較
+#
+# 管理画面の重いクエリ (全注文を顧客ごとに集計) と、ログイン中ユーザーの軽い検索を
+# 同じイベントループ上で同時に受け付け、軽いリクエストが受付から完了まで
+# どれだけ待たされるかを測ります。
+#
+# AsyncSession では重いクエリが aiosqlite のスレッドで並行して走るので、結果はCPUのコア数に大きく左右されます。
+# 1 vCPU の環境 (Python 3.11.7 / SQLite 3.40.1) では、軽いリクエストの p50 が
+# before 約200〜300ms、after 約280〜410ms (10回実行) と、AsyncSession の方が遅くなりました。
+# 結果を共有するときは、最初に表示する実行環境の行も一緒に貼ってください。
+#
+# 使い方 (backend ディレクトリで):
+#   python -m benchmarks.async_db --orders 200000 --heavy 4 --light 200
+
+import argparse
+import asyncio
+import os
+import platform
+import sqlite3
+import time
+
+from sqlalchemy import func, insert, select
+
+from benchmarks.common import load_app_with_temp_db, print_table, summarize
+
+
+def seed(main, n_users, n_orders):
+    '''ベンチマーク用のユーザーとデリバリー注文をまとめて投入する'''
+    with main.SessionLocal() as db:
+        db.execute(insert(main.UserModel), [
+            {"id": i, "name": f"user{i}", "email": f"user{i}@example.com", "role": "customer"}
+            for i in range(1, n_users + 1)
+        ])
+        db.execute(insert(main.OrderModel), [
+            {"id": 1000 + i, "user_id": i % n_users + 1, "date": "2025-09-15", "time": "10:00",
+             "size": "M", "beans": "エチオピア・シダモ", "status": "pending", "notes": ""}
+            for i in range(1, n_orders + 1)
+        ])
+        db.commit()
+
+
+def heavy_stmt(main):
+    # SQLite側で時間がかかるクエリ (結果は小さいのでPython側の処理はほぼゼロ)
+    return (
+        select(main.UserModel.name, func.count(main.OrderModel.id))
+        .join(main.UserModel, main.OrderModel.user_id == main.UserModel.id)
+        .group_by(main.UserModel.name)
+        .order_by(func.count(main.OrderModel.id).desc())
+    )
+
+
+def light_stmt(main, i):
+    return select(main.UserModel).filter(main.UserModel.email == f"user{i}@example.com")
+
+
+async def run_sync(main, n_heavy, n_light):
+    '''変更前: async def の中で同期セッションを直接呼ぶ (イベントループが止まる)'''
+    latencies = []
+    t0 = time.perf_counter()
+
+    async def heavy():
+        with main.SessionLocal() as db:
+            db.execute(heavy_stmt(main)).scalars().all()
+
+    async def light(i):
+        with main.SessionLocal() as db:
+            db.execute(light_stmt(main, i)).scalars().first()
+        latencies.append((time.perf_counter() - t0) * 1000)
+
+    # 重いクエリと軽いリクエストを交互に、同時に受け付けたものとして扱う
+    tasks = [light(i) for i in range(n_light)]
+    step = max(1, n_light // max(1, n_heavy))
+    for k in range(n_heavy):
+        tasks.insert(k * (step + 1), heavy())
+    await asyncio.gather(*tasks)
+    return latencies
+
+
+async def run_async(main, n_heavy, n_light):
+    '''変更後: AsyncSession (aiosqlite) 経由でクエリを待つ'''
+    latencies = []
+    t0 = time.perf_counter()
+
+    async def heavy():
+        async with main.AsyncSessionLocal() as db:
+            (await db.execute(heavy_stmt(main))).scalars().all()
+
+    async def light(i):
+        async with main.AsyncSessionLocal() as db:
+            (await db.execute(light_stmt(main, i))).scalars().first()
+        latencies.append((time.perf_counter() - t0) * 1000)
+
+    # 重いクエリと軽いリクエストを交互に、同時に受け付けたものとして扱う
+    tasks = [light(i) for i in range(n_light)]
+    step = max(1, n_light // max(1, n_heavy))
+    for k in range(n_heavy):
+        tasks.insert(k * (step + 1), heavy())
+    await asyncio.gather(*tasks)
+    return latencies
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="同期セッションとAsyncSessionのレイテンシ比較")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--orders", type=int, default=200000)
+    parser.add_argument("--heavy", type=int, default=4, help="同時に走らせる管理者クエリの数")
+    parser.add_argument("--light", type=int, default=200, help="同時に走らせるユーザー検索の数")
+    args = parser.parse_args()
+
+    print(f"実行環境: Python {platform.python_version()} / SQLite {sqlite3.sqlite_version} / "
+          f"CPU {os.cpu_count()} / {platform.platform()}")
+    main, db_path = load_app_with_temp_db()
+    print(f"一時DB: {db_path}")
+    seed(main, args.users, args.orders)
+
+    results = {}
+    for label, runner in (("before (sync Session)", run_sync), ("after (AsyncSession)", run_async)):
+        start = time.perf_counter()
+        latencies = asyncio.run(runner(main, args.heavy, args.light))
+        results[label] = summarize(latencies)
+        print(f"{label}: 全体 {time.perf_counter() - start:.2f}s")
+
+    print_table("軽いリクエストのレイテンシ (ms)", results)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,145 @@
+# benchmarks/bean_stock_write_behind.py
+# POST /orders の豆在庫の引当て: 条件付きUPDATE (既定) と write-behind (BEAN_STOCK_WRITE_BEHIND=1) の比較
+#
+# httpx の ASGITransport で app をプロセス内から呼び出し、同時接続数を変えながら POST /orders を送ります。
+# 注文のレイテンシ (p50/p95/p99) と RPS に加えて、イベントループの遅れ (10ms ごとに起きるタスクが
+# 予定よりどれだけ遅れたか) の最大値を測ります。ジャーナルの fsync をイベントループ上で行うと、
+# この値が fsync 1回分ずつ積み上がります。
+#
+# --fsync-delay-ms を付けると、ジャーナルの fsync に指定した時間がかかるものとして測ります
+# (開発機の SSD や tmpfs では fsync が速すぎて、本番のディスクとの違いが見えないため)。
+#
+# main.py は環境変数をインポート時に読むので、モードごとに子プロセスで実行します。
+#
+# 使い方 (backend ディレクトリで):
+#   python -m benchmarks.bean_stock_write_behind --concurrency 1,8,32 --requests 400
+#   python -m benchmarks.bean_stock_write_behind --fsync-delay-ms 5
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.common import load_app_with_temp_db
+from benchmarks.http_endpoints import run_scenario
+
+MODES = {
+    "guarded UPDATE": {"BEAN_STOCK_WRITE_BEHIND": "0"},
+    "write-behind": {"BEAN_STOCK_WRITE_BEHIND": "1"},
+}
+
+EMAIL = "taro.yamada@example.com"
+PASSWORD = "pw"
+BEANS = "エチオピア・シダモ"
+
+
+async def measure_loop_lag(stop, interval=0.01):
+    '''stop が立つまで interval ごとに起き、予定より遅れた時間の最大値 (ミリ秒) を返す'''
+    worst = 0.0
+    while not stop.is_set():
+        expected = time.perf_counter() + interval
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - expected)
+    return round(worst * 1000, 2)
+
+
+async def bench_mode(main, concurrency_levels, n_requests):
+    import httpx
+    from sqlalchemy import insert
+
+    main.DELIVERY_SLOTS = {slot_time: 10 ** 9 for slot_time in main.DELIVERY_SLOTS}
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.app.router.lifespan_context(main.app):
+        # 在庫切れにならないように、十分な在庫の豆を1種類入れておく
+        with main.engine.begin() as conn:
+            conn.execute(insert(main.BeanInventoryModel).values(name=BEANS, stock=10 ** 9))
+        if main.bean_stock is not None:
+            main.bean_stock.reconcile()  # カウンターを上の在庫で作り直す
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            response = await client.post("/token", data={"username": EMAIL, "password": PASSWORD})
+            response.raise_for_status()
+            ctx = {"client": client, "headers": {"Authorization": f"Bearer {response.json()['access_token']}"}}
+
+            async def create_order(ctx, i):
+                return await ctx["client"].post(
+                    "/orders", headers=ctx["headers"],
+                    json={"time": "10:00", "size": "M", "beans": BEANS, "notes": ""},
+                )
+
+            results = {}
+            for concurrency in concurrency_levels:
+                stop = asyncio.Event()
+                lag_task = asyncio.create_task(measure_loop_lag(stop))
+                result = await run_scenario(ctx, create_order, n_requests, concurrency)
+                stop.set()
+                result["loop_lag_max_ms"] = await lag_task
+                results[str(concurrency)] = result
+    if main.bean_stock is not None:
+        results["fsyncs"] = main.bean_stock.stats()["fsyncs"]
+    return results
+
+
+def slow_fsync(delay_ms):
+    '''os.fsync を、delay_ms だけ余分に時間がかかるものに置き換える (遅いディスクの代わり)'''
+    real_fsync = os.fsync
+
+    def fsync(fd):
+        real_fsync(fd)
+        time.sleep(delay_ms / 1000)
+
+    os.fsync = fsync
+
+
+def run_single_mode(mode, concurrency_levels, n_requests, fsync_delay_ms, result_path):
+    '''子プロセス側: 1つのモードでベンチマークし、結果を result_path に JSON で書く'''
+    if fsync_delay_ms:
+        slow_fsync(fsync_delay_ms)
+    db_dir = tempfile.mkdtemp(prefix="coffee-bench-")
+    os.environ.update(MODES[mode])
+    os.environ["BEAN_STOCK_JOURNAL_PATH"] = os.path.join(db_dir, "bean_stock.journal")
+    main, _ = load_app_with_temp_db(os.path.join(db_dir, "bench.db"))
+    results = asyncio.run(bench_mode(main, concurrency_levels, n_requests))
+    with open(result_path, "w", encoding="utf-8") as f:
+        json.dump(results, f)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="豆在庫の引当て方式ごとの POST /orders ベンチマーク")
+    parser.add_argument("--concurrency", default="1,8,32", help="同時接続数 (カンマ区切り)")
+    parser.add_argument("--requests", type=int, default=400, help="1つの組み合わせあたりのリクエスト数")
+    parser.add_argument("--fsync-delay-ms", type=float, default=0, help="ジャーナルの fsync 1回に足す時間")
+    parser.add_argument("--single-mode", help=argparse.SUPPRESS)  # 子プロセス用
+    parser.add_argument("--result-path", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    concurrency_levels = [int(c) for c in args.concurrency.split(",")]
+
+    if args.single_mode:
+        run_single_mode(args.single_mode, concurrency_levels, args.requests, args.fsync_delay_ms,
+                        args.result_path)
+        return
+
+    print(f"{'mode':<16}{'c':>5}{'p50':>10}{'p95':>10}{'p99':>10}{'rps':>10}{'loop lag':>10}{'errors':>8}")
+    for mode in MODES:
+        result_path = os.path.join(tempfile.mkdtemp(prefix="coffee-bench-"), "result.json")
+        subprocess.run(
+            [sys.executable, "-m", "benchmarks.bean_stock_write_behind", "--single-mode", mode,
+             "--concurrency", args.concurrency, "--requests", str(args.requests), "--fsync-delay-ms", str(args.fsync_delay_ms),
+             "--result-path", result_path],
+            check=True, stdout=subprocess.DEVNULL,
+        )
+        with open(result_path, encoding="utf-8") as f:
+            results = json.load(f)
+        for concurrency in concurrency_levels:
+            r = results[str(concurrency)]
+            print(f"{mode:<16}{concurrency:>5}{r['p50']:>10}{r['p95']:>10}{r['p99']:>10}{r['rps']:>10}"
+                  f"{r['loop_lag_max_ms']:>10}{r['errors']:>8}")
+        if "fsyncs" in results:
+            print(f"{'':<16}(journal fsyncs: {results['fsyncs']})")
+
+
+if __name__ == "__main__":
+    main_cli()
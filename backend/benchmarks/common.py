@@ -0,0 +1,49 @@
+# benchmarks/common.py
+# ベンチマークスクリプト共通のヘルパー
+# (backend ディレクトリから `python -m benchmarks.xxx` の形で実行してください)
+
+import importlib
+import os
+import statistics
+import tempfile
+
+
+def load_app_with_temp_db(db_path=None):
+    '''
+    本番の coffee.db を汚さないように、一時的なDBファイルを指す設定で main.py を読み込む。
+    main.py はインポート時にエンジンを作るので、必ずインポートより先に DATABASE_URL を設定する。
+    '''
+    if db_path is None:
+        db_path = os.path.join(tempfile.mkdtemp(prefix="coffee-bench-"), "bench.db")
+    os.environ["DATABASE_URL"] = f"sqlite:///{db_path}"
+    main = importlib.import_module("main")
+    main.Base.metadata.create_all(bind=main.engine)
+    return main, db_path
+
+
+def summarize(latencies_ms):
+    '''レイテンシ(ミリ秒)のリストから p50 / p95 / p99 / 最大値を計算する'''
+    if not latencies_ms:
+        return {"count": 0, "p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+    ordered = sorted(latencies_ms)
+
+    def pct(p):
+        index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+        return round(ordered[index], 2)
+
+    return {
+        "count": len(ordered),
+        "mean": round(statistics.fmean(ordered), 2),
+        "p50": pct(50),
+        "p95": pct(95),
+        "p99": pct(99),
+        "max": round(ordered[-1], 2),
+    }
+
+
+def print_table(title, rows):
+    '''{ラベル: summarize()の結果} を簡単な表にして表示する'''
+    print(f"\n=== {title} ===")
+    print(f"{'':<24}{'count':>8}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for label, s in rows.items():
+        print(f"{label:<24}{s['count']:>8}{s['p50']:>10}{s['p95']:>10}{s['p99']:>10}{s['max']:>10}")
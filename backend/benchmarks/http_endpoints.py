@@ -0,0 +1,304 @@
+# benchmarks/http_endpoints.py
+# FastAPI アプリ全体の HTTP ベンチマーク (エンドポイントごとのレイテンシとスループット)
+#
+# httpx の ASGITransport で app をプロセス内から直接呼び出すので、サーバーの起動は不要です。
+# generate_data.py で規模の違うDBを作り、それぞれに対して
+# ログイン・/products・/settings・/orders・/bean_orders・/orders/me・管理画面の一覧を
+# 同時接続数を変えながら叩き、p50/p95/p99 と 1秒あたりのリクエスト数を JSON に保存します。
+# --compare に前回の JSON を渡すと、p95 と RPS の変化率を表示します (コミット間の比較用)。
+# エラー (ステータス 400 以上) が1件でもあった組み合わせは、レイテンシが正しく測れていないので
+# NG と表示して比較から外し、終了コード1で終わります。
+#
+# main.py はインポート時にDBエンジンを作るので、DBの規模ごとに子プロセスで実行します。
+#
+# 使い方 (backend ディレクトリで):
+#   python -m benchmarks.http_endpoints --sizes small,medium --concurrency 1,8,32 --out bench.json
+#   python -m benchmarks.http_endpoints --out after.json --compare before.json
+
+import argparse
+import asyncio
+import datetime as dt
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.common import load_app_with_temp_db, summarize
+
+# DBの規模 (generate_data.generate に渡す件数)
+SIZES = {
+    "small": {"users": 200, "products": 20, "orders": 10000, "bean_orders": 3000, "subscriptions": 200},
+    "medium": {"users": 2000, "products": 30, "orders": 100000, "bean_orders": 30000, "subscriptions": 2000},
+    "large": {"users": 10000, "products": 50, "orders": 1000000, "bean_orders": 300000, "subscriptions": 20000},
+}
+
+ADMIN_EMAIL = "taro.yamada@example.com"
+PASSWORD = "pw"
+
+
+def scenarios():
+    '''(名前, リクエストを1件送るコルーチン関数) のリスト。ctx には httpx クライアントとトークンが入る'''
+    beans = ["エチオピア・シダモ", "コロンビア・スプレモ", "グアテマラ・アンティグア", "ケニア・AA"]
+
+    async def login(ctx, i):
+        email = ctx["customer_emails"][i % len(ctx["customer_emails"])]
+        return await ctx["client"].post("/token", data={"username": email, "password": PASSWORD})
+
+    async def products(ctx, i):
+        return await ctx["client"].get("/products")
+
+    async def products_etag(ctx, i):
+        # ブラウザの再訪問と同じく If-None-Match 付き (304 が返る)
+        return await ctx["client"].get("/products", headers={"If-None-Match": ctx["products_etag"]})
+
+    async def settings(ctx, i):
+        return await ctx["client"].get("/settings")
+
+    async def create_order(ctx, i):
+        return await ctx["client"].post(
+            "/orders", headers=ctx["customer_headers"],
+            json={"time": "10:00", "size": "M", "beans": beans[i % len(beans)], "notes": ""},
+        )
+
+    async def create_bean_order(ctx, i):
+        product_ids = ctx["product_ids"]
+        return await ctx["client"].post(
+            "/bean_orders", headers=ctx["customer_headers"],
+            json={"items": [{"id": product_ids[i % len(product_ids)], "quantity": 1}]},
+        )
+
+    async def orders_me(ctx, i):
+        return await ctx["client"].get("/orders/me", headers=ctx["customer_headers"])
+
+    async def admin_all_orders(ctx, i):
+        return await ctx["client"].get("/admin/all_orders", headers=ctx["admin_headers"])
+
+    async def admin_subscriptions(ctx, i):
+        return await ctx["client"].get("/admin/subscriptions", headers=ctx["admin_headers"])
+
+    async def admin_users(ctx, i):
+        return await ctx["client"].get("/admin/users", headers=ctx["admin_headers"])
+
+    async def admin_inventory(ctx, i):
+        return await ctx["client"].get("/admin/all_inventory", headers=ctx["admin_headers"])
+
+    return [
+        ("POST /token", login),
+        ("GET /products", products),
+        ("GET /products (304)", products_etag),
+        ("GET /settings", settings),
+        ("POST /orders", create_order),
+        ("POST /bean_orders", create_bean_order),
+        ("GET /orders/me", orders_me),
+        ("GET /admin/all_orders", admin_all_orders),
+        ("GET /admin/subscriptions", admin_subscriptions),
+        ("GET /admin/users", admin_users),
+        ("GET /admin/all_inventory", admin_inventory),
+    ]
+
+
+async def run_scenario(ctx, request, n_requests, concurrency):
+    '''concurrency 本のワーカーで合計 n_requests 件送り、レイテンシとRPSを返す'''
+    counter = itertools.count()
+    latencies = []
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        while (i := next(counter)) < n_requests:
+            start = time.perf_counter()
+            response = await request(ctx, i)
+            latencies.append((time.perf_counter() - start) * 1000)
+            if response.status_code >= 400:
+                errors += 1
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started_at
+    result = summarize(latencies)
+    result["rps"] = round(len(latencies) / elapsed, 1)
+    result["errors"] = errors
+    return result
+
+
+async def bench_size(main, concurrency_levels, n_requests, n_login_requests):
+    import httpx
+    from sqlalchemy import select, update
+
+    # 注文系のベンチマークで在庫切れ・時間枠の満席にならないようにしておく
+    main.DELIVERY_SLOTS = {slot_time: 10 ** 9 for slot_time in main.DELIVERY_SLOTS}
+    with main.engine.begin() as conn:
+        conn.execute(update(main.ProductModel).values(stock=10 ** 9))
+        conn.execute(update(main.BeanInventoryModel).values(stock=10 ** 9))
+        product_ids = list(conn.execute(select(main.ProductModel.id)).scalars())
+        # 注文の多いユーザー (Zipf分布の上位) を /orders/me の対象にする
+        customer_emails = list(conn.execute(
+            select(main.UserModel.email).where(main.UserModel.role == "customer")
+            .order_by(main.UserModel.id).limit(20)
+        ).scalars())
+
+    transport = httpx.ASGITransport(app=main.app)
+    # 本番と同じく startup / shutdown イベントを実行する (グループコミットの書き込みタスク、
+    # 豆在庫の反映などのバックグラウンドタスクは async の startup で開始される)
+    async with main.app.router.lifespan_context(main.app), \
+            httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        async def token_for(email):
+            response = await client.post("/token", data={"username": email, "password": PASSWORD})
+            response.raise_for_status()
+            return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+        ctx = {
+            "client": client,
+            "product_ids": product_ids,
+            "customer_emails": customer_emails,
+            "customer_headers": await token_for(customer_emails[0]),
+            "admin_headers": await token_for(ADMIN_EMAIL),
+            "products_etag": (await client.get("/products")).headers.get("etag", ""),
+        }
+
+        results = {}
+        for name, request in scenarios():
+            results[name] = {}
+            # ログインは bcrypt が重いので件数を減らす
+            n = n_login_requests if name == "POST /token" else n_requests
+            for concurrency in concurrency_levels:
+                result = await run_scenario(ctx, request, n, concurrency)
+                results[name][str(concurrency)] = result
+                print(f"  {name:<28} c={concurrency:<4} p50={result['p50']:>8}ms p95={result['p95']:>8}ms "
+                      f"p99={result['p99']:>8}ms rps={result['rps']:>8} errors={result['errors']}"
+                      f"{'  <- NG' if result['errors'] else ''}",
+                      file=sys.stderr)
+    return results
+
+
+def run_single_size(size, concurrency_levels, n_requests, n_login_requests, seed, result_path):
+    '''
+    子プロセス側: 1つの規模のDBを作ってベンチマークし、結果を result_path に JSON で書く
+    (main.py が標準出力にログを出すので、結果はファイルで受け渡す)
+    '''
+    import generate_data
+
+    db_dir = tempfile.mkdtemp(prefix="coffee-bench-")
+    # BEAN_STOCK_WRITE_BEHIND=1 のときのジャーナルを backend ディレクトリに作らないように
+    os.environ.setdefault("BEAN_STOCK_JOURNAL_PATH", os.path.join(db_dir, "bean_stock.journal"))
+    main, db_path = load_app_with_temp_db(os.path.join(db_dir, "bench.db"))
+    started_at = time.perf_counter()
+    counts = generate_data.generate(main, seed=seed, **SIZES[size])
+    print(f"[{size}] seeded {sum(counts.values())} rows in {time.perf_counter() - started_at:.1f}s ({db_path})",
+          file=sys.stderr)
+    # 管理者ユーザーの作成などは bench_size の中で startup イベントとして実行される
+    results = asyncio.run(bench_size(main, concurrency_levels, n_requests, n_login_requests))
+    with open(result_path, "w", encoding="utf-8") as f:
+        json.dump({"rows": counts, "endpoints": results}, f)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def failed_runs(output):
+    '''エラーのあった (規模, エンドポイント, 同時接続数, エラー数) のリスト'''
+    return [
+        (size, name, concurrency, result["errors"])
+        for size, size_result in output["sizes"].items()
+        for name, by_concurrency in size_result["endpoints"].items()
+        for concurrency, result in by_concurrency.items()
+        if result.get("errors")
+    ]
+
+
+def print_comparison(current, baseline):
+    '''前回の結果と比べて p95 と RPS の変化率を表示する (どちらかにエラーがあった組み合わせは比べない)'''
+    print(f"\n=== compare with {baseline['meta'].get('commit')} ===")
+    print(f"{'size':<8}{'endpoint':<30}{'c':>5}{'p95 before':>12}{'p95 after':>12}{'Δp95':>9}{'Δrps':>9}")
+    for size, size_result in current["sizes"].items():
+        before_size = baseline["sizes"].get(size, {}).get("endpoints", {})
+        for name, by_concurrency in size_result["endpoints"].items():
+            for concurrency, after in by_concurrency.items():
+                before = before_size.get(name, {}).get(concurrency)
+                if not before:
+                    continue
+                if after.get("errors") or before.get("errors"):
+                    print(f"{size:<8}{name:<30}{concurrency:>5}  skipped (errors: before={before.get('errors', 0)}, "
+                          f"after={after.get('errors', 0)})")
+                    continue
+
+                def change(key):
+                    return f"{(after[key] - before[key]) / before[key] * 100:+.0f}%" if before[key] else "-"
+
+                print(f"{size:<8}{name:<30}{concurrency:>5}{before['p95']:>12}{after['p95']:>12}"
+                      f"{change('p95'):>9}{change('rps'):>9}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="FastAPI アプリの HTTP ベンチマーク")
+    parser.add_argument("--sizes", default="small,medium", help=f"DBの規模 (カンマ区切り: {', '.join(SIZES)})")
+    parser.add_argument("--concurrency", default="1,8,32", help="同時接続数 (カンマ区切り)")
+    parser.add_argument("--requests", type=int, default=400, help="1つの組み合わせあたりのリクエスト数")
+    parser.add_argument("--login-requests", type=int, default=40, help="POST /token のリクエスト数")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", default="bench-http.json", help="結果を書き出す JSON ファイル")
+    parser.add_argument("--compare", help="比較対象の (前回の) JSON ファイル")
+    parser.add_argument("--single-size", help=argparse.SUPPRESS)  # 子プロセス用
+    parser.add_argument("--result-path", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    concurrency_levels = [int(c) for c in args.concurrency.split(",")]
+
+    if args.single_size:
+        run_single_size(args.single_size, concurrency_levels, args.requests, args.login_requests, args.seed,
+                        args.result_path)
+        return
+
+    output = {
+        "meta": {
+            "commit": git_commit(),
+            "created_at": dt.datetime.now(dt.timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "seed": args.seed,
+            "requests": args.requests,
+            "concurrency": concurrency_levels,
+        },
+        "sizes": {},
+    }
+    for size in args.sizes.split(","):
+        if size not in SIZES:
+            parser.error(f"unknown size: {size}")
+        result_path = os.path.join(tempfile.mkdtemp(prefix="coffee-bench-"), f"{size}.json")
+        subprocess.run(
+            [sys.executable, "-m", "benchmarks.http_endpoints", "--single-size", size,
+             "--concurrency", args.concurrency, "--requests", str(args.requests),
+             "--login-requests", str(args.login_requests), "--seed", str(args.seed),
+             "--result-path", result_path],
+            check=True,
+        )
+        with open(result_path, encoding="utf-8") as f:
+            output["sizes"][size] = json.load(f)
+
+    failures = failed_runs(output)
+    output["meta"]["failed"] = bool(failures)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(output, f, ensure_ascii=False, indent=2)
+    print(f"結果を {args.out} に保存しました")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            print_comparison(output, json.load(f))
+
+    if failures:
+        print("\nNG: エラーのあった組み合わせがあります (この結果のレイテンシとRPSは比較に使えません)")
+        for size, name, concurrency, errors in failures:
+            print(f"  {size:<8}{name:<30} c={concurrency:<4} errors={errors}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
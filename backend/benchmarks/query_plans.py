@@ -0,0 +1,127 @@
+# benchmarks/query_plans.py
+# よく使うクエリの EXPLAIN QUERY PLAN を確認する回帰チェック
+#
+# インデックスが使われずにテーブル全体をスキャンしているクエリ、
+# またはページング用のクエリで並べ替えに一時B-treeを使っているクエリがあれば
+# NG を表示して終了コード1で終わります (CIなどで実行してください)。
+#
+# 使い方 (backend ディレクトリで):
+#   python -m benchmarks.query_plans
+
+import re
+import sys
+
+from sqlalchemy import insert, select
+from sqlalchemy.dialects import sqlite
+
+from benchmarks.common import load_app_with_temp_db
+
+
+def hot_queries(main):
+    '''(名前, SQLAlchemyのSELECT, 並べ替えにもインデックスが必要か) のリスト'''
+    O, B = main.OrderModel, main.BeanOrderModel
+    # ページングのクエリは、エンドポイントと同じ keyset_page_stmt で組み立てる (1ページ目と2ページ目以降)
+    delivery_cursor = main.encode_cursor("2025-09-15", 2500)
+    bean_cursor = main.encode_cursor("2025-09-15", main.format_bean_order_id(2500))
+    admin_limit = main.ADMIN_ORDERS_DEFAULT_LIMIT
+
+    def admin_delivery(cursor, **filters):
+        return main.keyset_page_stmt(main.admin_delivery_orders_stmt(**filters), O.date, O.id, cursor, admin_limit)
+
+    def admin_bean(cursor, **filters):
+        return main.keyset_page_stmt(main.admin_bean_orders_stmt(**filters), B.date, B.order_id, cursor, admin_limit)
+
+    return [
+        ("/orders/me delivery", main.keyset_page_stmt(
+            main.user_delivery_orders_stmt(1), O.date, O.id, None, main.USER_ORDERS_DEFAULT_LIMIT), True),
+        ("/orders/me delivery p2", main.keyset_page_stmt(
+            main.user_delivery_orders_stmt(1), O.date, O.id, delivery_cursor, main.USER_ORDERS_DEFAULT_LIMIT), True),
+        ("/orders/me bean", main.keyset_page_stmt(
+            main.user_bean_orders_stmt(1), B.date, B.order_id, None, main.USER_ORDERS_DEFAULT_LIMIT), True),
+        ("/orders/me bean p2", main.keyset_page_stmt(
+            main.user_bean_orders_stmt(1), B.date, B.order_id, bean_cursor, main.USER_ORDERS_DEFAULT_LIMIT), True),
+        ("order detail items", select(main.BeanOrderItemModel).filter(main.BeanOrderItemModel.bean_order_id == main.format_bean_order_id(1)), False),
+        ("order detail history", select(main.OrderHistoryModel).filter(main.OrderHistoryModel.order_id == main.format_bean_order_id(1)), False),
+        ("subscription items", select(main.SubscriptionContractItemModel).filter(main.SubscriptionContractItemModel.contract_id == 1), False),
+        ("subscriptions by user", select(main.SubscriptionContractModel).filter(main.SubscriptionContractModel.user_id == 1), False),
+        ("delivery by status", select(O).filter(O.status == "pending").order_by(O.date.desc()), True),
+        ("bean by status", select(B).filter(B.status == "paid").order_by(B.date.desc()), True),
+        ("subscription renewal", select(main.SubscriptionContractModel.id).filter(
+            main.SubscriptionContractModel.status == "active",
+            main.SubscriptionContractModel.next_delivery_date <= "2025-09-15")
+            .order_by(main.SubscriptionContractModel.next_delivery_date, main.SubscriptionContractModel.id)
+            .limit(1000), True),
+        # /admin/all_orders: 絞り込みなし・ステータス・顧客・期間ごとに確認する
+        ("admin delivery page", admin_delivery(None), True),
+        ("admin delivery page p2", admin_delivery(delivery_cursor), True),
+        ("admin delivery status", admin_delivery(None, status="pending"), True),
+        ("admin delivery status p2", admin_delivery(delivery_cursor, status="pending"), True),
+        ("admin delivery user", admin_delivery(None, user_id=1), True),
+        ("admin delivery user p2", admin_delivery(delivery_cursor, user_id=1), True),
+        ("admin delivery dates", admin_delivery(None, date_from="2025-09-01", date_to="2025-09-07"), True),
+        ("admin bean page", admin_bean(None), True),
+        ("admin bean page p2", admin_bean(bean_cursor), True),
+        ("admin bean status", admin_bean(None, status="paid"), True),
+        ("admin bean status p2", admin_bean(bean_cursor, status="paid"), True),
+        ("admin bean user", admin_bean(None, user_id=1), True),
+        ("admin bean user p2", admin_bean(bean_cursor, user_id=1), True),
+        ("admin bean dates", admin_bean(None, date_from="2025-09-01", date_to="2025-09-07"), True),
+        ("delivery slots", select(main.DeliverySlotCountModel.time, main.DeliverySlotCountModel.booked)
+            .filter(main.DeliverySlotCountModel.date == "2025-09-15"), True),
+    ]
+
+
+def seed(main):
+    '''プランナーが現実的な判断をするように、ある程度の行数と統計を用意する'''
+    with main.SessionLocal() as db:
+        db.execute(insert(main.OrderModel), [
+            {"id": i, "user_id": i % 50, "date": f"2025-09-{1 + i % 28:02d}", "time": "10:00", "size": "M",
+             "beans": "エチオピア・シダモ", "status": ("pending", "delivered", "cancelled")[i % 3], "notes": ""}
+            for i in range(1, 5001)
+        ])
+        db.execute(insert(main.BeanOrderModel), [
+            {"order_id": main.format_bean_order_id(i), "user_id": i % 50, "date": f"2025-09-{1 + i % 28:02d}",
+             "total_price": 1500, "shipping_address": "", "status": ("paid", "shipped", "delivered")[i % 3]}
+            for i in range(1, 5001)
+        ])
+        db.commit()
+    with main.engine.begin() as conn:
+        conn.exec_driver_sql("ANALYZE")
+
+
+def explain(main, stmt):
+    sql = str(stmt.compile(dialect=sqlite.dialect(), compile_kwargs={"literal_binds": True}))
+    with main.engine.connect() as conn:
+        return [row[3] for row in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + sql)]
+
+
+def problems_in(plan, needs_ordered_index):
+    problems = []
+    for line in plan:
+        # "SCAN orders" のようにインデックスなしで全件を読んでいる
+        if re.match(r"SCAN \w+$", line):
+            problems.append(f"full table scan: {line}")
+        if needs_ordered_index and "USE TEMP B-TREE" in line:
+            problems.append(f"sort without index: {line}")
+    return problems
+
+
+def main_cli():
+    main, _ = load_app_with_temp_db()
+    main.ensure_indexes()
+    seed(main)
+
+    failed = False
+    for name, stmt, needs_ordered_index in hot_queries(main):
+        plan = explain(main, stmt)
+        problems = problems_in(plan, needs_ordered_index)
+        print(f"{'NG' if problems else 'OK'}  {name:<24} {' | '.join(plan)}")
+        for problem in problems:
+            print(f"      -> {problem}")
+        failed = failed or bool(problems)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,115 @@
+# benchmarks/sqlite_tuning.py
+# SQLiteのデフォルト設定 と sqlite_tuning.py の設定 (WAL など) を比べる読み書き同時ベンチマーク
+#
+# 書き込みスレッドは create_order と同じく「在庫を1減らす + 注文を1件追加」を1トランザクションで行い、
+# 読み込みスレッドは /orders/me 相当のクエリ (ユーザーごとの注文一覧) を繰り返します。
+#
+# 使い方 (backend ディレクトリで):
+#   python -m benchmarks.sqlite_tuning --writers 4 --readers 8 --seconds 5
+
+import argparse
+import itertools
+import os
+import tempfile
+import threading
+import time
+
+from sqlalchemy import create_engine, insert, select, update
+from sqlalchemy.exc import OperationalError
+
+from benchmarks.common import load_app_with_temp_db, print_table, summarize
+from sqlite_tuning import apply_sqlite_pragmas, pragmas_from_env, pool_options_from_env
+
+
+def make_engine(main, pragmas):
+    path = os.path.join(tempfile.mkdtemp(prefix="coffee-bench-"), "tuning.db")
+    engine = create_engine(
+        f"sqlite:///{path}", connect_args={"check_same_thread": False}, **pool_options_from_env()
+    )
+    apply_sqlite_pragmas(engine, pragmas)
+    main.Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        conn.execute(insert(main.BeanInventoryModel), [{"name": "エチオピア・シダモ", "stock": 10**9}])
+        conn.execute(insert(main.OrderModel), [
+            {"id": i, "user_id": i % 100, "date": "2025-09-15", "time": "10:00", "size": "M",
+             "beans": "エチオピア・シダモ", "status": "pending", "notes": ""}
+            for i in range(1, 20001)
+        ])
+    return engine
+
+
+def run(main, engine, n_writers, n_readers, seconds):
+    stop = threading.Event()
+    ids = itertools.count(100000)
+    write_latencies, read_latencies = [], []
+    errors = {"locked": 0}
+    lock = threading.Lock()
+
+    def writer():
+        while not stop.is_set():
+            start = time.perf_counter()
+            try:
+                with engine.begin() as conn:
+                    conn.execute(
+                        update(main.BeanInventoryModel)
+                        .where(main.BeanInventoryModel.name == "エチオピア・シダモ")
+                        .values(stock=main.BeanInventoryModel.stock - 1)
+                    )
+                    conn.execute(insert(main.OrderModel).values(
+                        id=next(ids), user_id=1, date="2025-09-15", time="10:00", size="M",
+                        beans="エチオピア・シダモ", status="pending", notes=""
+                    ))
+            except OperationalError:
+                with lock:
+                    errors["locked"] += 1
+                continue
+            with lock:
+                write_latencies.append((time.perf_counter() - start) * 1000)
+
+    def reader(n):
+        while not stop.is_set():
+            start = time.perf_counter()
+            try:
+                with engine.connect() as conn:
+                    conn.execute(select(main.OrderModel).where(main.OrderModel.user_id == n % 100)).all()
+            except OperationalError:
+                with lock:
+                    errors["locked"] += 1
+                continue
+            with lock:
+                read_latencies.append((time.perf_counter() - start) * 1000)
+
+    threads = [threading.Thread(target=writer) for _ in range(n_writers)]
+    threads += [threading.Thread(target=reader, args=(n,)) for n in range(n_readers)]
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    return write_latencies, read_latencies, errors["locked"]
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="SQLiteのPRAGMA設定による読み書き同時性能の比較")
+    parser.add_argument("--writers", type=int, default=4)
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=5)
+    args = parser.parse_args()
+
+    main, _ = load_app_with_temp_db()
+    rows = {}
+    for label, pragmas in (("default", {}), ("tuned", pragmas_from_env())):
+        engine = make_engine(main, pragmas)
+        writes, reads, locked = run(main, engine, args.writers, args.readers, args.seconds)
+        engine.dispose()
+        print(f"{label:<8} writes/s={len(writes) / args.seconds:>9.1f}  "
+              f"reads/s={len(reads) / args.seconds:>9.1f}  locked errors={locked}")
+        rows[f"{label} write"] = summarize(writes)
+        rows[f"{label} read"] = summarize(reads)
+
+    print_table("レイテンシ (ms)", rows)
+
+
+if __name__ == "__main__":
+    main_cli()
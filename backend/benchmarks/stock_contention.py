@@ -0,0 +1,107 @@
+# benchmarks/stock_contention.py
+# 在庫の同時引当てテスト: 読んでから書く方式(変更前) と 条件付きUPDATE(変更後) の比較
+#
+# 在庫 --stock 個の商品に対して、--threads 本のスレッドが1個ずつ買い続けます。
+# 売れた数が在庫数を超えたら「売り越し」です。変更後は売り越しが0件であることを確認し、
+# 0件でなければ終了コード1で終わります。
+#
+# 使い方 (backend ディレクトリで):
+#   python -m benchmarks.stock_contention --threads 16 --stock 2000
+
+import argparse
+import sys
+import threading
+import time
+
+from sqlalchemy import insert, select
+from sqlalchemy.exc import OperationalError
+
+from benchmarks.common import load_app_with_temp_db
+
+
+def reset_stock(main, stock):
+    with main.SessionLocal() as db:
+        db.query(main.ProductModel).delete()
+        db.execute(insert(main.ProductModel), [{
+            "id": "bean-001", "name": "夜明けのブレンド", "description": "", "price": 1500,
+            "stock": stock, "image_url": "",
+        }])
+        db.commit()
+
+
+def buy_read_modify_write(main, db):
+    '''変更前の create_bean_order と同じ: SELECT (FOR UPDATE は SQLite では無視) → Python で減算'''
+    product = db.query(main.ProductModel).filter(main.ProductModel.id == "bean-001").with_for_update().first()
+    if not product or product.stock < 1:
+        db.rollback()
+        return False
+    product.stock -= 1
+    db.commit()
+    return True
+
+
+def buy_guarded_update(main, db):
+    '''変更後: UPDATE ... WHERE stock >= :q を1文で実行し、rowcount で判定'''
+    result = db.execute(main._reserve_product_stmt, [{"_product_id": "bean-001", "_quantity": 1}])
+    if result.rowcount != 1:
+        db.rollback()
+        return False
+    db.commit()
+    return True
+
+
+def run(main, buy, n_threads, stock):
+    reset_stock(main, stock)
+    sold = [0] * n_threads
+    errors = [0] * n_threads
+
+    def worker(n):
+        with main.SessionLocal() as db:
+            while True:
+                try:
+                    if not buy(main, db):
+                        return
+                    sold[n] += 1
+                except OperationalError:
+                    db.rollback()
+                    errors[n] += 1
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(n_threads)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    with main.SessionLocal() as db:
+        final_stock = db.scalar(select(main.ProductModel.stock))
+    return {
+        "sold": sum(sold),
+        "oversold": max(0, sum(sold) - stock),
+        "final_stock": final_stock,
+        "errors": sum(errors),
+        "orders_per_sec": round(sum(sold) / elapsed, 1),
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="在庫の同時引当てテスト (売り越しの有無とスループット)")
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--stock", type=int, default=2000)
+    args = parser.parse_args()
+
+    main, _ = load_app_with_temp_db()
+    before = run(main, buy_read_modify_write, args.threads, args.stock)
+    after = run(main, buy_guarded_update, args.threads, args.stock)
+    print(f"before (read-modify-write): {before}")
+    print(f"after  (guarded UPDATE)   : {after}")
+
+    if after["oversold"] or after["sold"] != args.stock or after["final_stock"] != 0:
+        print("NG: 条件付きUPDATEで売り越し、または在庫の不整合が発生しました")
+        sys.exit(1)
+    print("OK: 売り越しなし")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,87 @@
+# catalog_cache.py
+# /products と /settings のレスポンス (JSONのバイト列) をバージョン付きで覚えておくキャッシュ
+#
+# 商品情報や在庫が変わったら bump() でバージョンを上げ、古いキャッシュを無効にします。
+# ETag はレスポンス本文のハッシュなので、ワーカーが複数あっても同じ内容なら同じ値になります。
+# バージョンはプロセスごとなので、別ワーカーでの変更は max_age_seconds 経過後に反映されます。
+
+import hashlib
+import threading
+import time
+
+
+class CatalogEntry:
+    def __init__(self, version: int, body: bytes):
+        self.version = version
+        self.body = body
+        self.etag = '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+        self.stored_at = time.monotonic()
+
+
+class CatalogCache:
+    def __init__(self, max_age_seconds: float = 30.0):
+        self.max_age_seconds = max_age_seconds
+        self._lock = threading.Lock()
+        self._version = 0
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def bump(self):
+        '''カタログ (商品・在庫) が変わったときに呼ぶ'''
+        with self._lock:
+            self._version += 1
+            self._entries.clear()
+
+    def get(self, key: str):
+        '''有効なキャッシュがあれば CatalogEntry を、なければ None を返す'''
+        with self._lock:
+            entry = self._entries.get(key)
+            if (
+                entry is None
+                or entry.version != self._version
+                or time.monotonic() - entry.stored_at > self.max_age_seconds
+            ):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry
+
+    def get_or_build(self, key: str, build):
+        '''
+        キャッシュがあればそれを、なければ build() (JSONのバイト列を返す関数) で作って保存する。
+        build 中に bump() された場合は、古い内容を保存しないようにする。
+        '''
+        entry = self.get(key)
+        if entry is not None:
+            return entry
+        version = self._version
+        entry = CatalogEntry(version, build())
+        with self._lock:
+            if version == self._version:
+                self._entries[key] = entry
+        return entry
+
+    def stats(self):
+        with self._lock:
+            return {
+                "version": self._version,
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+def etag_matches(if_none_match, etag: str) -> bool:
+    '''If-None-Match ヘッダー (カンマ区切り、W/ 付きも可) が etag と一致するか'''
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
@@ -0,0 +1,322 @@
+# generate_data.py
+# 負荷試験・スケール試験用の架空データを coffee.db に大量投入するスクリプト
+#
+# on_startup が作るのはユーザー1人・商品1つ・注文1件だけなので、
+# /admin/all_orders や /orders/me を本番規模で試すにはこのスクリプトでデータを増やします。
+# - 乱数のシードと基準日 (--anchor-date) を固定するので、同じ引数なら実行した日によらず毎回同じデータになります
+# - 注文の多いユーザー・売れ筋の商品に偏りを持たせ (Zipf分布)、日付・時間帯・ステータスも現実に近い分布にします
+# - executemany でまとめて INSERT するので、100万行でも1分以内に入ります
+#
+# 使い方 (backend ディレクトリで):
+#   python generate_data.py --users 5000 --orders 500000 --bean-orders 150000 --subscriptions 20000
+#   python generate_data.py --db /tmp/load.db --orders 1000000 --seed 42
+#   python generate_data.py --anchor-date 2026-04-01   # 注文日をこの日までの days 日間にする
+
+import argparse
+import itertools
+import os
+import random
+import time
+from datetime import date, datetime, time as dt_time, timedelta
+
+# 1回のINSERT (executemany) でまとめて送る行数
+DEFAULT_BATCH_SIZE = 20000
+# 生成するデータの「今日」。注文日・ステータス・定期便の次回お届け日はすべてこの日から決める
+DEFAULT_ANCHOR_DATE = date(2025, 9, 30)
+
+DEPARTMENTS = ["営業部", "開発部", "総務部", "経理部", "人事部", "企画部", "マーケティング部", "カスタマーサポート部"]
+LAST_NAMES = ["佐藤", "鈴木", "高橋", "田中", "伊藤", "渡辺", "山本", "中村", "小林", "加藤", "吉田", "山田"]
+FIRST_NAMES = ["太郎", "花子", "一郎", "美咲", "健太", "さくら", "大輔", "陽菜", "翔太", "結衣", "蓮", "葵"]
+ORIGINS = ["エチオピア・シダモ", "コロンビア・スプレモ", "グアテマラ・アンティグア", "ケニア・AA",
+           "ブラジル・サントス", "インドネシア・マンデリン", "コスタリカ・タラス", "ルワンダ・ブルボン"]
+ROASTS = ["浅煎り", "中煎り", "中深煎り", "深煎り"]
+SIZES, SIZE_WEIGHTS = ["S", "M", "L"], [2, 6, 3]
+# 朝10時台と午後3時台に注文が集中する
+TIME_SLOTS = [f"{h:02d}:{m:02d}" for h in range(9, 18) for m in (0, 30)]
+TIME_WEIGHTS = [1, 3, 8, 6, 4, 2, 3, 2, 2, 3, 4, 3, 7, 6, 3, 2, 1, 1]
+GRIND_OPTIONS = ["whole_bean", "medium_grind", "fine_grind", "coarse_grind"]
+PAYMENT_METHODS, PAYMENT_WEIGHTS = ["credit_card", "bank_transfer", "convenience_store"], [8, 1, 1]
+SHIPPING_METHODS, SHIPPING_WEIGHTS = ["standard", "express"], [4, 1]
+INTERVALS = ["monthly", "bi-weekly"]
+
+
+def zipf_cum_weights(n, exponent=1.0):
+    '''上位ほど選ばれやすい (Zipf分布) 累積重みを作る。random.choices の cum_weights 用'''
+    return list(itertools.accumulate(1 / (rank ** exponent) for rank in range(1, n + 1)))
+
+
+class DataGenerator:
+    def __init__(self, main, seed, days, batch_size, anchor_date=DEFAULT_ANCHOR_DATE):
+        self.main = main
+        self.rng = random.Random(seed)
+        self.anchor_date = anchor_date
+        self.days = days
+        self.batch_size = batch_size
+        self.counts = {}
+
+    # --- 共通 ---
+    def insert_batches(self, conn, model, rows):
+        '''rows (ジェネレーター) を batch_size 件ずつ executemany で投入する'''
+        table = model.__table__
+        total = 0
+        while True:
+            batch = list(itertools.islice(rows, self.batch_size))
+            if not batch:
+                break
+            conn.execute(table.insert(), batch)
+            total += len(batch)
+        self.counts[table.name] = self.counts.get(table.name, 0) + total
+        return total
+
+    def random_dates(self, k):
+        '''基準日までの days 日間の日付を k 個 (平日は週末の3倍注文がある)'''
+        days = [self.anchor_date - timedelta(days=d) for d in range(self.days)]
+        weights = [1 if d.weekday() >= 5 else 3 for d in days]
+        return self.rng.choices(days, weights=weights, k=k)
+
+    def status_for(self, order_date, flow):
+        '''古い注文ほど完了しているステータスにする'''
+        age = (self.anchor_date - order_date).days
+        if age > 7:
+            return flow[-1] if self.rng.random() > 0.03 else "cancelled"
+        if age > 2:
+            return self.rng.choice(flow[1:])
+        return flow[0]
+
+    def max_value(self, conn, stmt, default):
+        value = conn.execute(stmt).scalar()
+        return default if value is None else value
+
+    # --- 各テーブル ---
+    def users(self, conn, n):
+        from sqlalchemy import func, select
+        main = self.main
+        start = self.max_value(conn, select(func.max(main.UserModel.id)), 0) + 1
+        # bcrypt は重いので、全員同じパスワード ("pw") のハッシュを使い回す
+        hashed = main.pwd_context.hash("pw")
+
+        def rows():
+            for i in range(start, start + n):
+                yield {
+                    "id": i,
+                    "name": f"{self.rng.choice(LAST_NAMES)} {self.rng.choice(FIRST_NAMES)}",
+                    "department": self.rng.choice(DEPARTMENTS),
+                    "email": f"loadtest-user{i}@example.com",
+                    "preferred_beans": self.rng.choice(ORIGINS),
+                    "hashed_password": hashed,
+                    "role": "admin" if self.rng.random() < 0.01 else "customer",
+                }
+
+        self.insert_batches(conn, main.UserModel, rows())
+        return list(range(start, start + n))
+
+    def products(self, conn, n):
+        from sqlalchemy import select
+        main = self.main
+        existing = set(conn.execute(select(main.ProductModel.id)).scalars())
+        ids = []
+        i = 1
+        while len(ids) < n:
+            product_id = f"bean-{i:03d}"
+            if product_id not in existing:
+                ids.append(product_id)
+            i += 1
+        prices = {}
+
+        def rows():
+            for product_id in ids:
+                price = self.rng.randrange(1200, 3200, 100)
+                prices[product_id] = price
+                yield {
+                    "id": product_id,
+                    "name": f"{self.rng.choice(ORIGINS)} {self.rng.choice(ROASTS)}",
+                    "description": "負荷試験用に自動生成された商品です。",
+                    "price": price,
+                    "stock": self.rng.randint(50, 5000),
+                    "image_url": f"/images/{product_id}.jpg",
+                }
+
+        self.insert_batches(conn, main.ProductModel, rows())
+        # 既存の商品も注文の対象にする
+        for product_id, price in conn.execute(select(main.ProductModel.id, main.ProductModel.price)):
+            prices.setdefault(product_id, price or 0)
+        return prices
+
+    def bean_inventory(self, conn):
+        from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+        main = self.main
+        conn.execute(
+            sqlite_insert(main.BeanInventoryModel.__table__).on_conflict_do_nothing(),
+            [{"name": name, "stock": self.rng.randint(1000, 100000)} for name in ORIGINS],
+        )
+        return ORIGINS
+
+    def delivery_orders(self, conn, n, user_ids, beans):
+        main = self.main
+        # アプリと同じシーケンスから範囲を確保する (既存の最大ID + 1 から振ると、
+        # アプリが確保済みでまだ使っていないIDと重なり、あとの注文が IntegrityError になる)
+        start, _ = main.order_id_allocator.reserve_range(conn, n)
+        user_weights = zipf_cum_weights(len(user_ids), 0.8)
+
+        def rows():
+            # 乱数はチャンク単位でまとめて引く (1件ずつ choices を呼ぶより速い)
+            for chunk_start in range(0, n, self.batch_size):
+                k = min(self.batch_size, n - chunk_start)
+                users = self.rng.choices(user_ids, cum_weights=user_weights, k=k)
+                dates = self.random_dates(k)
+                times = self.rng.choices(TIME_SLOTS, weights=TIME_WEIGHTS, k=k)
+                sizes = self.rng.choices(SIZES, weights=SIZE_WEIGHTS, k=k)
+                bean_choices = self.rng.choices(beans, k=k)
+                for j in range(k):
+                    yield {
+                        "id": start + chunk_start + j,
+                        "user_id": users[j],
+                        "date": dates[j].isoformat(),
+                        "time": times[j],
+                        "size": sizes[j],
+                        "beans": bean_choices[j],
+                        "status": self.status_for(dates[j], ["pending", "delivered"]),
+                        "notes": "ミルク少なめで" if self.rng.random() < 0.1 else "",
+                    }
+
+        self.insert_batches(conn, main.OrderModel, rows())
+
+    def bean_orders(self, conn, n, user_ids, prices):
+        main = self.main
+        start, _ = main.bean_order_id_allocator.reserve_range(conn, n)
+        user_weights = zipf_cum_weights(len(user_ids), 0.8)
+        product_ids = list(prices)
+        product_weights = zipf_cum_weights(len(product_ids), 1.1)
+        items, history = [], []
+
+        def rows():
+            for chunk_start in range(0, n, self.batch_size):
+                k = min(self.batch_size, n - chunk_start)
+                users = self.rng.choices(user_ids, cum_weights=user_weights, k=k)
+                dates = self.random_dates(k)
+                for j in range(k):
+                    order_id = main.format_bean_order_id(start + chunk_start + j)
+                    order_date = dates[j]
+                    n_items = self.rng.choices((1, 2, 3), weights=(6, 3, 1))[0]
+                    # 重複を除く (set だと文字列のハッシュ順でプロセスごとに順番が変わり、データが再現しない)
+                    chosen = dict.fromkeys(self.rng.choices(product_ids, cum_weights=product_weights, k=n_items))
+                    total = 0
+                    for product_id in chosen:
+                        quantity = self.rng.choices((1, 2, 3), weights=(6, 3, 1))[0]
+                        total += prices[product_id] * quantity
+                        items.append({
+                            "bean_order_id": order_id, "product_id": product_id, "quantity": quantity,
+                            "grind_option": self.rng.choice(GRIND_OPTIONS),
+                            "roasting_date": (order_date - timedelta(days=1)).isoformat(),
+                            "lot_number": f"L-{order_date:%Y%m%d}-{self.rng.randint(1, 9):02d}",
+                        })
+                    status = self.status_for(order_date, ["paid", "shipped", "delivered"])
+                    created_at = datetime.combine(order_date, dt_time(self.rng.randint(7, 22), self.rng.randint(0, 59)))
+                    history.append({"order_id": order_id, "timestamp": created_at, "actor_name": "システム",
+                                    "action": "注文が作成されました。"})
+                    if status != "paid":
+                        history.append({"order_id": order_id, "timestamp": created_at + timedelta(days=1),
+                                        "actor_name": "スタッフ",
+                                        "action": f"ステータスを「{status}」に変更しました"})
+                    yield {
+                        "order_id": order_id,
+                        "user_id": users[j],
+                        "date": order_date.isoformat(),
+                        "total_price": total,
+                        "shipping_address": "東京都千代田区丸の内1-1-1",
+                        "status": status,
+                        "payment_method": self.rng.choices(PAYMENT_METHODS, weights=PAYMENT_WEIGHTS)[0],
+                        "shipping_method": self.rng.choices(SHIPPING_METHODS, weights=SHIPPING_WEIGHTS)[0],
+                        "tracking_number": f"TN{start + chunk_start + j:010d}" if status != "paid" else None,
+                        "shipping_carrier": "ヤマト運輸" if status != "paid" else None,
+                    }
+                # 明細と履歴は注文のチャンクごとにまとめて投入する
+                self.insert_batches(conn, main.BeanOrderItemModel, iter(items))
+                self.insert_batches(conn, main.OrderHistoryModel, iter(history))
+                items.clear()
+                history.clear()
+
+        self.insert_batches(conn, main.BeanOrderModel, rows())
+
+    def subscriptions(self, conn, n, user_ids, prices):
+        from sqlalchemy import func, select
+        main = self.main
+        start = self.max_value(conn, select(func.max(main.SubscriptionContractModel.id)), 0) + 1
+        product_ids = list(prices)
+        product_weights = zipf_cum_weights(len(product_ids), 1.1)
+
+        def contracts():
+            for i in range(start, start + n):
+                yield {
+                    "id": i,
+                    "user_id": self.rng.choice(user_ids),
+                    "plan_name": self.rng.choice(["月替わり2種セット", "定番ブレンド便", "シングルオリジン便"]),
+                    "interval": self.rng.choice(INTERVALS),
+                    "next_delivery_date": (self.anchor_date + timedelta(days=self.rng.randint(-3, 30))).isoformat(),
+                    "status": self.rng.choices(["active", "paused", "cancelled"], weights=(8, 1, 1))[0],
+                    "renewal_count": self.rng.randint(0, 24),
+                }
+
+        def contract_items():
+            for i in range(start, start + n):
+                for product_id in dict.fromkeys(self.rng.choices(product_ids, cum_weights=product_weights, k=2)):
+                    yield {"contract_id": i, "product_id": product_id, "quantity": self.rng.randint(1, 2)}
+
+        self.insert_batches(conn, main.SubscriptionContractModel, contracts())
+        self.insert_batches(conn, main.SubscriptionContractItemModel, contract_items())
+
+
+def generate(main, users=1000, products=30, orders=100000, bean_orders=30000, subscriptions=2000,
+             seed=42, days=365, batch_size=DEFAULT_BATCH_SIZE, anchor_date=DEFAULT_ANCHOR_DATE):
+    '''
+    main (main.py モジュール) の engine が指すDBに架空データを投入し、テーブルごとの件数を返す。
+    ベンチマークなどからも呼べるように関数にしてある
+    '''
+    main.Base.metadata.create_all(bind=main.engine)
+    gen = DataGenerator(main, seed, days, batch_size, anchor_date)
+    with main.engine.begin() as conn:
+        user_ids = gen.users(conn, users)
+        prices = gen.products(conn, products)
+        beans = gen.bean_inventory(conn)
+        gen.delivery_orders(conn, orders, user_ids, beans)
+        gen.bean_orders(conn, bean_orders, user_ids, prices)
+        gen.subscriptions(conn, subscriptions, user_ids, prices)
+    main.ensure_indexes()
+    main.rebuild_sales_summary()  # 注文を直接投入したので、売上の日次集計を作り直す
+    main.rebuild_slot_counts()
+    with main.engine.begin() as conn:
+        conn.exec_driver_sql("ANALYZE")
+    main.catalog_cache.bump()
+    return gen.counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="負荷試験用の架空データを coffee.db に投入する")
+    parser.add_argument("--db", help="投入先のSQLiteファイル (省略時は DATABASE_URL または ./coffee.db)")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--products", type=int, default=30)
+    parser.add_argument("--orders", type=int, default=100000, help="デリバリー注文の件数")
+    parser.add_argument("--bean-orders", type=int, default=30000, help="焙煎豆注文の件数 (明細・履歴は別に増える)")
+    parser.add_argument("--subscriptions", type=int, default=2000)
+    parser.add_argument("--days", type=int, default=365, help="注文日を散らばらせる過去の日数")
+    parser.add_argument("--anchor-date", type=date.fromisoformat, default=DEFAULT_ANCHOR_DATE,
+                        help=f"生成するデータの「今日」 (YYYY-MM-DD、既定は {DEFAULT_ANCHOR_DATE})")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    if args.db:
+        os.environ["DATABASE_URL"] = f"sqlite:///{args.db}"
+    import main  # DATABASE_URL を設定してから読み込む
+
+    started_at = time.perf_counter()
+    counts = generate(
+        main, users=args.users, products=args.products, orders=args.orders,
+        bean_orders=args.bean_orders, subscriptions=args.subscriptions,
+        seed=args.seed, days=args.days, batch_size=args.batch_size, anchor_date=args.anchor_date,
+    )
+    elapsed = time.perf_counter() - started_at
+    total = sum(counts.values())
+    for table, count in counts.items():
+        print(f"{table:<32}{count:>10}")
+    print(f"🎉 合計 {total} 行を {elapsed:.1f} 秒で投入しました ({total / elapsed:.0f} 行/秒)")
@@ -0,0 +1,139 @@
+# group_commit.py
+# 注文の書き込みをまとめて1トランザクションでコミットするキュー (グループコミット)
+#
+# SQLiteは書き込みが1つずつなので、注文ごとにトランザクションとfsyncを行うと、
+# オフィス全体の注文が集中したときに書き込みロックの順番待ちになります。
+# 環境変数 ORDER_GROUP_COMMIT=1 で有効にすると、
+# - POST /orders は検証済みの注文をキューに入れ、結果 (Future) を待つだけになります
+# - 1つの書き込みタスクがキューから最大 max_batch 件、または最初の1件から max_wait_ms の間に
+#   届いた分を取り出し、write_batch で1トランザクションにまとめて書き込みます
+# - 注文ごとの結果 (採番したIDを含む注文、または在庫不足などの例外) を、それぞれの Future に返します
+#
+# 1件ずつコミットする場合と比べて、fsync と書き込みロックの取得がバッチごとに1回になります。
+# 効果は ORDER_GROUP_COMMIT=1 と 0 で python -m benchmarks.http_endpoints を実行し、--compare で比較できます。
+#
+# 書き込みタスクは main.py の startup イベントで開始します。startup を通さずにアプリを動かした場合
+# (running が False) は、main.py は注文を1件ずつコミットする従来の書き込みに切り替え、最初の1回だけ警告を出します。
+
+import asyncio
+import os
+
+
+class GroupCommitQueue:
+    def __init__(self, write_batch, max_batch: int = 50, max_wait_seconds: float = 0.005, max_queue: int = 1000):
+        '''
+        write_batch: 項目のリストを受け取り、同じ順番で結果のリストを返すコルーチン関数。
+            結果が例外オブジェクトなら、その項目の呼び出し元に例外として返す
+            (write_batch 自体が例外を投げた場合は、バッチ全体の呼び出し元に返す)
+        max_queue: キューの上限 (いっぱいのときは submit() が空くまで待つ)
+        '''
+        self._write_batch = write_batch
+        self.max_batch = max_batch
+        self.max_wait_seconds = max_wait_seconds
+        self.max_queue = max_queue
+        self._queue = None
+        self._task = None
+        self.batches = 0
+        self.items = 0
+        self.largest_batch = 0
+        self.bypassed = 0  # 書き込みタスクが動いていなかったため、キューを通さずに書き込んだ件数
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def bypass(self):
+        '''書き込みタスクが動いていないので、呼び出し元が直接書き込むときに呼ぶ (最初の1回だけ警告を出す)'''
+        if self.bypassed == 0:
+            print("⚠️ グループコミットの書き込みタスクが動いていないので、注文を1件ずつコミットします "
+                  "(startup イベントが実行されていません)")
+        self.bypassed += 1
+
+    def start(self):
+        '''書き込みタスクを開始する (イベントループの中で呼ぶ)'''
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        '''書き込みタスクを止める。キューに残っている項目の呼び出し元にはエラーを返す'''
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        while not self._queue.empty():
+            _, future = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("group commit queue stopped"))
+
+    async def submit(self, item):
+        '''項目をキューに入れ、書き込みが終わったらその結果を返す (失敗ならその例外を投げる)'''
+        if not self.running:
+            raise RuntimeError("group commit queue is not running (start() has not been called)")
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "batches": self.batches,
+            "items": self.items,
+            "largest_batch": self.largest_batch,
+            "average_batch": round(self.items / self.batches, 2) if self.batches else 0.0,
+            "bypassed": self.bypassed,
+        }
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait_seconds
+            while len(batch) < self.max_batch:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._commit(batch)
+
+    async def _commit(self, batch):
+        try:
+            results = await self._write_batch([item for item, _ in batch])
+        except asyncio.CancelledError:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(RuntimeError("group commit queue stopped"))
+            raise
+        except Exception as e:
+            results = [e] * len(batch)
+        self.batches += 1
+        self.items += len(batch)
+        self.largest_batch = max(self.largest_batch, len(batch))
+        for (_, future), result in zip(batch, results):
+            if future.done():  # 呼び出し元がキャンセルされた (書き込みは済んでいる)
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+def create_queue_from_env(write_batch):
+    '''環境変数 ORDER_GROUP_COMMIT が 1 なら作成する (無効なら None)'''
+    if os.getenv("ORDER_GROUP_COMMIT", "0").lower() not in ("1", "on", "true"):
+        return None
+    return GroupCommitQueue(
+        write_batch,
+        max_batch=int(os.getenv("ORDER_GROUP_COMMIT_MAX_BATCH", 50)),
+        max_wait_seconds=float(os.getenv("ORDER_GROUP_COMMIT_MAX_WAIT_MS", 5)) / 1000,
+        max_queue=int(os.getenv("ORDER_GROUP_COMMIT_MAX_QUEUE", 1000)),
+    )
@@ -0,0 +1,122 @@
+# id_allocator.py
+# 注文IDの採番 (count() + 1 の代わり)
+#
+# 採番用テーブル (id_sequences: name, next_value) から、ワーカーごとに
+# block_size 個ずつまとめてIDを確保し、その範囲内はメモリ上で1つずつ払い出します。
+# - 毎回の注文で COUNT(*) を実行しない (O(1))
+# - 範囲の確保は UPDATE で行うので、複数ワーカーでもIDが重複しない
+# - ワーカーが再起動すると、使い残した範囲は欠番になります (重複よりは安全)
+#
+# 注意: 範囲の確保は注文とは別のトランザクションで行います。
+# SQLiteは書き込みが1つずつなので、注文側で書き込みを始める「前」に next_id() を呼んでください。
+# リクエストのセッションを next_id(db) に渡すと、範囲の確保もそのセッションで行います
+# (ロックを待つ前にコミットして接続をプールに返すので、注文が集中しても1リクエストで2本の接続を借りない)。
+
+import asyncio
+
+from sqlalchemy import select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+
+class IdBlockAllocator:
+    def __init__(self, session_factory, sequence_table, name: str, initial_value_stmt, block_size: int = 10):
+        '''
+        session_factory: AsyncSessionLocal など
+        sequence_table: id_sequences テーブル (name, next_value 列を持つ)
+        name: シーケンス名 ("orders" など)
+        initial_value_stmt: シーケンスがまだ無いときの開始値を返す SELECT
+            (既存データの最大ID + 1 など)
+        '''
+        self._session_factory = session_factory
+        self._table = sequence_table
+        self.name = name
+        self._initial_value_stmt = initial_value_stmt
+        self.block_size = block_size
+        self._next = 0
+        self._end = 0
+        self._lock = asyncio.Lock()
+
+    async def next_id(self, db=None) -> int:
+        '''
+        次のIDを1つ返す。
+        db: リクエストの AsyncSession (省略時は範囲の確保のたびに新しいセッションを開く)。
+            範囲を確保するときはコミットされるので、書き込みを始める前に呼ぶこと
+        '''
+        if self._next < self._end:
+            # 確保済みの範囲から払い出す (await しないので、ほかのコルーチンと重ならない)
+            value = self._next
+            self._next += 1
+            return value
+        if db is not None:
+            # ロックを待っている間、ユーザーの確認などで借りた接続を持ったままにしない
+            # (持ったまま待つと、範囲を確保する側が接続を借りられずにプールが詰まる)
+            await db.commit()
+        async with self._lock:
+            if self._next >= self._end:
+                self._next, self._end = await self._reserve_block(db)
+            value = self._next
+            self._next += 1
+            return value
+
+    async def _reserve_block(self, db=None):
+        '''DB上のシーケンスを block_size だけ進め、確保した範囲 [start, end) を返す'''
+        if db is None:
+            async with self._session_factory() as db:
+                async with db.begin():
+                    return await db.run_sync(self.reserve_range, self.block_size)
+        try:
+            block = await db.run_sync(self.reserve_range, self.block_size)
+            await db.commit()
+        except BaseException:
+            await db.rollback()
+            raise
+        return block
+
+    def reserve_range(self, db, count: int):
+        '''
+        シーケンスを count だけ進め、確保した範囲 [start, end) を返す (同期版)。
+        db は同期の Session / Connection で、呼び出し側のトランザクションの中で実行される。
+        定期便の一括更新 (subscription_renewal.py) のように、まとめてIDが必要なときにも使う
+        '''
+        t = self._table
+        advance = (
+            update(t)
+            .where(t.c.name == self.name)
+            .values(next_value=t.c.next_value + count)
+        )
+        result = db.execute(advance)
+        if result.rowcount == 0:
+            self._create_sequence(db)
+            db.execute(advance)
+        end = db.scalar(select(t.c.next_value).where(t.c.name == self.name))
+        return end - count, end
+
+    def advance_past(self, db, next_value: int):
+        '''
+        シーケンスを next_value 以上に進める (同期版、呼び出し側のトランザクションの中で実行される)。
+        migrate.py のように、IDを指定して行を直接 INSERT したときに同じトランザクションで呼ぶ
+        (そうしないと、アプリがあとで同じIDを払い出して IntegrityError になる)。
+        注意: 実行中のアプリがすでに確保している範囲は変わらないので、移行はアプリを止めて行うこと
+        '''
+        t = self._table
+        self._create_sequence(db)
+        db.execute(
+            update(t)
+            .where(t.c.name == self.name, t.c.next_value < next_value)
+            .values(next_value=next_value)
+        )
+
+    def _create_sequence(self, db):
+        '''
+        シーケンスがまだ無ければ、既存データから開始値を決めて作る
+        (別のワーカーが同時に作った場合は何もしない)
+        '''
+        t = self._table
+        if db.scalar(select(t.c.next_value).where(t.c.name == self.name)) is not None:
+            return
+        initial = db.scalar(self._initial_value_stmt)
+        db.execute(
+            sqlite_insert(t)
+            .values(name=self.name, next_value=initial)
+            .on_conflict_do_nothing(index_elements=[t.c.name])
+        )
@@ -0,0 +1,248 @@
+# idempotency.py
+# 注文を作るAPI (POST /orders, POST /bean_orders) の Idempotency-Key (冪等キー)
+#
+# Wi-Fi が切れてレスポンスが届かなかった注文をクライアントが再送すると、在庫の引当てからやり直して
+# 同じ注文が2件できていました。リクエストに Idempotency-Key ヘッダー (クライアントが注文ごとに作るID) を
+# 付けると、同じキーの再送には最初のレスポンスをそのまま返し、在庫にも注文にも触りません。
+#
+# - キーは (エンドポイント, ユーザーID, キー) の単位で idempotency_keys テーブルに記録し、
+#   ttl_seconds (既定24時間) が過ぎたら使えなくなります (purge_expired() で削除)
+# - 処理の前に「処理中」の行を INSERT してキーを確保するので、同じキーのリクエストが
+#   ほかのワーカーで同時に来ても、処理するのは1つだけです。後から来た方は、最初の処理が終わるまで
+#   待ってから同じレスポンスを返します (同じプロセス内なら Future で、ほかのワーカーならDBを見て待つ)
+# - 成功したレスポンスだけを保存します。在庫不足などのエラーのときはキーを解放するので、
+#   同じキーで再送すると改めて処理されます
+# - 保存したレスポンスはメモリ上の LRU キャッシュにも置き、再送のときはDBを読まずに返します
+# - 同じキーで内容の違うリクエストが来たら IdempotencyKeyReused を投げます (キーの使い回しの誤り)
+#
+# 注文のコミットとレスポンスの保存は別のトランザクションです。その間にプロセスが落ちると、
+# キーは「処理中」のまま残り、再送には IdempotencyKeyInProgress (409) を返します
+# (レスポンスは返せませんが、注文が二重にできることはありません)。
+# イベントループのスレッドからだけ呼んでください (メモリ上の状態はロックで守っていません)。
+
+import asyncio
+import os
+import time
+from collections import OrderedDict, namedtuple
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from query_budget import exempt_from_query_budget
+
+StoredResponse = namedtuple("StoredResponse", ["status_code", "body", "fingerprint"])
+
+
+class IdempotencyKeyReused(Exception):
+    '''同じキーが、内容の違うリクエストに使われた'''
+
+
+class IdempotencyKeyInProgress(Exception):
+    '''同じキーのリクエストが処理中のまま、待ち時間の上限を過ぎた'''
+
+
+class IdempotencyStore:
+    def __init__(self, session_factory, table, ttl_seconds: float = 86400, cache_size: int = 10000,
+                 wait_timeout_seconds: float = 30, poll_interval_seconds: float = 0.05):
+        '''
+        session_factory: AsyncSessionLocal など (purge_expired() で使う)
+        table: idempotency_keys テーブル (endpoint, user_id, key が主キー)
+        wait_timeout_seconds: 同じキーのリクエストが処理中のときに待つ時間の上限
+        poll_interval_seconds: ほかのワーカーの処理を待つときに、DBを見直す最初の間隔 (1秒まで倍にしていく)
+        '''
+        self._session_factory = session_factory
+        self._table = table
+        self.ttl_seconds = ttl_seconds
+        self.cache_size = cache_size
+        self.wait_timeout_seconds = wait_timeout_seconds
+        self.poll_interval_seconds = poll_interval_seconds
+        self._cache = OrderedDict()  # (endpoint, user_id, key) -> (StoredResponse, expires_at)
+        self._inflight = {}          # (endpoint, user_id, key) -> このプロセスで処理中の Future
+        self.executed = 0
+        self.replayed = 0
+        self.waited = 0
+        self.rejected = 0
+
+    async def run(self, db, scope: tuple, fingerprint: str, handler):
+        '''
+        db: リクエストのセッション。キーの確保・保存はそれぞれこのセッションでコミットする
+            (注文の処理と同時に、もう1本プールの接続を借りないため。handler の前後で呼ぶので注文とは混ざらない)
+        scope: (エンドポイント, ユーザーID, キー)
+        fingerprint: リクエストの内容のハッシュ (同じキーで内容が違う再送を見分ける)
+        handler: 引数なしのコルーチン関数。成功したら (ステータスコード, 本文のバイト列) を返し、
+            失敗したら例外を投げる (例外はそのまま呼び出し元に返り、キーは解放される)
+        戻り値: (ステータスコード, 本文のバイト列, 保存済みのレスポンスを返したなら True)
+        '''
+        deadline = time.monotonic() + self.wait_timeout_seconds
+        while True:
+            stored = self._cache_get(scope)
+            if stored is not None:
+                return self._replay(stored, fingerprint)
+            inflight = self._inflight.get(scope)
+            if inflight is None:
+                break
+            # このプロセスで同じキーのリクエストを処理中なら、終わるまで待つ
+            # (成功していればキャッシュに入っている。失敗していたら、このリクエストが改めて処理する)
+            self.waited += 1
+            try:
+                await asyncio.wait_for(asyncio.shield(inflight), deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                raise IdempotencyKeyInProgress()
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[scope] = future
+        try:
+            return await self._run_once(db, scope, fingerprint, handler, deadline)
+        finally:
+            del self._inflight[scope]
+            future.set_result(None)
+
+    async def purge_expired(self) -> int:
+        '''期限切れのキーを削除し、削除した件数を返す'''
+        t = self._table
+        async with self._session_factory() as db:
+            result = await db.execute(delete(t).where(t.c.expires_at <= time.time()))
+            await db.commit()
+        now = time.time()
+        for scope in [scope for scope, (_, expires_at) in self._cache.items() if expires_at <= now]:
+            del self._cache[scope]
+        return result.rowcount
+
+    def stats(self):
+        return {
+            "cached": len(self._cache),
+            "inflight": len(self._inflight),
+            "executed": self.executed,
+            "replayed": self.replayed,
+            "waited": self.waited,
+            "rejected": self.rejected,
+        }
+
+    # --- 以下は内部用 ---
+    async def _run_once(self, db, scope, fingerprint, handler, deadline):
+        interval = self.poll_interval_seconds
+        while not await self._claim(db, scope, fingerprint):
+            # すでに記録がある: 保存済みならそのレスポンスを返し、ほかのワーカーで処理中なら終わるまで待つ
+            while True:
+                # 待つ時間だけ繰り返すSQLなので、N+1 (同じ形のSQLの繰り返し) の検出から外す
+                with exempt_from_query_budget():
+                    row = await self._load(db, scope)
+                if row is None:
+                    break  # 待っている間に解放された (失敗した処理のキー、または期限切れ) ので、もう一度確保する
+                if row.status_code is not None:
+                    stored = StoredResponse(row.status_code, row.response_body.encode("utf-8"), row.fingerprint)
+                    self._cache_put(scope, stored, row.expires_at)
+                    return self._replay(stored, fingerprint)
+                if row.fingerprint != fingerprint:
+                    self.rejected += 1
+                    raise IdempotencyKeyReused()
+                if time.monotonic() + interval > deadline:
+                    raise IdempotencyKeyInProgress()
+                self.waited += 1
+                await asyncio.sleep(interval)
+                interval = min(interval * 2, 1.0)
+
+        expires_at = time.time() + self.ttl_seconds
+        try:
+            status_code, body = await handler()
+        except BaseException:
+            await asyncio.shield(self._release(db, scope))
+            raise
+        self.executed += 1
+        stored = StoredResponse(status_code, body, fingerprint)
+        try:
+            await self._store(db, scope, stored)
+        except Exception as e:
+            # 注文はコミット済みなので、リクエスト自体は成功として返す (キーは処理中のまま残る)
+            print(f"😱 冪等キーのレスポンスの保存中にエラーが発生: {e}")
+        else:
+            self._cache_put(scope, stored, expires_at)
+        return status_code, body, False
+
+    def _replay(self, stored, fingerprint):
+        if stored.fingerprint != fingerprint:
+            self.rejected += 1
+            raise IdempotencyKeyReused()
+        self.replayed += 1
+        return stored.status_code, stored.body, True
+
+    def _where(self, scope):
+        t = self._table
+        endpoint, user_id, key = scope
+        return (t.c.endpoint == endpoint, t.c.user_id == user_id, t.c.key == key)
+
+    async def _claim(self, db, scope, fingerprint) -> bool:
+        '''キーを「処理中」として確保する。記録がない (または期限切れ) なら True'''
+        t = self._table
+        endpoint, user_id, key = scope
+        now = time.time()
+        stmt = sqlite_insert(t).values(
+            endpoint=endpoint, user_id=user_id, key=key, fingerprint=fingerprint,
+            status_code=None, response_body=None, created_at=now, expires_at=now + self.ttl_seconds,
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[t.c.endpoint, t.c.user_id, t.c.key],
+            set_={
+                "fingerprint": stmt.excluded.fingerprint, "status_code": None, "response_body": None,
+                "created_at": stmt.excluded.created_at, "expires_at": stmt.excluded.expires_at,
+            },
+            where=t.c.expires_at <= now,  # 期限切れの記録だけ上書きする
+        )
+        result = await db.execute(stmt)
+        await db.commit()
+        return result.rowcount == 1
+
+    async def _load(self, db, scope):
+        t = self._table
+        result = await db.execute(
+            select(t.c.fingerprint, t.c.status_code, t.c.response_body, t.c.expires_at)
+            .where(*self._where(scope), t.c.expires_at > time.time())
+        )
+        row = result.first()
+        await db.commit()  # 待っている間は接続をプールに返しておく
+        return row
+
+    async def _store(self, db, scope, stored):
+        t = self._table
+        await db.execute(
+            update(t).where(*self._where(scope))
+            .values(status_code=stored.status_code, response_body=stored.body.decode("utf-8"))
+        )
+        await db.commit()
+
+    async def _release(self, db, scope):
+        t = self._table
+        try:
+            await db.rollback()  # 失敗した注文の処理が残っていれば捨てる
+            await db.execute(delete(t).where(*self._where(scope), t.c.status_code.is_(None)))
+            await db.commit()
+        except Exception as e:
+            # 解放できなかったキーは期限切れまで処理中のまま (再送は 409 になる)
+            print(f"😱 冪等キーの解放中にエラーが発生: {e}")
+
+    def _cache_get(self, scope):
+        entry = self._cache.get(scope)
+        if entry is None:
+            return None
+        stored, expires_at = entry
+        if expires_at <= time.time():
+            del self._cache[scope]
+            return None
+        self._cache.move_to_end(scope)
+        return stored
+
+    def _cache_put(self, scope, stored, expires_at):
+        self._cache[scope] = (stored, expires_at)
+        self._cache.move_to_end(scope)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+
+def create_store_from_env(session_factory, table):
+    '''環境変数から冪等キーの設定を読み込んで作成する'''
+    return IdempotencyStore(
+        session_factory, table,
+        ttl_seconds=float(os.getenv("IDEMPOTENCY_KEY_TTL_SECONDS", 86400)),
+        cache_size=int(os.getenv("IDEMPOTENCY_CACHE_MAX_ENTRIES", 10000)),
+        wait_timeout_seconds=float(os.getenv("IDEMPOTENCY_WAIT_TIMEOUT_SECONDS", 30)),
+    )
@@ -1,7 +1,17 @@
 import os # ★ これを追加
+import asyncio
+import base64
+import hashlib
+import hmac
+import csv
+import io
+import json
 # --- (ファイルの先頭に追加) ---
-from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey, DateTime, Boolean
-from sqlalchemy.orm import sessionmaker, relationship, Session, joinedload  # ★ ここに joinedload を追加
+from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey, DateTime, Boolean, Index, select, insert, func, update, delete, bindparam, cast, tuple_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import sessionmaker, relationship, Session, joinedload, selectinload  # ★ ここに joinedload を追加
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 from sqlalchemy.ext.declarative import declarative_base
 from contextlib import contextmanager
 import datetime as dt
@@ -9,12 +19,29 @@ import datetime as dt
 from datetime import datetime, timedelta, timezone
 from typing import List, Optional
 
-from fastapi import Depends, FastAPI, HTTPException, status
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Response, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from pydantic import BaseModel, computed_field
+try:
+    import orjson # ★ 管理画面の一覧など、大きなJSONを速く作るため (なければ標準の json を使う)
+except ImportError:
+    orjson = None
+
+from password_pool import PasswordPoolSaturated, create_pool_from_env
+from principal_cache import create_cache_from_env
+from id_allocator import IdBlockAllocator
+from bean_stock import create_bean_stock_from_env
+from group_commit import create_queue_from_env
+from order_events import TooManySubscribers, create_broker_from_env
+from idempotency import IdempotencyKeyInProgress, IdempotencyKeyReused, create_store_from_env
+from catalog_cache import CatalogCache, etag_matches
+from sqlite_tuning import apply_sqlite_pragmas, pool_options_from_env
+from metrics import MetricsMiddleware, MetricsRegistry, instrument_engine, pool_class_with_wait_metrics
+from query_budget import create_checker_from_env, query_budget
 
 # --- セキュリティ設定 ---
 # SECRET_KEY = "your-secret-key-is-not-secret-at-all" # ← この行をコメントアウトか削除
@@ -22,17 +49,47 @@ SECRET_KEY = os.getenv("SECRET_KEY", "a-secure-default-key-for-local-dev") # ★
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# bcrypt の計算は専用のスレッドプールで行う (イベントループを止めないため)
+password_pool = create_pool_from_env()
+PASSWORD_POOL_RETRY_AFTER_SECONDS = int(os.getenv("PASSWORD_POOL_RETRY_AFTER_SECONDS", 1))
+# 認証済みユーザーのキャッシュ (トークン -> User)
+principal_cache = create_cache_from_env()
+# /products と /settings のレスポンスキャッシュ (商品・在庫が変わるたびに bump() する)
+catalog_cache = CatalogCache(max_age_seconds=float(os.getenv("CATALOG_CACHE_MAX_AGE_SECONDS", 30)))
+# ルートごとのレイテンシやDB時間などの計測値 (/metrics で Prometheus 形式で出す)
+metrics = MetricsRegistry()
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 app = FastAPI()
 
 # --- ★★★ データベース設定 (ここから追加) ★★★ ---
-SQLALCHEMY_DATABASE_URL = "sqlite:///./coffee.db"
+SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./coffee.db")
 # ↑「coffee.db」という名前のファイルにデータベースを作る、という設定です
+# (ベンチマークなどで別のDBファイルを使うときは環境変数 DATABASE_URL で上書きできます)
 
+# WAL や busy_timeout などの PRAGMA とプールサイズは sqlite_tuning.py で設定します
 engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
+    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False},
+    poolclass=pool_class_with_wait_metrics(QueuePool, metrics, "sync"),
+    **pool_options_from_env()
 )
+apply_sqlite_pragmas(engine)
+instrument_engine(engine)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# --- ★ 非同期エンドポイント用のエンジンとセッション (aiosqlite) ---
+# async def のエンドポイントで同期セッションを使うと、SQLiteの待ち時間の間
+# イベントループ全体が止まってしまうため、非同期版を別に用意します。
+# (起動時のテーブル作成や migrate.py などのスクリプトは同期版をそのまま使います)
+ASYNC_SQLALCHEMY_DATABASE_URL = SQLALCHEMY_DATABASE_URL.replace("sqlite://", "sqlite+aiosqlite://", 1)
+async_engine = create_async_engine(
+    ASYNC_SQLALCHEMY_DATABASE_URL,
+    poolclass=pool_class_with_wait_metrics(AsyncAdaptedQueuePool, metrics, "async"),
+    **pool_options_from_env()
+)
+apply_sqlite_pragmas(async_engine.sync_engine)
+instrument_engine(async_engine.sync_engine)
+# commit後に属性が失効すると、レスポンス生成時に遅延ロード(=同期I/O)が走ってしまうので無効にする
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
 # --- ★★★ (ここまで追加) ★★★ ---
 
@@ -42,6 +99,14 @@ app.add_middleware(
     CORSMiddleware, allow_origins=origins, allow_credentials=True,
     allow_methods=["*"], allow_headers=["*"],
 )
+# ★ 計測用ミドルウェア (最後に追加したものが一番外側になるので、CORSの処理時間も含めて計測する)
+# (SQLの実行回数が @query_budget の上限を超えたり、N+1 の疑いがあるときは警告する。テストでは例外にする)
+app.add_middleware(MetricsMiddleware, registry=metrics, query_checker=create_checker_from_env())
+metrics.register_engine("sync", engine)
+metrics.register_engine("async", async_engine)
+metrics.add_gauge_source("password_pool", password_pool.metrics)
+metrics.add_gauge_source("principal_cache", principal_cache.stats)
+metrics.add_gauge_source("catalog_cache", catalog_cache.stats)
 
 # --- モデル定義 ---
 class UserCreate(BaseModel):
@@ -136,6 +201,12 @@ class BeanOrderModel(Base):
     items = relationship("BeanOrderItemModel", back_populates="order")
     history = relationship("OrderHistoryModel", back_populates="order") # 履歴との連携
 
+    __table_args__ = (
+        Index("ix_bean_orders_user_id_date_order_id", "user_id", "date", "order_id"), # /orders/me (order_id まで並べ替えに使う)
+        Index("ix_bean_orders_status_date_order_id", "status", "date", "order_id"), # ステータスでの絞り込み (order_id まで並べ替えに使う)
+        Index("ix_bean_orders_date_order_id", "date", "order_id"), # 管理画面の新しい順ページング
+    )
+
 class BeanOrderItemModel(Base):
     __tablename__ = "bean_order_items"
     
@@ -153,17 +224,25 @@ class BeanOrderItemModel(Base):
     order = relationship("BeanOrderModel", back_populates="items")
     product = relationship("ProductModel")
 
+    __table_args__ = (
+        Index("ix_bean_order_items_bean_order_id", "bean_order_id"),
+    )
+
 # --- ★★★ 新しいテーブル: 注文履歴 ★★★ ---
 class OrderHistoryModel(Base):
     __tablename__ = "order_history"
 
     id = Column(Integer, primary_key=True, index=True)
     order_id = Column(String, ForeignKey("bean_orders.order_id"))
-    timestamp = Column(DateTime, default=dt.datetime.now(timezone.utc))
+    timestamp = Column(DateTime, default=lambda: dt.datetime.now(timezone.utc)) # ★ 行ごとに現在時刻を入れる
     actor_name = Column(String) # 例: "山田 太郎", "システム"
     action = Column(String) # 例: "注文を作成しました", "ステータスを「発送済」に変更しました"
 
     order = relationship("BeanOrderModel", back_populates="history")
+
+    __table_args__ = (
+        Index("ix_order_history_order_id", "order_id"),
+    )
 # --- ★★★ ここまで ★★★ ---
 
 class BeanInventoryModel(Base):
@@ -187,6 +266,12 @@ class OrderModel(Base):
     customer = relationship("UserModel")
     bean_type = relationship("BeanInventoryModel") # ★ 紐付けを定義
 
+    __table_args__ = (
+        Index("ix_orders_user_id_date", "user_id", "date"), # /orders/me
+        Index("ix_orders_status_date_id", "status", "date", "id"), # ステータスでの絞り込み (id まで並べ替えに使う)
+        Index("ix_orders_date", "date"), # 管理画面の新しい順ページング (idはrowidなので含めなくてよい)
+    )
+
 
 # --- ★★★ サブスクリプション関連のDBモデル (ここから追加) ★★★ ---
 class SubscriptionContractModel(Base):
@@ -203,6 +288,12 @@ class SubscriptionContractModel(Base):
     customer = relationship("UserModel")
     items = relationship("SubscriptionContractItemModel", back_populates="contract")
 
+    __table_args__ = (
+        Index("ix_subscription_contracts_user_id", "user_id"),
+        # 定期便の更新対象 (status = 'active' かつ next_delivery_date が期日以前) を順に読むため
+        Index("ix_subscription_contracts_status_next_delivery_date", "status", "next_delivery_date"),
+    )
+
 class SubscriptionContractItemModel(Base):
     __tablename__ = "subscription_contract_items"
 
@@ -213,22 +304,131 @@ class SubscriptionContractItemModel(Base):
 
     contract = relationship("SubscriptionContractModel", back_populates="items")
     product = relationship("ProductModel")
+
+    __table_args__ = (
+        Index("ix_subscription_contract_items_contract_id", "contract_id"),
+    )
 # --- ★★★ (ここまで追加) ★★★ ---
 
+# --- ★ 注文IDの採番用テーブル (id_allocator.py で使用) ---
+class IdSequenceModel(Base):
+    __tablename__ = "id_sequences"
+
+    name = Column(String, primary_key=True) # 例: "orders", "bean_orders"
+    next_value = Column(Integer, nullable=False) # 次に確保される範囲の先頭
+
+# --- ★ 売上の日次集計テーブル (/admin/stats 用) ---
+# 注文の作成・ステータス変更と同じトランザクションで増減させるので、
+# ダッシュボードの集計は「日数 × 商品数」の行を読むだけで済む (注文の件数に依存しない)
+class DailyProductSalesModel(Base):
+    __tablename__ = "daily_product_sales"
+
+    date = Column(String, primary_key=True) # 注文日 "2025-09-15"
+    product_id = Column(String, primary_key=True) # 焙煎豆の商品ID
+    quantity = Column(Integer, nullable=False, default=0) # 販売数
+    revenue = Column(Integer, nullable=False, default=0) # 売上 (円)
+    order_count = Column(Integer, nullable=False, default=0) # この商品を含む注文の件数
+
+class DailyBeanSalesModel(Base):
+    __tablename__ = "daily_bean_sales"
+
+    date = Column(String, primary_key=True)
+    bean = Column(String, primary_key=True) # デリバリー用の豆 "エチオピア・シダモ" など
+    quantity = Column(Integer, nullable=False, default=0) # 杯数 (デリバリー注文は1件1杯で、価格はない)
+
+# --- ★ デリバリーの時間枠ごとの予約数 ---
+# create_order と同じトランザクションで増やすので、枠の空きは主キーで1行読むだけで分かる (orders を数えない)
+class DeliverySlotCountModel(Base):
+    __tablename__ = "delivery_slot_counts"
+
+    date = Column(String, primary_key=True) # 注文日 "2025-09-15"
+    time = Column(String, primary_key=True) # 枠の開始時刻 "10:00"
+    booked = Column(Integer, nullable=False, default=0) # キャンセルされていない注文の件数
+
+# --- ★ 注文APIの冪等キー (idempotency.py) ---
+# 同じ Idempotency-Key の再送には、ここに保存した最初のレスポンスを返す
+class IdempotencyKeyModel(Base):
+    __tablename__ = "idempotency_keys"
+
+    endpoint = Column(String, primary_key=True) # "POST /orders" など
+    user_id = Column(Integer, primary_key=True)
+    key = Column(String, primary_key=True) # Idempotency-Key ヘッダーの値
+    fingerprint = Column(String, nullable=False) # リクエスト本文のハッシュ
+    status_code = Column(Integer, nullable=True) # NULL なら処理中
+    response_body = Column(String, nullable=True) # 保存したレスポンスのJSON
+    created_at = Column(Float, nullable=False) # UNIX時刻
+    expires_at = Column(Float, nullable=False) # UNIX時刻 (過ぎたら同じキーを新しいリクエストとして扱う)
+
+    __table_args__ = (
+        Index("ix_idempotency_keys_expires_at", "expires_at"),
+    )
+
 
 # --- ★★★ (ここまで追加) ★★★ ---
 
 
+# --- ★ 注文IDの採番 ---
+# 以前は count() + 1 で決めていたため、注文が増えるほど遅くなり、同時注文でIDが重複していた。
+# 初回は既存データの最大ID + 1 から始める (デリバリー注文は1001から、焙煎豆注文は bo-00000001 から)
+ORDER_ID_BLOCK_SIZE = int(os.getenv("ORDER_ID_BLOCK_SIZE", 10))
+order_id_allocator = IdBlockAllocator(
+    AsyncSessionLocal, IdSequenceModel.__table__, "orders",
+    select(func.coalesce(func.max(OrderModel.id) + 1, 1001)),
+    block_size=ORDER_ID_BLOCK_SIZE,
+)
+bean_order_id_allocator = IdBlockAllocator(
+    AsyncSessionLocal, IdSequenceModel.__table__, "bean_orders",
+    select(func.coalesce(func.max(cast(func.substr(BeanOrderModel.order_id, 4), Integer)) + 1, 1))
+    .filter(BeanOrderModel.order_id.like("bo-%")),
+    block_size=ORDER_ID_BLOCK_SIZE,
+)
+
+# 焙煎豆の注文IDは番号を固定幅でゼロ埋めする。一覧は (date, order_id) の降順なので、
+# 桁数が変わると文字列の比較で 'bo-1000' < 'bo-999' となり、同じ日の中で新しい順にならない。
+# (以前の 'bo-001' 形式のIDはそのまま残る。その日の中だけは番号順でなく文字列順に並ぶ)
+BEAN_ORDER_ID_DIGITS = 8
+
+def format_bean_order_id(number: int) -> str:
+    '''採番した番号から焙煎豆の注文ID ("bo-00000012" の形式) を作る'''
+    return f"bo-{number:0{BEAN_ORDER_ID_DIGITS}d}"
+
+# --- ★ デリバリー用の豆在庫の write-behind (bean_stock.py) ---
+# BEAN_STOCK_WRITE_BEHIND=1 のときだけ有効 (None なら従来どおり条件付きUPDATEで引き当てる)
+bean_stock = create_bean_stock_from_env(engine, BeanInventoryModel.__table__, IdSequenceModel.__table__)
+BEAN_STOCK_FLUSH_INTERVAL_SECONDS = float(os.getenv("BEAN_STOCK_FLUSH_INTERVAL_SECONDS", 1))
+if bean_stock is not None:
+    metrics.add_gauge_source("bean_stock", bean_stock.stats)
+
+# --- ★ 注文APIの冪等キー (idempotency.py) ---
+idempotency_store = create_store_from_env(AsyncSessionLocal, IdempotencyKeyModel.__table__)
+IDEMPOTENCY_PURGE_INTERVAL_SECONDS = float(os.getenv("IDEMPOTENCY_PURGE_INTERVAL_SECONDS", 3600))
+metrics.add_gauge_source("idempotency", idempotency_store.stats)
+
 # --- 認証ヘルパー関数 ---
-def get_user(db: Session, email: str):
+async def get_user(db: AsyncSession, email: str):
     '''
-    データベースからメールアドレスでユーザーを検索する（SQLAlchemy版）
+    データベースからメールアドレスでユーザーを検索する（AsyncSession版）
     '''
-    return db.query(UserModel).filter(UserModel.email == email).first()
+    result = await db.execute(select(UserModel).filter(UserModel.email == email))
+    return result.scalars().first()
 
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
+async def run_in_password_pool(fn, *args):
+    '''
+    パスワードのハッシュ化・照合をプールで実行する。
+    プールが満杯のときは待たずに 503 (Retry-After付き) を返す。
+    '''
+    try:
+        return await password_pool.run(fn, *args)
+    except PasswordPoolSaturated:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="ただいま混み合っています。しばらくしてから再度お試しください。",
+            headers={"Retry-After": str(PASSWORD_POOL_RETRY_AFTER_SECONDS)},
+        )
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     expire = datetime.now(timezone.utc) + (expires_delta or timedelta(minutes=15))
@@ -243,10 +443,135 @@ def get_db():
     finally:
         db.close()
 
+async def get_async_db():
+    '''async def のエンドポイント用に、非同期のデータベースセッションを確立する'''
+    async with AsyncSessionLocal() as db:
+        yield db
+
+# 置き換えて使わなくなったインデックス (ensure_indexes で削除する)
+OBSOLETE_INDEXES = {
+    "ix_bean_orders_user_id_date",  # -> ix_bean_orders_user_id_date_order_id
+    "ix_bean_orders_status_date",   # -> ix_bean_orders_status_date_order_id
+    "ix_orders_status_date",        # -> ix_orders_status_date_id
+}
+
+def ensure_indexes(bind=None):
+    '''
+    モデルに定義したインデックスのうち、DBにまだ無いものを作成する (何度実行しても安全)。
+    create_all は既存のテーブルにはインデックスを追加しないため、古い coffee.db 用に必要。
+    作成したインデックス名のリストを返す。
+    '''
+    bind = bind or engine
+    created = []
+    with bind.begin() as conn:
+        existing = {
+            row[0] for row in conn.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'index'")
+        }
+        # 列を足したインデックスに置き換えたものは、古い方を削除する
+        for name in OBSOLETE_INDEXES & existing:
+            conn.exec_driver_sql(f'DROP INDEX "{name}"')
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(bind=conn)
+                    created.append(index.name)
+        if created:
+            # クエリプランナーが新しいインデックスを使えるように統計を更新する
+            conn.exec_driver_sql("ANALYZE")
+    return created
+
+def rebuild_sales_summary(bind=None):
+    '''
+    売上の日次集計テーブルを注文データから作り直す。
+    集計テーブルができる前の coffee.db や、generate_data.py などで注文を直接投入したあとに使う
+    '''
+    bind = bind or engine
+    B, I, P = BeanOrderModel, BeanOrderItemModel, ProductModel
+    # 明細には単価がないので、注文の合計金額を 現在の単価×数量 の比で商品ごとに按分する
+    weights = (
+        select(I.bean_order_id, func.sum(I.quantity * P.price).label("weight"))
+        .join(P, P.id == I.product_id)
+        .group_by(I.bean_order_id)
+        .subquery()
+    )
+    with bind.begin() as conn:
+        conn.execute(delete(_product_sales_table))
+        conn.execute(delete(_bean_sales_table))
+        conn.execute(insert(_product_sales_table).from_select(
+            ["date", "product_id", "quantity", "revenue", "order_count"],
+            select(
+                B.date, I.product_id, func.sum(I.quantity),
+                func.coalesce(cast(func.round(func.sum(
+                    B.total_price * 1.0 * I.quantity * P.price / weights.c.weight
+                )), Integer), 0),
+                func.count(func.distinct(B.order_id)),
+            )
+            .join(I, I.bean_order_id == B.order_id)
+            .join(P, P.id == I.product_id)
+            .join(weights, weights.c.bean_order_id == B.order_id)
+            .where(counts_as_sale(B.status))
+            .group_by(B.date, I.product_id),
+        ))
+        conn.execute(insert(_bean_sales_table).from_select(
+            ["date", "bean", "quantity"],
+            select(OrderModel.date, OrderModel.beans, func.count())
+            .where(counts_as_sale(OrderModel.status))
+            .group_by(OrderModel.date, OrderModel.beans),
+        ))
+
+def rebuild_slot_counts(bind=None):
+    '''時間枠ごとの予約数を注文データから作り直す (rebuild_sales_summary と同じく、注文を直接投入したあとに使う)'''
+    bind = bind or engine
+    slot_counts = DeliverySlotCountModel.__table__
+    with bind.begin() as conn:
+        conn.execute(delete(slot_counts))
+        conn.execute(insert(slot_counts).from_select(
+            ["date", "time", "booked"],
+            select(OrderModel.date, OrderModel.time, func.count())
+            .where(counts_as_sale(OrderModel.status), OrderModel.time.is_not(None))
+            .group_by(OrderModel.date, OrderModel.time),
+        ))
+
+def ensure_slot_counts(bind=None):
+    '''予約数のテーブルが空で注文がある (テーブルを追加する前のDB) ときだけ作り直す'''
+    bind = bind or engine
+    with bind.connect() as conn:
+        counts_empty = conn.scalar(select(DeliverySlotCountModel.date).limit(1)) is None
+        has_orders = conn.scalar(select(OrderModel.id).limit(1)) is not None
+    if counts_empty and has_orders:
+        rebuild_slot_counts(bind)
+        return True
+    return False
+
+def ensure_sales_summary(bind=None):
+    '''集計テーブルが空で注文がある (集計テーブルを追加する前のDB) ときだけ作り直す'''
+    bind = bind or engine
+    with bind.connect() as conn:
+        summary_empty = (
+            conn.scalar(select(func.count()).select_from(_product_sales_table)) == 0
+            and conn.scalar(select(func.count()).select_from(_bean_sales_table)) == 0
+        )
+        has_orders = conn.scalar(select(BeanOrderModel.order_id).limit(1)) or conn.scalar(select(OrderModel.id).limit(1))
+    if summary_empty and has_orders:
+        rebuild_sales_summary(bind)
+        return True
+    return False
+
 @app.on_event("startup")
 def on_startup():
     '''アプリ起動時にデータベースとテーブルを作成し、テストユーザーを登録する'''
     Base.metadata.create_all(bind=engine)
+    created_indexes = ensure_indexes()
+    if created_indexes:
+        print(f"--- Indexes created: {', '.join(created_indexes)} ---")
+    if ensure_sales_summary():
+        print("--- Sales summary rebuilt ---")
+    if ensure_slot_counts():
+        print("--- Delivery slot counts rebuilt ---")
+    if bean_stock is not None:
+        replayed = bean_stock.reconcile()
+        if replayed:
+            print(f"--- Bean stock journal replayed: {replayed} records ---")
 
     db = SessionLocal()
     try:
@@ -313,11 +638,14 @@ def on_startup():
             print("--- Sample subscription created ---")
 
         # サンプル焙煎豆注文が存在するか確認
-        sample_bean_order = db.query(BeanOrderModel).filter(BeanOrderModel.order_id == "bo-001").first()
+        sample_order_id = format_bean_order_id(1)
+        sample_bean_order = db.query(BeanOrderModel).filter(
+            BeanOrderModel.order_id.in_(["bo-001", sample_order_id])  # 古いDBのサンプルは 'bo-001'
+        ).first()
         if not sample_bean_order:
             # 注文を作成
             new_order = BeanOrderModel(
-                order_id="bo-001",
+                order_id=sample_order_id,
                 user_id=test_user.id,
                 date=datetime.now(timezone.utc).strftime("%Y-%m-%d"),
                 total_price=3000,
@@ -341,6 +669,7 @@ def on_startup():
                 lot_number="L-20241014-01"
             )
             db.add(order_item)
+            db.execute(_add_product_sales_stmt, product_sales_rows(new_order.date, [("bean-001", 2, 3000)]))
 
             # 注文履歴を紐付け
             history1 = OrderHistoryModel(
@@ -363,10 +692,77 @@ def on_startup():
         db.close()
 # --- ★★★ (ここまで追加) ★★★ ---
 
+# --- ★ 定期便の自動更新 (subscription_renewal.py) ---
+# 0 (デフォルト) なら無効。CLI (python subscription_renewal.py) を cron などで実行してもよい
+SUBSCRIPTION_RENEWAL_INTERVAL_SECONDS = float(os.getenv("SUBSCRIPTION_RENEWAL_INTERVAL_SECONDS", 0))
+
+async def subscription_renewal_loop():
+    '''期日が来た定期便の契約を、一定間隔でまとめて更新し続ける'''
+    # subscription_renewal は main を読み込むので、ここでインポートする
+    from subscription_renewal import renew_due_subscriptions
+    while True:
+        try:
+            # 同期のバッチ処理なので、イベントループを止めないように別スレッドで実行する
+            report = await asyncio.to_thread(renew_due_subscriptions)
+            if report["renewed"]:
+                print(f"--- Subscriptions renewed: {report} ---")
+        except Exception as e:
+            print(f"😱 定期便の更新中にエラーが発生: {e}")
+        await asyncio.sleep(SUBSCRIPTION_RENEWAL_INTERVAL_SECONDS)
+
+@app.on_event("startup")
+async def start_subscription_renewal():
+    if SUBSCRIPTION_RENEWAL_INTERVAL_SECONDS > 0:
+        app.state.subscription_renewal_task = asyncio.create_task(subscription_renewal_loop())
+
+async def bean_stock_flush_loop():
+    '''豆在庫のカウンターの増減を、一定間隔でまとめてDBに反映し続ける'''
+    while True:
+        await asyncio.sleep(BEAN_STOCK_FLUSH_INTERVAL_SECONDS)
+        try:
+            await asyncio.to_thread(bean_stock.flush)
+        except Exception as e:
+            # 反映できなかった分はジャーナルに残っているので、次の回に再実行される
+            print(f"😱 豆在庫の反映中にエラーが発生: {e}")
+
+@app.on_event("startup")
+async def start_bean_stock_flush():
+    if bean_stock is not None:
+        app.state.bean_stock_flush_task = asyncio.create_task(bean_stock_flush_loop())
+
+async def idempotency_purge_loop():
+    '''期限切れの冪等キーを一定間隔で削除し続ける'''
+    while True:
+        try:
+            await idempotency_store.purge_expired()
+        except Exception as e:
+            print(f"😱 冪等キーの削除中にエラーが発生: {e}")
+        await asyncio.sleep(IDEMPOTENCY_PURGE_INTERVAL_SECONDS)
+
+@app.on_event("startup")
+async def start_idempotency_purge():
+    app.state.idempotency_purge_task = asyncio.create_task(idempotency_purge_loop())
+
+@app.on_event("shutdown")
+def on_shutdown():
+    '''アプリ終了時にパスワード用のスレッドプールと定期便の自動更新を止め、豆在庫の残りを反映する'''
+    password_pool.shutdown()
+    for task_name in ("subscription_renewal_task", "bean_stock_flush_task", "idempotency_purge_task"):
+        task = getattr(app.state, task_name, None)
+        if task is not None:
+            task.cancel()
+    if bean_stock is not None:
+        bean_stock.close()
+
 async def get_current_user(
     token: str = Depends(oauth2_scheme),
-    db: Session = Depends(get_db) # ★ DBセッションを追加
+    db: AsyncSession = Depends(get_async_db) # ★ DBセッションを追加
 ):
+    # キャッシュにあれば jwt.decode も DB検索もせずに返す
+    cached_user = principal_cache.get(token)
+    if cached_user is not None:
+        return cached_user
+
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials", headers={"WWW-Authenticate": "Bearer"},
@@ -379,13 +775,16 @@ async def get_current_user(
         raise credentials_exception
     
     # db = load_data() <- 古いコードを削除
-    user = get_user(db, email=email) # ★ 新しいget_user関数を呼ぶ
+    generation = principal_cache.generation() # 読んでいる間にユーザー情報が更新されたら、キャッシュに入れない
+    user = await get_user(db, email=email) # ★ 新しいget_user関数を呼ぶ
     
     if user is None: raise credentials_exception
     
     # Pydanticモデル(User)とSQLAlchemyモデル(UserModel)は別物なので、
     # ここでPydanticモデル(User)に詰め替えてから返す
-    return User.from_orm(user)
+    current_user = User.from_orm(user)
+    principal_cache.put(token, current_user, current_user.id, token_exp=payload.get("exp"), generation=generation)
+    return current_user
 
 
 async def get_current_admin_user(current_user: User = Depends(get_current_user)):
@@ -404,18 +803,18 @@ async def read_users_me(current_user: User = Depends(get_current_user)):
     return current_user
 
 @app.post("/users", response_model=User, status_code=status.HTTP_201_CREATED)
-async def create_user(user: UserCreate, db: Session = Depends(get_db)):
+async def create_user(user: UserCreate, db: AsyncSession = Depends(get_async_db)):
     '''新規ユーザー登録'''
-    db_user = get_user(db, email=user.email)
+    db_user = await get_user(db, email=user.email)
     if db_user:
         raise HTTPException(status_code=400, detail="このメールアドレスは既に使用されています")
     
-    hashed_password = pwd_context.hash(user.password)
+    hashed_password = await run_in_password_pool(pwd_context.hash, user.password)
     db_user = UserModel(email=user.email, name=user.name, hashed_password=hashed_password)
     
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     
     return db_user
 
@@ -424,18 +823,21 @@ async def create_user(user: UserCreate, db: Session = Depends(get_db)):
 @app.post("/token", response_model=Token)
 async def login_for_access_token(
     form_data: OAuth2PasswordRequestForm = Depends(), 
-    db: Session = Depends(get_db)  # ★ DBセッションを依存関係として追加
+    db: AsyncSession = Depends(get_async_db)  # ★ DBセッションを依存関係として追加
 ):
     try:
-        user = get_user(db, form_data.username)
+        user = await get_user(db, form_data.username)
         
-        if not user or not verify_password(form_data.password, user.hashed_password):
+        if not user or not await run_in_password_pool(verify_password, form_data.password, user.hashed_password):
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Incorrect username or password", headers={"WWW-Authenticate": "Bearer"},
             )
         access_token = create_access_token(data={"sub": user.email})
         return {"access_token": access_token, "token_type": "bearer"}
+    except HTTPException:
+        # 401 (認証失敗) や 503 (混雑) はそのままフロントに返す
+        raise
     except Exception as e:
         print(f"--- LOGIN ERROR ---")
         print(f"Error in login_for_access_token: {e}")
@@ -447,80 +849,388 @@ async def login_for_access_token(
             detail="An internal server error occurred.",
         )
 
+USER_ORDERS_DEFAULT_LIMIT = 50
+USER_ORDERS_MAX_LIMIT = 200
+
+def user_delivery_orders_stmt(user_id: int):
+    '''/orders/me のデリバリー注文の SELECT (ページングの条件は keyset_page_stmt で付ける)'''
+    return select(OrderModel).filter(OrderModel.user_id == user_id)
+
+def user_bean_orders_stmt(user_id: int):
+    '''/orders/me の焙煎豆注文の SELECT (明細と商品名もまとめて読み込む)'''
+    return (
+        select(BeanOrderModel)
+        .filter(BeanOrderModel.user_id == user_id)
+        .options(selectinload(BeanOrderModel.items).joinedload(BeanOrderItemModel.product))
+    )
+
 @app.get("/orders/me")
+@query_budget(4) # ★ 1リクエストのSQL実行回数の上限 (認証のクエリも含む)
 async def read_user_orders(
+    limit: int = Query(USER_ORDERS_DEFAULT_LIMIT, ge=1, le=USER_ORDERS_MAX_LIMIT),
+    delivery_cursor: Optional[str] = None,
+    bean_cursor: Optional[str] = None,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    '''ログイン中のユーザーの注文履歴を取得する（完全DB版）'''
+    '''
+    ログイン中のユーザーの注文履歴を新しい順に1ページ分取得する（完全DB版）
+    注文数に関係なく、クエリは「デリバリー1回 + 焙煎豆1回 + 明細1回」の3回で済む
+    続きは next_delivery_cursor / next_bean_cursor を次のリクエストに渡して取得する
+    '''
     user_id = current_user.id
 
     # --- デリバリー注文をDBから取得 ---
-    user_delivery_orders = db.query(OrderModel).filter(OrderModel.user_id == user_id).all()
+    user_delivery_orders, next_delivery_cursor = await fetch_keyset_page(
+        db, user_delivery_orders_stmt(user_id), OrderModel.date, OrderModel.id, delivery_cursor, limit
+    )
 
-    # --- 焙煎豆注文をDBから取得 ---
-    user_bean_orders = db.query(BeanOrderModel).filter(BeanOrderModel.user_id == user_id).all()
+    # --- 焙煎豆注文をDBから取得 (明細と商品名もまとめて読み込む) ---
+    user_bean_orders, next_bean_cursor = await fetch_keyset_page(
+        db, user_bean_orders_stmt(user_id), BeanOrderModel.date, BeanOrderModel.order_id, bean_cursor, limit
+    )
 
     return {
-        "delivery_orders": user_delivery_orders,
-        "bean_orders": user_bean_orders
+        "delivery_orders": [
+            {
+                "id": o.id, "user_id": o.user_id, "date": o.date, "time": o.time,
+                "size": o.size, "beans": o.beans, "status": o.status, "notes": o.notes,
+            }
+            for o in user_delivery_orders
+        ],
+        "bean_orders": [
+            {
+                "order_id": o.order_id, "user_id": o.user_id, "date": o.date,
+                "total_price": o.total_price, "shipping_address": o.shipping_address,
+                "status": o.status, "payment_method": o.payment_method,
+                "shipping_method": o.shipping_method, "coupon_code": o.coupon_code,
+                "tracking_number": o.tracking_number, "shipping_carrier": o.shipping_carrier,
+                # internal_notes はスタッフ用のメモなので顧客には返さない
+                "items": [
+                    {
+                        "product_id": item.product_id,
+                        "product_name": item.product.name if item.product else None,
+                        "quantity": item.quantity,
+                        "grind_option": item.grind_option,
+                    }
+                    for item in o.items
+                ],
+            }
+            for o in user_bean_orders
+        ],
+        "next_delivery_cursor": next_delivery_cursor,
+        "next_bean_cursor": next_bean_cursor,
     }
 
+# その他の固定設定（YAMLから移行）
+SHOP_SETTINGS = {
+    "coffee_shop": {
+        "name": "出張コーヒー屋",
+        "address": "オフィスビル 3F",
+        "contact": "080-1234-5678"
+    },
+    "operational_hours": {
+        "start": "09:00",
+        "end": "18:00"
+    },
+}
+
+# --- ★ デリバリーの時間枠 ---
+# operational_hours を DELIVERY_SLOT_MINUTES 分ごとに区切り、枠ごとに DELIVERY_SLOT_CAPACITY 件まで受け付ける。
+# 混む時間だけ定員を変えるときは DELIVERY_SLOT_CAPACITY_OVERRIDES="12:00=20,12:30=20" のように指定する
+DELIVERY_SLOT_MINUTES = int(os.getenv("DELIVERY_SLOT_MINUTES", 30))
+DELIVERY_SLOT_CAPACITY = int(os.getenv("DELIVERY_SLOT_CAPACITY", 10))
+
+def build_delivery_slots(hours: dict, minutes: int, capacity: int, overrides: str = "") -> dict:
+    '''営業時間内の時間枠 {"HH:MM": 定員} を開始時刻順に返す (終了時刻ちょうどの枠は含まない)'''
+    start = datetime.strptime(hours["start"], "%H:%M")
+    end = datetime.strptime(hours["end"], "%H:%M")
+    slots = {}
+    while start < end:
+        slots[start.strftime("%H:%M")] = capacity
+        start += timedelta(minutes=minutes)
+    for item in filter(None, (part.strip() for part in overrides.split(","))):
+        slot_time, slot_capacity = item.split("=")
+        if slot_time.strip() in slots:
+            slots[slot_time.strip()] = int(slot_capacity)
+    return slots
+
+DELIVERY_SLOTS = build_delivery_slots(
+    SHOP_SETTINGS["operational_hours"], DELIVERY_SLOT_MINUTES, DELIVERY_SLOT_CAPACITY,
+    os.getenv("DELIVERY_SLOT_CAPACITY_OVERRIDES", ""),
+)
+
+def dump_json(data) -> bytes:
+    '''FastAPIの標準 (JSONResponse) と同じ形式でJSONのバイト列にする (orjson があれば orjson で)'''
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+class FastJSONResponse(Response):
+    '''
+    dict / list をそのまま dump_json でバイト列にするレスポンス。
+    エンドポイントからこのレスポンスを直接返すと、FastAPI の jsonable_encoder と
+    response_model の検証を通らないので、件数の多い一覧で速い (値はJSONにできる型だけにすること)
+    '''
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return dump_json(content)
+
+# ★ 管理画面に新しい注文・ステータスの変更を送る pub/sub (order_events.py、GET /admin/orders/stream)
+order_events = create_broker_from_env(dump_json)
+ORDER_EVENTS_HEARTBEAT_SECONDS = float(os.getenv("ORDER_EVENTS_HEARTBEAT_SECONDS", 15))
+metrics.add_gauge_source("order_events", order_events.stats)
+
+@app.on_event("shutdown")
+def close_order_events():
+    # 接続中のストリームを終わらせないと、サーバーの終了がストリームの切断まで待たされる
+    order_events.close()
+
+def catalog_response(entry, if_none_match: Optional[str]) -> Response:
+    '''キャッシュしたJSONを返す。If-None-Match が一致すれば本文なしの 304'''
+    headers = {"ETag": entry.etag, "Cache-Control": "no-cache"}
+    if etag_matches(if_none_match, entry.etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=entry.body, media_type="application/json", headers=headers)
+
 @app.get("/settings")
-def get_settings(db: Session = Depends(get_db)): # ★ DBセッションを追加
-    '''設定情報を返す（DB + ハードコード版）'''
-    
-    # 1. デリバリー用の豆在庫をDBから取得
-    inventory_items = db.query(BeanInventoryModel).filter(BeanInventoryModel.stock > 0).all()
-    # 在庫がある豆の名前のリストを作成
-    bean_inventory = {item.name: item.stock for item in inventory_items}
-    
-    # 2. その他の固定設定（YAMLから移行）
-    settings_data = {
-        "coffee_shop": {
-            "name": "出張コーヒー屋",
-            "address": "オフィスビル 3F",
-            "contact": "080-1234-5678"
-        },
-        "operational_hours": {
-            "start": "09:00",
-            "end": "18:00"
-        },
-        "bean_inventory": bean_inventory # ★ DBから取得した在庫情報
-    }
-    
-    return settings_data
+def get_settings(
+    db: Session = Depends(get_db), # ★ DBセッションを追加
+    if_none_match: Optional[str] = Header(None),
+):
+    '''設定情報を返す（DB + ハードコード版、ETag対応）'''
 
-@app.post("/orders", status_code=201)
-async def create_order(
-    order: OrderCreate, 
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db) # ★ DBセッションを追加
+    def build():
+        # 1. デリバリー用の豆在庫をDBから取得 (write-behind のときはDBより新しいカウンターの値)
+        if bean_stock is not None:
+            bean_inventory = {name: stock for name, stock in bean_stock.snapshot().items() if stock > 0}
+        else:
+            inventory_items = db.query(BeanInventoryModel).filter(BeanInventoryModel.stock > 0).all()
+            # 在庫がある豆の名前のリストを作成
+            bean_inventory = {item.name: item.stock for item in inventory_items}
+
+        # 2. 固定設定と合わせる
+        settings_data = {**SHOP_SETTINGS, "bean_inventory": bean_inventory} # ★ DBから取得した在庫情報
+        return dump_json(settings_data)
+
+    # キャッシュが有効ならDBには触らない
+    return catalog_response(catalog_cache.get_or_build("settings", build), if_none_match)
+
+@app.get("/slots")
+@query_budget(1)
+async def get_delivery_slots(
+    date: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}-\d{2}$"), # 省略時は今日
+    db: AsyncSession = Depends(get_async_db)
 ):
-    '''デリバリー注文を作成する（SQLAlchemy + トランザクション版）'''
-    
-    try:
-        # 1. 在庫テーブルから注文された豆を探す（ロックをかける）
-        bean_stock = db.query(BeanInventoryModel).filter(BeanInventoryModel.name == order.beans).with_for_update().first()
-        
-        # 2. 在庫確認
-        if not bean_stock or bean_stock.stock <= 0:
+    '''指定日の時間枠ごとの定員と残り (読むのはその日の予約数の行だけ)'''
+    day = date or datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    result = await db.execute(
+        select(DeliverySlotCountModel.time, DeliverySlotCountModel.booked).where(DeliverySlotCountModel.date == day)
+    )
+    booked = dict(result.all())
+    return {
+        "date": day,
+        "slot_minutes": DELIVERY_SLOT_MINUTES,
+        "slots": [
+            {"time": slot_time, "capacity": capacity, "booked": booked.get(slot_time, 0),
+             "remaining": max(capacity - booked.get(slot_time, 0), 0)}
+            for slot_time, capacity in DELIVERY_SLOTS.items()
+        ],
+    }
+
+# --- ★ 在庫の引当て (条件付きUPDATE) ---
+# SQLiteは SELECT ... FOR UPDATE を無視するため、読んでから書く方式だと同時注文で売り越してしまう。
+# 「在庫が足りているときだけ減らす」UPDATE を実行し、更新された行数(rowcount)で成否を判定する。
+_products_table = ProductModel.__table__
+_reserve_product_stmt = (
+    update(_products_table)
+    .where(
+        _products_table.c.id == bindparam("_product_id"),
+        _products_table.c.stock >= bindparam("_quantity"),
+    )
+    .values(stock=_products_table.c.stock - bindparam("_quantity"))
+)
+
+# --- ★ 売上の日次集計 (daily_product_sales / daily_bean_sales) の増減 ---
+# キャンセルされた注文は売上に含めない
+SALES_EXCLUDED_STATUSES = ("cancelled",)
+_product_sales_table = DailyProductSalesModel.__table__
+_bean_sales_table = DailyBeanSalesModel.__table__
+
+def counts_as_sale(status):
+    '''ステータスの列 (SQL式) に対して、売上に含める注文かどうかの条件を返す'''
+    return func.coalesce(status, "").not_in(SALES_EXCLUDED_STATUSES)
+
+def _add_to_summary_stmt(table, key_columns):
+    '''集計行がなければ作り、あれば値を足す (マイナスを渡せば減らす) UPSERT'''
+    stmt = sqlite_insert(table)
+    return stmt.on_conflict_do_update(
+        index_elements=key_columns,
+        set_={c.name: c + stmt.excluded[c.name] for c in table.columns if c.name not in key_columns},
+    )
+
+_add_product_sales_stmt = _add_to_summary_stmt(_product_sales_table, ["date", "product_id"])
+_add_bean_sales_stmt = _add_to_summary_stmt(_bean_sales_table, ["date", "bean"])
+
+# --- ★ 時間枠の予約 (delivery_slot_counts) ---
+# 定員に達していないときだけ1増やすUPSERT。満席なら何も変更されず、rowcount が 0 になる
+_slot_counts_table = DeliverySlotCountModel.__table__
+_book_slot_insert = sqlite_insert(_slot_counts_table).values(date=bindparam("_date"), time=bindparam("_time"), booked=1)
+_book_slot_stmt = _book_slot_insert.on_conflict_do_update(
+    index_elements=["date", "time"],
+    set_={"booked": _slot_counts_table.c.booked + 1},
+    where=_slot_counts_table.c.booked < bindparam("_capacity"),
+)
+# キャンセルの取り消しなどで予約数を増やす (定員は確認しない)
+_add_slot_count_stmt = _add_to_summary_stmt(_slot_counts_table, ["date", "time"])
+# 予約を1つ戻す。0 より下げない (集計がずれていても、ない空きを作ったりマイナスにしたりしない)
+_release_slot_stmt = (
+    update(_slot_counts_table)
+    .where(
+        _slot_counts_table.c.date == bindparam("_date"),
+        _slot_counts_table.c.time == bindparam("_time"),
+        _slot_counts_table.c.booked > 0,
+    )
+    .values(booked=_slot_counts_table.c.booked - 1)
+)
+
+async def release_delivery_slot(db: AsyncSession, order_date: str, slot_time: str):
+    '''時間枠の予約を1つ戻す (キャンセル、または在庫不足で予約を取り消すとき)'''
+    result = await db.execute(_release_slot_stmt, {"_date": order_date, "_time": slot_time})
+    if result.rowcount == 0:
+        # すでに 0 なら集計がずれている (rebuild_slot_counts() で注文データから作り直せる)
+        print(f"⚠️ 時間枠 {order_date} {slot_time} の予約数が 0 のため、戻せませんでした")
+
+async def book_delivery_slot(db: AsyncSession, order_date: str, slot_time: str):
+    '''時間枠を1つ予約する。営業時間の枠でなければ HTTPException(400)、満席なら HTTPException(409)'''
+    capacity = DELIVERY_SLOTS.get(slot_time)
+    if capacity is None:
+        raise HTTPException(status_code=400, detail=f'{slot_time}は受付時間外です。')
+    if capacity > 0:
+        result = await db.execute(_book_slot_stmt, {"_date": order_date, "_time": slot_time, "_capacity": capacity})
+        if result.rowcount == 1:
+            return
+    raise HTTPException(status_code=409, detail=f'{slot_time}の枠は満席です。ほかの時間を選んでください。')
+
+def product_sales_rows(order_date: str, lines, sign: int = 1):
+    '''
+    1件の注文の明細 [(商品ID, 数量, 金額), ...] から、_add_product_sales_stmt に渡す行を作る。
+    sign=-1 でキャンセル分を差し引く
+    '''
+    rows = {}
+    for product_id, quantity, revenue in lines:
+        row = rows.setdefault(product_id, {"date": order_date, "product_id": product_id,
+                                           "quantity": 0, "revenue": 0, "order_count": sign})
+        row["quantity"] += sign * quantity
+        row["revenue"] += sign * revenue
+    return list(rows.values())
+
+def split_order_revenue(total_price: int, quantities: dict, prices: dict):
+    '''
+    注文の合計金額を 単価×数量 の比で商品ごとに按分し、明細 [(商品ID, 数量, 金額), ...] を返す。
+    明細に注文時の単価を保存していないため、キャンセル時に使う (単価が変わっていなければ 単価×数量 と一致する)
+    '''
+    weights = {pid: (prices.get(pid) or 0) * q for pid, q in quantities.items()}
+    total_weight = sum(weights.values())
+    lines, allocated = [], 0
+    for n, (pid, q) in enumerate(quantities.items()):
+        if n == len(quantities) - 1:
+            revenue = (total_price or 0) - allocated # 端数は最後の商品に寄せて、合計を注文の金額に合わせる
+        else:
+            revenue = (total_price or 0) * weights[pid] // total_weight if total_weight else 0
+        allocated += revenue
+        lines.append((pid, q, revenue))
+    return lines
+
+async def add_bean_order_sales(db: AsyncSession, orders, sign: int):
+    '''
+    既存の焙煎豆注文 [(注文ID, 注文日, 合計金額), ...] の売上を集計に足す (sign=-1 なら差し引く)。
+    ステータスの変更 (キャンセル・キャンセルの取り消し) と同じトランザクションで呼ぶ
+    '''
+    orders = {order_id: (order_date, total_price) for order_id, order_date, total_price in orders}
+    quantities = {}
+    result = await db.execute(
+        select(BeanOrderItemModel.bean_order_id, BeanOrderItemModel.product_id, BeanOrderItemModel.quantity)
+        .filter(BeanOrderItemModel.bean_order_id.in_(orders))
+    )
+    for order_id, product_id, quantity in result:
+        per_order = quantities.setdefault(order_id, {})
+        per_order[product_id] = per_order.get(product_id, 0) + quantity
+    if not quantities:
+        return
+    product_ids = {pid for per_order in quantities.values() for pid in per_order}
+    result = await db.execute(select(ProductModel.id, ProductModel.price).filter(ProductModel.id.in_(product_ids)))
+    prices = dict(result.all())
+
+    rows = []
+    for order_id, per_order in quantities.items():
+        order_date, total_price = orders[order_id]
+        rows += product_sales_rows(order_date, split_order_revenue(total_price, per_order, prices), sign)
+    await db.execute(_add_product_sales_stmt, rows)
+
+async def reserve_bean_inventory(db: AsyncSession, bean_name: str, quantity: int = 1) -> bool:
+    '''デリバリー用の豆在庫を quantity だけ減らす。在庫不足なら何もせず False'''
+    if bean_stock is not None:
+        return await bean_stock.reserve(bean_name, quantity)
+    result = await db.execute(
+        update(BeanInventoryModel.__table__)
+        .where(BeanInventoryModel.name == bean_name, BeanInventoryModel.stock >= quantity)
+        .values(stock=BeanInventoryModel.stock - quantity)
+    )
+    return result.rowcount == 1
+
+def release_bean_inventory(bean_name: str, quantity: int = 1):
+    '''write-behind のときだけ、引き当てた在庫をカウンターに戻す (DBで引き当てた場合はロールバックで戻る)'''
+    if bean_stock is not None:
+        bean_stock.release(bean_name, quantity)
+
+async def reserve_product_stock(db: AsyncSession, quantities: dict) -> bool:
+    '''
+    カート全体 ({商品ID: 数量}) の在庫を1回のexecutemanyでまとめて減らす。
+    1つでも在庫不足 (または存在しない商品) があれば False (呼び出し側でロールバックすること)。
+    quantities は空でないこと (空の executemany はエラーになる)
+    '''
+    if not quantities:
+        raise ValueError("quantities must not be empty")
+    result = await db.execute(
+        _reserve_product_stmt,
+        [{"_product_id": product_id, "_quantity": quantity} for product_id, quantity in quantities.items()],
+    )
+    return result.rowcount == len(quantities)
+
+async def add_delivery_order(db: AsyncSession, user_id: int, order: OrderCreate, new_id: int, order_date: str) -> dict:
+    '''
+    時間枠と在庫を1つずつ引き当て、デリバリー注文と売上の集計を db のトランザクションに追加する。
+    枠が満席・在庫不足なら HTTPException を投げる (そのときトランザクションには何も残らない)。
+    コミットは呼び出し側で行い、コミットできなかったら release_bean_inventory() で在庫を戻すこと
+    '''
+    if bean_stock is not None:
+        # write-behind のときは、在庫の引当て (ジャーナルの fsync を待つ) を時間枠の予約より先に行う。
+        # 予約でDBの書き込みロックを取ってから待つと、その間ほかの注文が書き込めず、fsync もまとめられない
+        if not await reserve_bean_inventory(db, order.beans):
+            raise HTTPException(status_code=400, detail=f'{order.beans}の在庫がありません。')
+        try:
+            await book_delivery_slot(db, order_date, order.time)
+        except Exception:
+            release_bean_inventory(order.beans)
+            raise
+    else:
+        # 時間枠を1つ予約する (満席なら主キーの1行を見るだけで断る)
+        await book_delivery_slot(db, order_date, order.time)
+
+        # 1〜3. 在庫があれば1つ減らす (条件付きUPDATEで確認と減算を同時に行う)
+        if not await reserve_bean_inventory(db, order.beans):
+            # グループコミットではほかの注文と一緒にコミットされるので、予約した枠はここで戻す
+            await release_delivery_slot(db, order_date, order.time)
             raise HTTPException(status_code=400, detail=f'{order.beans}の在庫がありません。')
-            
-        # 3. 在庫を1つ減らす
-        bean_stock.stock -= 1
-        
-        # 4. 注文IDを生成 (DBの総件数から次のIDを決定)
-        order_count = db.query(OrderModel).count()
-        new_id = (order_count + 1001) # 1001からスタート
-        
-        today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
 
+    try:
         # 5. OrderModelオブジェクトを作成
         new_order = OrderModel(
             id=new_id,
-            user_id=current_user.id,
-            date=today,
+            user_id=user_id,
+            date=order_date,
             time=order.time,
             size=order.size,
             beans=order.beans,
@@ -528,23 +1238,154 @@ async def create_order(
             notes=order.notes
         )
         db.add(new_order)
-        
-        # 6. 変更（在庫減算 + 注文追加）をコミット
-        db.commit()
-        
-        # 7. フロントエンドに返す（Pydanticモデルではなく辞書として返す）
-        new_order_data = {
-            "id": new_order.id, "user_id": new_order.user_id, "date": new_order.date,
-            "time": new_order.time, "size": new_order.size, "beans": new_order.beans,
-            "status": new_order.status, "notes": new_order.notes
-        }
-        
+        # 売上の日次集計にも同じトランザクションで1杯足す
+        await db.execute(_add_bean_sales_stmt, [{"date": order_date, "bean": order.beans, "quantity": 1}])
+    except Exception:
+        release_bean_inventory(order.beans)
+        raise
+
+    # フロントエンドに返す（Pydanticモデルではなく辞書として返す）
+    return {
+        "id": new_order.id, "user_id": new_order.user_id, "date": new_order.date,
+        "time": new_order.time, "size": new_order.size, "beans": new_order.beans,
+        "status": new_order.status, "notes": new_order.notes
+    }
+
+# --- ★ デリバリー注文のグループコミット (group_commit.py) ---
+async def write_delivery_orders(items):
+    '''
+    グループコミットの書き込み関数。[(ユーザーID, OrderCreate), ...] を1トランザクションで作成し、
+    注文ごとの結果 (注文の辞書、または在庫不足の HTTPException) を同じ順番で返す。
+    在庫不足以外のエラーでコミットできなかったときは、原因の注文だけが失敗するように1件ずつやり直す
+    '''
+    # 採番は書き込みを始める前に行う (id_allocator.py の注意を参照)
+    ids = [await order_id_allocator.next_id() for _ in items]
+    try:
+        return await _write_delivery_orders(items, ids)
+    except Exception:
+        if len(items) == 1:
+            raise
+    results = []
+    for item, new_id in zip(items, ids):
+        try:
+            results += await _write_delivery_orders([item], [new_id])
+        except Exception as e:
+            results.append(e)
+    return results
+
+async def _write_delivery_orders(items, ids):
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    results, reserved_beans = [], []
+    async with AsyncSessionLocal() as db:
+        try:
+            for (user_id, order), new_id in zip(items, ids):
+                try:
+                    results.append(await add_delivery_order(db, user_id, order, new_id, today))
+                    reserved_beans.append(order.beans)
+                except HTTPException as e:
+                    results.append(e)
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            for bean_name in reserved_beans:
+                release_bean_inventory(bean_name)
+            raise
+    if reserved_beans:
+        catalog_cache.bump() # 在庫が変わったので /settings のキャッシュを捨てる
+    return results
+
+# ORDER_GROUP_COMMIT=1 のときだけ有効 (None なら注文ごとにコミットする)
+order_queue = create_queue_from_env(write_delivery_orders)
+if order_queue is not None:
+    metrics.add_gauge_source("order_queue", order_queue.stats)
+
+@app.on_event("startup")
+async def start_order_queue():
+    if order_queue is not None:
+        order_queue.start()
+
+@app.on_event("shutdown")
+async def stop_order_queue():
+    if order_queue is not None:
+        await order_queue.stop()
+
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+async def run_idempotent(db: AsyncSession, endpoint: str, user_id: int, key: str, payload: BaseModel, create):
+    '''
+    Idempotency-Key 付きの注文リクエストを処理する。create() は注文を作成してレスポンスの辞書を返すコルーチン関数。
+    同じキーの再送には、create() を呼ばずに最初のレスポンスをそのまま返す (Idempotent-Replayed: true ヘッダー付き)。
+    同じキーのリクエストが処理中なら、終わるまで待ってから同じレスポンスを返す
+    '''
+    if not key or len(key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Idempotency-Key must be 1-{IDEMPOTENCY_KEY_MAX_LENGTH} characters")
+    fingerprint = hashlib.sha256(dump_json(payload.model_dump())).hexdigest()
+
+    async def handler():
+        return status.HTTP_201_CREATED, dump_json(await create())
+
+    try:
+        status_code, body, replayed = await idempotency_store.run(db, (endpoint, user_id, key), fingerprint, handler)
+    except IdempotencyKeyReused:
+        raise HTTPException(status_code=422, detail="Idempotency-Key has already been used for a different request")
+    except IdempotencyKeyInProgress:
+        raise HTTPException(
+            status_code=409, detail="A request with this Idempotency-Key is still in progress", headers={"Retry-After": "1"},
+        )
+    headers = {"Idempotent-Replayed": "true"} if replayed else None
+    return Response(content=body, status_code=status_code, media_type="application/json", headers=headers)
+
+@app.post("/orders", status_code=201)
+async def create_order(
+    order: OrderCreate,
+    idempotency_key: Optional[str] = Header(None),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    '''デリバリー注文を作成する。Idempotency-Key ヘッダーがあれば、同じキーの再送では注文を作り直さない'''
+    if idempotency_key is None:
+        return await place_delivery_order(order, current_user, db)
+    return await run_idempotent(
+        db, "POST /orders", current_user.id, idempotency_key, order,
+        lambda: place_delivery_order(order, current_user, db),
+    )
+
+async def place_delivery_order(order: OrderCreate, current_user: User, db: AsyncSession):
+    '''デリバリー注文を作成する（SQLAlchemy + トランザクション版）'''
+    reserved = False
+    use_queue = order_queue is not None and order_queue.running
+    if order_queue is not None and not use_queue:
+        order_queue.bypass()
+    try:
+        if use_queue:
+            # ほかの注文とまとめて書き込みタスクがコミットする (在庫不足なら HTTPException が返ってくる)。
+            # 待っている間はこのリクエストの接続 (ユーザーの確認で使ったもの) を返しておかないと、
+            # 注文が集中したときに書き込みタスクが接続を借りられなくなる
+            await db.close()
+            new_order_data = await order_queue.submit((current_user.id, order))
+        else:
+            # 注文IDを採番 (在庫の引当てで書き込みを始める前に行う)
+            new_id = await order_id_allocator.next_id(db)
+            today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+            new_order_data = await add_delivery_order(db, current_user.id, order, new_id, today)
+            reserved = True
+
+            # 6. 変更（在庫減算 + 注文追加 + 集計）をコミット
+            await db.commit()
+            catalog_cache.bump() # 在庫が変わったので /settings のキャッシュを捨てる
+
+        # 管理画面に新しい注文を知らせる (/admin/all_orders の1行と同じ形)
+        order_events.publish("order_created", {
+            "order_type": "delivery", "order": {**new_order_data, "customer_name": current_user.name},
+        })
         return {"message": "注文を受け付けました！", "order": new_order_data}
 
     except Exception as e:
         # 8. エラーが起きたらロールバック
         print(f"😱 デリバリー注文処理中にエラーが発生: {e}")
-        db.rollback()
+        await db.rollback()
+        if reserved:
+            release_bean_inventory(order.beans)
         
         if isinstance(e, HTTPException):
             raise e
@@ -552,43 +1393,81 @@ async def create_order(
             raise HTTPException(status_code=500, detail=f"サーバー内部でエラーが発生しました。")
 
 @app.get("/products", response_model=List[Product])
-def get_products(db: Session = Depends(get_db)): # ★ DBセッションを追加
+@query_budget(1)
+def get_products(
+    db: Session = Depends(get_db), # ★ DBセッションを追加
+    if_none_match: Optional[str] = Header(None),
+):
     # return load_data().get("products", []) <- 古いコードを削除
-    return db.query(ProductModel).all()
+    def build():
+        rows = db.execute(select(
+            ProductModel.id, ProductModel.name, ProductModel.description,
+            ProductModel.price, ProductModel.stock, ProductModel.image_url,
+        )).mappings().all()
+        return dump_json([dict(row) for row in rows])
+
+    # キャッシュが有効ならDBには触らない
+    return catalog_response(catalog_cache.get_or_build("products", build), if_none_match)
 
 @app.post("/bean_orders", status_code=201)
 async def create_bean_order(
-    order_data: BeanOrderCreate, 
+    order_data: BeanOrderCreate,
+    idempotency_key: Optional[str] = Header(None),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db) # ★ DBセッションを追加
+    db: AsyncSession = Depends(get_async_db)
 ):
+    '''焙煎豆の注文を作成する。Idempotency-Key ヘッダーがあれば、同じキーの再送では在庫の引当てからやり直さない'''
+    if idempotency_key is None:
+        return await place_bean_order(order_data, current_user, db)
+    return await run_idempotent(
+        db, "POST /bean_orders", current_user.id, idempotency_key, order_data,
+        lambda: place_bean_order(order_data, current_user, db),
+    )
+
+async def place_bean_order(order_data: BeanOrderCreate, current_user: User, db: AsyncSession):
     '''焙煎豆の注文を作成する (SQLAlchemy + トランザクション版) '''
-    
+
+    # 入力の確認は、注文IDの採番やDBへの書き込みより前に行う
+    if not order_data.items:
+        raise HTTPException(status_code=400, detail="カートが空です。")
+    # 同じ商品が複数行あっても1回の引当てになるように、商品IDごとに数量をまとめる
+    quantities = {}
+    for item in order_data.items:
+        if item.quantity <= 0:
+            raise HTTPException(status_code=400, detail="数量は1以上を指定してください。")
+        quantities[item.id] = quantities.get(item.id, 0) + item.quantity
+
     # 1. トランザクション内で在庫の確認と価格の計算
     try:
-        total_price = 0
-        
-        # 注文IDを先に生成 (YAMLのロジックを踏襲)
-        order_count = db.query(BeanOrderModel).count()
-        order_id = f"bo-{order_count + 1:03d}"
-
-        # 2. 注文する商品の在庫を確認し、価格を計算
-        for item in order_data.items:
-            # データベースから商品を取得し、ロックをかける（在庫の同時更新を防ぐ）
-            # .with_for_update()は、複数の人が同時に在庫を引くのを防ぐ高度なテクニックです
-            product = db.query(ProductModel).filter(ProductModel.id == item.id).with_for_update().first()
-            
-            if not product or product.stock < item.quantity:
-                raise HTTPException(status_code=400, detail=f"商品「{product.name if product else ''}」の在庫が不足しています。")
-            
-            total_price += product.price * item.quantity
-            product.stock -= item.quantity # 在庫をメモリ上で減らす
+        # 注文IDを採番 (在庫の引当てで書き込みを始める前に行う)
+        order_id = format_bean_order_id(await bean_order_id_allocator.next_id(db))
+
+        # 2. カート全体の在庫を条件付きUPDATEでまとめて引き当てる
+        if not await reserve_product_stock(db, quantities):
+            await db.rollback()
+            # どの商品が足りなかったかを調べてエラーメッセージに使う
+            result = await db.execute(select(ProductModel).filter(ProductModel.id.in_(quantities)))
+            products = {p.id: p for p in result.scalars()}
+            missing = next((pid for pid in quantities if pid not in products), None)
+            if missing is not None:
+                raise HTTPException(status_code=404, detail=f"商品ID「{missing}」は存在しません。")
+            # (調べる間にほかの注文のキャンセルで在庫が戻っていたら、商品名なしで返す)
+            short = next((products[pid] for pid, q in quantities.items() if products[pid].stock < q), None)
+            raise HTTPException(status_code=400, detail=f"商品「{short.name if short else ''}」の在庫が不足しています。")
+
+        # 価格はまとめて1回のSELECTで取得する
+        result = await db.execute(
+            select(ProductModel.id, ProductModel.price).filter(ProductModel.id.in_(quantities))
+        )
+        prices = dict(result.all())
+        total_price = sum(prices[pid] * q for pid, q in quantities.items())
         
         # 3. BeanOrderModel (注文台帳) を作成
+        order_date = datetime.now(timezone.utc).strftime("%Y-%m-%d")
         new_order = BeanOrderModel(
             order_id=order_id,
             user_id=current_user.id,
-            date=datetime.now(timezone.utc).strftime("%Y-%m-%d"),
+            date=order_date,
             total_price=total_price,
             shipping_address=order_data.shipping_address,
             status="paid"
@@ -604,9 +1483,15 @@ async def create_bean_order(
             )
             db.add(new_item)
 
+        # 売上の日次集計にも同じトランザクションで足す
+        await db.execute(_add_product_sales_stmt, product_sales_rows(
+            order_date, [(pid, q, prices[pid] * q) for pid, q in quantities.items()]
+        ))
+
         # 5. すべての変更をコミット（保存）
         # (注文、注文アイテム、商品在庫の変更が「すべて同時に」保存されます)
-        db.commit()
+        await db.commit()
+        catalog_cache.bump() # 在庫が変わったので /products のキャッシュを捨てる
         
         # 6. 新しく作成された注文情報をフロントエンドに返す
         created_order_dict = {
@@ -618,14 +1503,22 @@ async def create_bean_order(
             "shipping_address": new_order.shipping_address,
             "status": new_order.status
         }
+        order_events.publish("order_created", {
+            "order_type": "bean",
+            "order": {
+                "order_id": new_order.order_id, "user_id": new_order.user_id, "date": new_order.date,
+                "total_price": new_order.total_price, "shipping_address": new_order.shipping_address,
+                "status": new_order.status, "customer_name": current_user.name,
+            },
+        })
         
         return {"message": "豆の注文を受け付けました！", "order": created_order_dict}
 
     except Exception as e:
         # 7. エラーが発生したら、すべての変更を元に戻す（ロールバック）
         print(f"😱 注文処理中にエラーが発生: {e}")
-        db.rollback() 
-        # 在庫の変更 (product.stock -= ...) もすべて元に戻ります
+        await db.rollback() 
+        # 在庫の引当て (条件付きUPDATE) もすべて元に戻ります
         
         # HTTPExceptionの場合は、それをそのままフロントに返す
         if isinstance(e, HTTPException):
@@ -676,11 +1569,11 @@ class SubscriptionCreate(BaseModel):
 async def create_subscription(
     contract_data: SubscriptionCreate,
     admin_user: User = Depends(get_current_admin_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     '''新規サブスクリプション契約を作成する'''
     # ユーザーの存在確認
-    user = db.query(UserModel).filter(UserModel.id == contract_data.user_id).first()
+    user = await db.get(UserModel, contract_data.user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
@@ -694,8 +1587,8 @@ async def create_subscription(
         renewal_count=0 # 新規なので0
     )
     db.add(new_contract)
-    db.commit()
-    db.refresh(new_contract)
+    await db.commit()
+    await db.refresh(new_contract)
 
     # 契約に商品を紐付ける
     for item in contract_data.items:
@@ -706,18 +1599,19 @@ async def create_subscription(
         )
         db.add(new_item)
     
-    db.commit()
+    await db.commit()
 
     # フロントエンドに返すために、作成したデータを再度読み込む
-    created_contract = (
-        db.query(SubscriptionContractModel)
+    result = await db.execute(
+        select(SubscriptionContractModel)
         .options(
             joinedload(SubscriptionContractModel.customer),
             joinedload(SubscriptionContractModel.items).joinedload(SubscriptionContractItemModel.product)
         )
         .filter(SubscriptionContractModel.id == new_contract.id)
-        .first()
+        .execution_options(populate_existing=True)
     )
+    created_contract = result.unique().scalars().first()
     
     items_response = [
         SubscriptionContractItemResponse(
@@ -741,106 +1635,457 @@ async def create_subscription(
     )
 
 
-@app.get("/admin/subscriptions", response_model=List[SubscriptionContractResponse])
+@app.get("/admin/subscriptions", response_model=List[SubscriptionContractResponse], response_class=FastJSONResponse)
+@query_budget(2)
 async def get_all_subscriptions(
     admin_user: User = Depends(get_current_admin_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    '''すべてのサブスクリプション契約を取得する'''
-    contracts = (
-        db.query(SubscriptionContractModel)
-        .options(
-            joinedload(SubscriptionContractModel.customer),
-            joinedload(SubscriptionContractModel.items).joinedload(SubscriptionContractItemModel.product)
+    '''
+    すべてのサブスクリプション契約を取得する。
+    契約・顧客名・明細・商品名を必要な列だけ1回のJOINで読み、契約ごとにまとめる
+    '''
+    C, I = SubscriptionContractModel, SubscriptionContractItemModel
+    result = await db.execute(
+        select(
+            C.id, C.user_id, C.plan_name, C.interval, C.next_delivery_date, C.status, C.renewal_count,
+            func.coalesce(UserModel.name, "不明なユーザー"),
+            I.product_id, I.quantity, func.coalesce(ProductModel.name, ""),
         )
-        .all()
+        .outerjoin(UserModel, UserModel.id == C.user_id)
+        .outerjoin(I, I.contract_id == C.id)
+        .outerjoin(ProductModel, ProductModel.id == I.product_id)
+        .order_by(C.id, I.id)
     )
-    
+
     response = []
-    for contract in contracts:
-        items_response = [
-            SubscriptionContractItemResponse(
-                product_id=item.product.id,
-                quantity=item.quantity,
-                product_name=item.product.name
-            )
-            for item in contract.items
-        ]
-        response.append(
-            SubscriptionContractResponse(
-                id=contract.id,
-                user_id=contract.user_id,
-                plan_name=contract.plan_name,
-                interval=contract.interval,
-                next_delivery_date=contract.next_delivery_date,
-                status=contract.status,
-                renewal_count=contract.renewal_count,
-                customer_name=contract.customer.name,
-                items=items_response
-            )
-        )
-    return response
+    contract = None
+    for (contract_id, user_id, plan_name, interval, next_delivery_date, contract_status, renewal_count,
+         customer_name, product_id, quantity, product_name) in result:
+        if contract is None or contract["id"] != contract_id:
+            contract = {
+                "id": contract_id, "user_id": user_id, "plan_name": plan_name, "interval": interval,
+                "next_delivery_date": next_delivery_date, "status": contract_status,
+                "renewal_count": renewal_count, "customer_name": customer_name, "items": [],
+            }
+            response.append(contract)
+        if product_id is not None:
+            contract["items"].append({"product_id": product_id, "quantity": quantity, "product_name": product_name})
+    return FastJSONResponse(response)
 
 
 @app.get("/admin/users", response_model=List[User])
+@query_budget(2)
 async def get_all_users(
     admin_user: User = Depends(get_current_admin_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     '''すべてのユーザーを取得する (管理者用) '''
-    users = db.query(UserModel).all()
+    result = await db.execute(select(UserModel))
+    users = result.scalars().all()
     return users
 
 
-@app.get("/admin/all_inventory")
+@app.get("/admin/all_inventory", response_class=FastJSONResponse)
+@query_budget(3)
 async def get_all_inventory(
     admin_user: User = Depends(get_current_admin_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     '''焙煎豆とデリバリー豆のすべての在庫を返す'''
 
-    # 焙煎豆ストアの商品在庫
-    roasted_beans = db.query(ProductModel).all()
+    # 焙煎豆ストアの商品在庫 (ORMのオブジェクトを作らずに、列の値を辞書にする)
+    roasted_beans = [dict(row) for row in (await db.execute(select(ProductModel.__table__))).mappings()]
 
     # デリバリー用の豆在庫
-    delivery_beans = db.query(BeanInventoryModel).all()
+    delivery_beans = [dict(row) for row in (await db.execute(select(BeanInventoryModel.__table__))).mappings()]
+    if bean_stock is not None:
+        # write-behind のときはDBに未反映の増減を含むカウンターの値を返す
+        stock = bean_stock.snapshot()
+        for bean in delivery_beans:
+            bean["stock"] = stock.get(bean["name"], bean["stock"])
+
+    return FastJSONResponse({"roasted_beans": roasted_beans, "delivery_beans": delivery_beans})
+
+@app.get("/admin/principal_cache")
+async def get_principal_cache_stats(admin_user: User = Depends(get_current_admin_user)):
+    '''認証済みユーザーキャッシュのヒット率などを返す (管理者用)'''
+    return principal_cache.stats()
+
+@app.get("/admin/password_pool")
+async def get_password_pool_metrics(admin_user: User = Depends(get_current_admin_user)):
+    '''パスワード用スレッドプールの状態を返す (管理者用)'''
+    return password_pool.metrics()
+
+# Prometheus のスクレイプ用のトークン (scrape_config の authorization に Bearer で設定する)。
+# 未設定なら /metrics は管理者のログインが必要
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+async def require_metrics_access(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)):
+    '''/metrics の認証: METRICS_TOKEN と一致するトークン、または管理者のアクセストークン'''
+    if METRICS_TOKEN and hmac.compare_digest(token.encode(), METRICS_TOKEN.encode()):
+        return
+    await get_current_admin_user(await get_current_user(token, db))
+
+@app.get("/metrics", response_class=PlainTextResponse, dependencies=[Depends(require_metrics_access)])
+def get_metrics():
+    '''
+    Prometheus 形式の計測値 (ルートごとのリクエスト数・レイテンシ・DB時間、プールの待ち時間など)。
+    Authorization: Bearer <METRICS_TOKEN> (または管理者のアクセストークン) が必要
+    '''
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
-    return {"roasted_beans": roasted_beans, "delivery_beans": delivery_beans}
+# --- ★ 売上のKPI (日次集計テーブルから計算する) ---
+ADMIN_STATS_DEFAULT_DAYS = 30
+ADMIN_STATS_MAX_DAYS = 731
+
+@app.get("/admin/stats")
+@query_budget(3)
+async def get_sales_stats(
+    date_from: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}-\d{2}$"), # この日を含む (省略時は date_to の29日前)
+    date_to: Optional[str] = Query(None, pattern=r"^\d{4}-\d{2}-\d{2}$"),   # この日を含む (省略時は今日)
+    admin_user: User = Depends(get_current_admin_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    '''
+    期間内の売上・販売数を日別・商品別・豆別に返す (管理者用)
+    読むのは日次集計テーブルの「日数 × 商品数」の行だけなので、注文が何件あっても速い
+    '''
+    try:
+        end = dt.date.fromisoformat(date_to) if date_to else datetime.now(timezone.utc).date()
+        start = dt.date.fromisoformat(date_from) if date_from else end - timedelta(days=ADMIN_STATS_DEFAULT_DAYS - 1)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date")
+    if start > end:
+        raise HTTPException(status_code=400, detail="date_from must be on or before date_to")
+    if (end - start).days + 1 > ADMIN_STATS_MAX_DAYS:
+        raise HTTPException(status_code=400, detail=f"The date range must be at most {ADMIN_STATS_MAX_DAYS} days")
+
+    # 期間内の日付をすべて並べる (売上のない日も0としてグラフに出せるように)
+    daily = {}
+    day = start
+    while day <= end:
+        daily[day.isoformat()] = {"date": day.isoformat(), "revenue": 0, "bean_quantity": 0, "delivery_cups": 0}
+        day += timedelta(days=1)
+
+    S = DailyProductSalesModel
+    result = await db.execute(
+        select(S.date, S.product_id, ProductModel.name, S.quantity, S.revenue, S.order_count)
+        .outerjoin(ProductModel, ProductModel.id == S.product_id)
+        .filter(S.date.between(start.isoformat(), end.isoformat()))
+    )
+    products = {}
+    for order_date, product_id, name, quantity, revenue, order_count in result:
+        daily[order_date]["revenue"] += revenue
+        daily[order_date]["bean_quantity"] += quantity
+        product = products.setdefault(product_id, {
+            "product_id": product_id, "name": name, "quantity": 0, "revenue": 0, "order_count": 0,
+        })
+        product["quantity"] += quantity
+        product["revenue"] += revenue
+        product["order_count"] += order_count
+
+    result = await db.execute(
+        select(DailyBeanSalesModel.date, DailyBeanSalesModel.bean, DailyBeanSalesModel.quantity)
+        .filter(DailyBeanSalesModel.date.between(start.isoformat(), end.isoformat()))
+    )
+    beans = {}
+    for order_date, bean, quantity in result:
+        daily[order_date]["delivery_cups"] += quantity
+        beans[bean] = beans.get(bean, 0) + quantity
+
+    days = list(daily.values())
+    return {
+        "date_from": start.isoformat(),
+        "date_to": end.isoformat(),
+        "totals": {
+            "revenue": sum(d["revenue"] for d in days),
+            "bean_quantity": sum(d["bean_quantity"] for d in days),
+            "delivery_cups": sum(d["delivery_cups"] for d in days),
+        },
+        "daily": days,
+        "products": sorted(products.values(), key=lambda p: p["revenue"], reverse=True),
+        "beans": [
+            {"bean": bean, "quantity": quantity}
+            for bean, quantity in sorted(beans.items(), key=lambda b: b[1], reverse=True)
+        ],
+    }
+
+# --- ★ キーセット・ページネーション用のカーソル ---
+# カーソルは「前のページの最後の行の (日付, ID)」をbase64にしたもの。
+# OFFSET と違って何ページ目でも同じ速さで取得できる。
+ADMIN_ORDERS_DEFAULT_LIMIT = 100
+ADMIN_ORDERS_MAX_LIMIT = 500
+
+def encode_cursor(*values) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values, ensure_ascii=False).encode()).decode()
+
+def decode_cursor(cursor: str, types: tuple) -> list:
+    '''
+    encode_cursor() で作ったカーソルを値のリストに戻す。
+    値の数と型 (types の順) が合わない、壊れた・改ざんされたカーソルは HTTPException(400)
+    '''
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        values = None
+    if (
+        not isinstance(values, list) or len(values) != len(types)
+        # bool は int のサブクラスなので isinstance ではなく型そのもので比べる
+        or any(type(value) is not value_type for value, value_type in zip(values, types))
+    ):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+def keyset_page_stmt(stmt, date_col, key_col, cursor: Optional[str], limit: int):
+    '''
+    stmt に、cursor より後 ((date_col, key_col) の降順) の limit + 1 件を取る条件と並べ替えを付ける
+    (1件多く取って次のページがあるかを判定する)。benchmarks/query_plans.py もこの文のプランを確認する
+    '''
+    if cursor:
+        last_date, last_key = decode_cursor(cursor, (date_col.type.python_type, key_col.type.python_type))
+        stmt = stmt.filter(tuple_(date_col, key_col) < tuple_(last_date, last_key))
+    return stmt.order_by(date_col.desc(), key_col.desc()).limit(limit + 1)
+
+async def fetch_keyset_page(db: AsyncSession, stmt, date_col, key_col, cursor: Optional[str], limit: int,
+                            scalars: bool = True):
+    '''
+    (date_col, key_col) の降順で limit 件を取得し、(行のリスト, 次のカーソル) を返す。
+    次のページがない場合、次のカーソルは None。
+    列を選んだ SELECT のときは scalars=False にすると Row のリストを返す (date_col, key_col の列を含めること)
+    '''
+    stmt = keyset_page_stmt(stmt, date_col, key_col, cursor, limit)
+    result = await db.execute(stmt)
+    rows = result.scalars().all() if scalars else result.all()
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(getattr(last, date_col.key), getattr(last, key_col.key))
+
+def _admin_order_filters(stmt, model, status: Optional[str], date_from: Optional[str],
+                         date_to: Optional[str], user_id: Optional[int]):
+    if status:
+        stmt = stmt.filter(model.status == status)
+    if date_from:
+        stmt = stmt.filter(model.date >= date_from)
+    if date_to:
+        stmt = stmt.filter(model.date <= date_to)
+    if user_id is not None:
+        stmt = stmt.filter(model.user_id == user_id)
+    return stmt
+
+def _admin_customer_name():
+    # 顧客名はJOINで1列として取る (ORMのオブジェクトを作らないので、顧客の hashed_password などは読まない)
+    return func.coalesce(UserModel.name, "不明なユーザー").label("customer_name")
+
+def admin_delivery_orders_stmt(status: Optional[str] = None, date_from: Optional[str] = None,
+                               date_to: Optional[str] = None, user_id: Optional[int] = None):
+    '''/admin/orders のデリバリー注文の SELECT (ページングの条件は keyset_page_stmt で付ける)'''
+    O = OrderModel
+    return _admin_order_filters(
+        select(O.id, O.user_id, O.date, O.time, O.size, O.beans, O.status, O.notes, _admin_customer_name())
+        .outerjoin(UserModel, UserModel.id == O.user_id),
+        O, status, date_from, date_to, user_id,
+    )
+
+def admin_bean_orders_stmt(status: Optional[str] = None, date_from: Optional[str] = None,
+                           date_to: Optional[str] = None, user_id: Optional[int] = None):
+    '''/admin/orders の焙煎豆注文の SELECT (ページングの条件は keyset_page_stmt で付ける)'''
+    B = BeanOrderModel
+    return _admin_order_filters(
+        select(B.order_id, B.user_id, B.date, B.total_price, B.shipping_address, B.status, _admin_customer_name())
+        .outerjoin(UserModel, UserModel.id == B.user_id),
+        B, status, date_from, date_to, user_id,
+    )
 
 # --- ★★★ 管理者専用の新しいAPI ★★★ ---
-@app.get("/admin/all_orders")
+@app.get("/admin/all_orders", response_class=FastJSONResponse)
+@query_budget(3)
 async def get_all_orders_for_admin(
+    order_type: Optional[str] = Query(None, pattern="^(delivery|bean)$"), # 片方だけ取得したいとき
+    status_filter: Optional[str] = Query(None, alias="status"),
+    date_from: Optional[str] = None, # "YYYY-MM-DD" (この日を含む)
+    date_to: Optional[str] = None,   # "YYYY-MM-DD" (この日を含む)
+    user_id: Optional[int] = None,
+    limit: int = Query(ADMIN_ORDERS_DEFAULT_LIMIT, ge=1, le=ADMIN_ORDERS_MAX_LIMIT),
+    delivery_cursor: Optional[str] = None,
+    bean_cursor: Optional[str] = None,
     admin_user: User = Depends(get_current_admin_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    '''すべての注文を返す（完全DB版）'''
-    
-    # --- デリバリー注文をDBから取得（顧客名もJOIN） ---
+    '''
+    注文を新しい順に1ページ分返す（キーセット・ページネーション版）
+    続きは next_delivery_cursor / next_bean_cursor を次のリクエストに渡して取得する
+    '''
+    # 一覧に出す列だけを選ぶ (SELECT は benchmarks/query_plans.py もプランを確認する)
+    # --- デリバリー注文をDBから取得 ---
     delivery_orders_response = []
-    delivery_orders_db = db.query(OrderModel).options(joinedload(OrderModel.customer)).all()
-    for order in delivery_orders_db:
-        order_dict = {
-            "id": order.id, "user_id": order.user_id, "date": order.date,
-            "time": order.time, "size": order.size, "beans": order.beans,
-            "status": order.status, "notes": order.notes,
-            "customer_name": order.customer.name if order.customer else "不明なユーザー"
-        }
-        delivery_orders_response.append(order_dict)
+    next_delivery_cursor = None
+    if order_type in (None, "delivery"):
+        stmt = admin_delivery_orders_stmt(status_filter, date_from, date_to, user_id)
+        rows, next_delivery_cursor = await fetch_keyset_page(
+            db, stmt, OrderModel.date, OrderModel.id, delivery_cursor, limit, scalars=False
+        )
+        keys = stmt.selected_columns.keys()
+        delivery_orders_response = [dict(zip(keys, row)) for row in rows]
 
-    # --- 焙煎豆注文をDBから取得（顧客名もJOIN） ---
+    # --- 焙煎豆注文をDBから取得 ---
     bean_orders_response = []
-    bean_orders_db = db.query(BeanOrderModel).options(joinedload(BeanOrderModel.customer)).all()
-    for order in bean_orders_db:
-        order_dict = {
-            "order_id": order.order_id, "user_id": order.user_id, "date": order.date,
-            "total_price": order.total_price, "shipping_address": order.shipping_address,
-            "status": order.status,
-            "customer_name": order.customer.name if order.customer else "不明なユーザー"
-        }
-        bean_orders_response.append(order_dict)
+    next_bean_cursor = None
+    if order_type in (None, "bean"):
+        stmt = admin_bean_orders_stmt(status_filter, date_from, date_to, user_id)
+        rows, next_bean_cursor = await fetch_keyset_page(
+            db, stmt, BeanOrderModel.date, BeanOrderModel.order_id, bean_cursor, limit, scalars=False
+        )
+        keys = stmt.selected_columns.keys()
+        bean_orders_response = [dict(zip(keys, row)) for row in rows]
+
+    return FastJSONResponse({
+        "delivery_orders": delivery_orders_response,
+        "bean_orders": bean_orders_response,
+        "next_delivery_cursor": next_delivery_cursor,
+        "next_bean_cursor": next_bean_cursor,
+    })
 
-    return {"delivery_orders": delivery_orders_response, "bean_orders": bean_orders_response}
 
+# --- ★ 全注文のエクスポート (経理向け、ストリーミング) ---
+EXPORT_CSV_COLUMNS = [
+    "order_type", "order_id", "user_id", "customer_name", "date", "time", "status",
+    "total_price", "shipping_address", "size", "beans", "notes", "items",
+]
+
+async def iter_export_records(chunk_size: int):
+    '''
+    デリバリー注文 → 焙煎豆注文の順に、1件ずつ辞書を返す非同期ジェネレーター。
+    サーバー側カーソルから chunk_size 件ずつ読むので、件数が増えてもメモリ使用量は一定。
+    '''
+    # レスポンスの送信中ずっと使うので、依存関係ではなくここでセッションを開く
+    async with AsyncSessionLocal() as db:
+        delivery_stmt = (
+            select(
+                OrderModel.id, OrderModel.user_id, UserModel.name, OrderModel.date, OrderModel.time,
+                OrderModel.status, OrderModel.size, OrderModel.beans, OrderModel.notes,
+            )
+            .outerjoin(UserModel, OrderModel.user_id == UserModel.id)
+            .order_by(OrderModel.id)
+            .execution_options(yield_per=chunk_size)
+        )
+        result = await db.stream(delivery_stmt)
+        async for rows in result.partitions():
+            for r in rows:
+                yield {
+                    "order_type": "delivery", "order_id": r.id, "user_id": r.user_id,
+                    "customer_name": r.name or "不明なユーザー", "date": r.date, "time": r.time,
+                    "status": r.status, "total_price": None, "shipping_address": None,
+                    "size": r.size, "beans": r.beans, "notes": r.notes, "items": [],
+                }
+
+        bean_stmt = (
+            select(
+                BeanOrderModel.order_id, BeanOrderModel.user_id, UserModel.name, BeanOrderModel.date,
+                BeanOrderModel.status, BeanOrderModel.total_price, BeanOrderModel.shipping_address,
+            )
+            .outerjoin(UserModel, BeanOrderModel.user_id == UserModel.id)
+            .order_by(BeanOrderModel.order_id)
+            .execution_options(yield_per=chunk_size)
+        )
+        result = await db.stream(bean_stmt)
+        async for rows in result.partitions():
+            # このチャンクに含まれる注文の明細だけを1回のINクエリで取得する
+            items_by_order = {}
+            item_rows = await db.execute(
+                select(
+                    BeanOrderItemModel.bean_order_id, BeanOrderItemModel.product_id,
+                    ProductModel.name, BeanOrderItemModel.quantity,
+                )
+                .outerjoin(ProductModel, BeanOrderItemModel.product_id == ProductModel.id)
+                .filter(BeanOrderItemModel.bean_order_id.in_([r.order_id for r in rows]))
+            )
+            for item in item_rows:
+                items_by_order.setdefault(item.bean_order_id, []).append(
+                    {"product_id": item.product_id, "product_name": item.name, "quantity": item.quantity}
+                )
+            for r in rows:
+                yield {
+                    "order_type": "bean", "order_id": r.order_id, "user_id": r.user_id,
+                    "customer_name": r.name or "不明なユーザー", "date": r.date, "time": None,
+                    "status": r.status, "total_price": r.total_price,
+                    "shipping_address": r.shipping_address, "size": None, "beans": None,
+                    "notes": None, "items": items_by_order.get(r.order_id, []),
+                }
+
+async def iter_export_ndjson(chunk_size: int):
+    buffer = []
+    async for record in iter_export_records(chunk_size):
+        buffer.append(json.dumps(record, ensure_ascii=False))
+        if len(buffer) >= chunk_size:
+            yield "\n".join(buffer) + "\n"
+            buffer = []
+    if buffer:
+        yield "\n".join(buffer) + "\n"
+
+async def iter_export_csv(chunk_size: int):
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=EXPORT_CSV_COLUMNS)
+    writer.writeheader()
+    # ヘッダーはすぐに送る (最初の1バイトを待たせない)
+    yield out.getvalue()
+    out.seek(0)
+    out.truncate()
+    count = 0
+    async for record in iter_export_records(chunk_size):
+        # CSVでは明細を「商品ID x 数量」を ; で区切った1つの列にまとめる
+        record["items"] = ";".join(f"{i['product_id']}x{i['quantity']}" for i in record["items"])
+        writer.writerow(record)
+        count += 1
+        if count % chunk_size == 0:
+            yield out.getvalue()
+            out.seek(0)
+            out.truncate()
+    if out.tell():
+        yield out.getvalue()
+
+@app.get("/admin/orders/export")
+async def export_all_orders(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    chunk_size: int = Query(1000, ge=1, le=10000),
+    admin_user: User = Depends(get_current_admin_user),
+):
+    '''すべての注文 (顧客名・明細つき) を NDJSON または CSV でストリーミングする (管理者用)'''
+    filename_date = datetime.now(timezone.utc).strftime("%Y%m%d")
+    if format == "csv":
+        body, media_type = iter_export_csv(chunk_size), "text/csv; charset=utf-8"
+    else:
+        body, media_type = iter_export_ndjson(chunk_size), "application/x-ndjson"
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="orders-{filename_date}.{format}"'},
+    )
+
+@app.get("/admin/orders/stream")
+async def stream_order_events(
+    last_event_id: Optional[str] = Header(None),
+    admin_user: User = Depends(get_current_admin_user),
+    db: AsyncSession = Depends(get_async_db),
+):
+    '''
+    新しい注文 (order_created) とステータスの変更 (order_status) を Server-Sent Events で送る (管理者用)。
+    再接続のときは Last-Event-ID ヘッダーを付けると、その後のイベントから受け取れる。
+    reset イベントが届いたら、取りこぼしがあるので /admin/all_orders で一覧を取り直すこと
+    '''
+    try:
+        subscription = order_events.subscribe(last_event_id)
+    except TooManySubscribers:
+        raise HTTPException(status_code=503, detail="Too many order stream connections", headers={"Retry-After": "30"})
+    # 接続している間ずっとプールの接続 (管理者の確認で使ったもの) を借りたままにしない
+    await db.close()
+    return StreamingResponse(
+        subscription.frames(ORDER_EVENTS_HEARTBEAT_SECONDS),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 # --- ★★★ 新しいAPI: 注文詳細取得 ★★★ ---
 
@@ -885,22 +2130,23 @@ class BeanOrderDetailResponse(BaseModel):
         from_attributes = True
 
 @app.get("/admin/bean_orders/{order_id}", response_model=BeanOrderDetailResponse)
+@query_budget(2)
 async def get_bean_order_details(
     order_id: str,
     admin_user: User = Depends(get_current_admin_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """指定された焙煎豆の注文詳細を取得する"""
-    order = (
-        db.query(BeanOrderModel)
+    result = await db.execute(
+        select(BeanOrderModel)
         .options(
             joinedload(BeanOrderModel.customer),
             joinedload(BeanOrderModel.items).joinedload(BeanOrderItemModel.product),
             joinedload(BeanOrderModel.history)
         )
         .filter(BeanOrderModel.order_id == order_id)
-        .first()
     )
+    order = result.unique().scalars().first()
 
     if not order:
         raise HTTPException(status_code=404, detail="Bean order not found")
@@ -950,39 +2196,135 @@ async def update_delivery_order_status(
     order_id: int,
     status_update: StatusUpdate,
     admin_user: User = Depends(get_current_admin_user),
-    db: Session = Depends(get_db) # ★ DBセッションを追加
+    db: AsyncSession = Depends(get_async_db) # ★ DBセッションを追加
 ):
     '''デリバリー注文のステータスを更新する（SQLAlchemy版）'''
-    order = db.query(OrderModel).filter(OrderModel.id == order_id).first()
-            
-    if not order:
-        raise HTTPException(status_code=404, detail="Delivery order not found")
-        
-    order.status = status_update.status
-    db.commit()
+    t = OrderModel.__table__
+    new_status = status_update.status
+    # キャンセル (またはキャンセルの取り消し) なら、売上の日次集計と時間枠の予約数も同じトランザクションで増減させる
+    # (キャンセルの取り消しは管理者の操作なので、枠の定員を超えても戻す)。
+    # 読んでから比べると、同時に2回キャンセルされたときに両方が「売上に含まれていた」と判断して
+    # 集計と枠を二重に戻してしまうので、切り替わるかどうかはUPDATEの条件で判定する
+    # (set_bean_order_status と同じ。条件に一致して行が返ってきたときだけ増減させる)
+    is_sale = new_status not in SALES_EXCLUDED_STATUSES
+    toggles = ~counts_as_sale(t.c.status) if is_sale else counts_as_sale(t.c.status)
+    result = await db.execute(
+        update(t)
+        .where(t.c.id == order_id, toggles)
+        .values(status=new_status)
+        .returning(t.c.date, t.c.beans, t.c.time)
+    )
+    toggled = result.first()
+    if toggled is not None:
+        delta = 1 if is_sale else -1
+        await db.execute(_add_bean_sales_stmt, [{"date": toggled.date, "bean": toggled.beans, "quantity": delta}])
+        if toggled.time is not None and is_sale:
+            await db.execute(_add_slot_count_stmt, [{"date": toggled.date, "time": toggled.time, "booked": 1}])
+        elif toggled.time is not None:
+            await release_delivery_slot(db, toggled.date, toggled.time)
+    else:
+        # 売上に含まれるかどうかは変わらない (または注文がない)
+        result = await db.execute(
+            update(t).where(t.c.id == order_id, ~toggles).values(status=new_status).returning(t.c.id)
+        )
+        if result.first() is None:
+            await db.rollback()
+            raise HTTPException(status_code=404, detail="Delivery order not found")
+    await db.commit()
+    order_events.publish("order_status", {"order_type": "delivery", "ids": [order_id], "status": new_status})
 
     return {"message": "Delivery order status updated successfully"}
 
+class BulkStatusUpdate(BaseModel):
+    order_ids: List[str]
+    status: str
+
+BULK_STATUS_MAX_ORDERS = 1000
+
+async def set_bean_order_status(db: AsyncSession, order_ids: List[str], new_status: str, actor_name: str) -> List[str]:
+    '''
+    焙煎豆注文のステータスをUPDATEでまとめて変更し、変更履歴と売上の日次集計を同じトランザクションで更新する。
+    実際に更新できた注文IDのリストを返す (コミットは呼び出し側で行う)
+    '''
+    t = BeanOrderModel.__table__
+    # 売上に含まれるかどうかが変わる注文 (キャンセル・キャンセルの取り消し) は別のUPDATEにして、
+    # 日次集計を増減させるために注文日と金額も返してもらう (UPDATEの条件で判定するので同時実行でも二重にならない)
+    is_sale = new_status not in SALES_EXCLUDED_STATUSES
+    toggles = ~counts_as_sale(t.c.status) if is_sale else counts_as_sale(t.c.status)
+    # 切り替わらない注文を先に更新する (更新後も ~toggles のままなので、次のUPDATEには一致しない)。
+    # 逆の順番だと、切り替えた注文が2つ目のUPDATEにも一致して、件数と履歴が二重になる
+    result = await db.execute(
+        update(t)
+        .where(t.c.order_id.in_(order_ids), ~toggles)
+        .values(status=new_status)
+        .returning(t.c.order_id)
+    )
+    unchanged_ids = [row[0] for row in result]
+    result = await db.execute(
+        update(t)
+        .where(t.c.order_id.in_(order_ids), toggles)
+        .values(status=new_status)
+        .returning(t.c.order_id, t.c.date, t.c.total_price)
+    )
+    toggled = result.all()
+    updated_ids = [row[0] for row in toggled] + unchanged_ids
+    if len(set(updated_ids)) != len(updated_ids):
+        # 履歴と売上の集計を二重に書かないように、コミット前に止める (呼び出し側でロールバックされる)
+        raise RuntimeError(f"bean order status updated twice: {sorted(updated_ids)}")
+    if toggled:
+        await add_bean_order_sales(db, toggled, 1 if is_sale else -1)
+    if updated_ids:
+        now = dt.datetime.now(timezone.utc)
+        await db.execute(insert(OrderHistoryModel.__table__), [
+            {
+                "order_id": order_id,
+                "timestamp": now,
+                "actor_name": actor_name,
+                "action": f"ステータスを「{new_status}」に変更しました",
+            }
+            for order_id in updated_ids
+        ])
+    return updated_ids
+
+@app.patch("/admin/bean_orders/status")
+async def bulk_update_bean_order_status(
+    bulk_update: BulkStatusUpdate,
+    admin_user: User = Depends(get_current_admin_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    '''複数の焙煎豆注文のステータスをまとめて更新する (発送日の一括処理用)'''
+    order_ids = list(dict.fromkeys(bulk_update.order_ids)) # 重複を除く (順序は保持)
+    if not order_ids:
+        raise HTTPException(status_code=400, detail="order_ids is empty")
+    if len(order_ids) > BULK_STATUS_MAX_ORDERS:
+        raise HTTPException(status_code=400, detail=f"order_ids must be at most {BULK_STATUS_MAX_ORDERS}")
+
+    updated_ids = await set_bean_order_status(db, order_ids, bulk_update.status, admin_user.name)
+    await db.commit()
+    if updated_ids:
+        order_events.publish("order_status", {"order_type": "bean", "ids": updated_ids, "status": bulk_update.status})
+
+    updated = set(updated_ids)
+    return {
+        "message": f"{len(updated_ids)} bean orders updated successfully",
+        "updated": [order_id for order_id in order_ids if order_id in updated],
+        "not_found": [order_id for order_id in order_ids if order_id not in updated],
+    }
+
 @app.patch("/admin/bean_orders/{order_id}/status")
 async def update_bean_order_status(
     order_id: str,
     status_update: StatusUpdate,
-    admin_user: User = Depends(get_current_admin_user)
+    admin_user: User = Depends(get_current_admin_user),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    '''焙煎豆の注文ステータスを更新する'''
-    data = load_data()
-    
-    order_found = False
-    for order in data.get("bean_orders", []):
-        if order["order_id"] == order_id:
-            order["status"] = status_update.status
-            order_found = True
-            break
-            
-    if not order_found:
+    '''焙煎豆の注文ステータスを更新する（SQLAlchemy版、変更履歴つき）'''
+    updated_ids = await set_bean_order_status(db, [order_id], status_update.status, admin_user.name)
+    if not updated_ids:
         raise HTTPException(status_code=404, detail="Bean order not found")
-        
-    save_data(data)
+    await db.commit()
+    order_events.publish("order_status", {"order_type": "bean", "ids": updated_ids, "status": status_update.status})
+
     return {"message": "Bean order status updated successfully"}
     # --- ★★★ 管理者用の新しいAPI（商品情報更新） ★★★ ---
 
@@ -997,13 +2339,13 @@ async def update_product_info(
     product_id: str,
     product_update: ProductUpdate,
     admin_user: User = Depends(get_current_admin_user),
-    db: Session = Depends(get_db) # ★ DBセッションを追加
+    db: AsyncSession = Depends(get_async_db) # ★ DBセッションを追加
 ):
     '''商品情報を更新する（SQLAlchemy版）'''
     # data = load_data() <- 古いコードを削除
     
     # 1. データベースから対象の商品を探す
-    product = db.query(ProductModel).filter(ProductModel.id == product_id).first()
+    product = await db.get(ProductModel, product_id)
             
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
@@ -1014,36 +2356,14 @@ async def update_product_info(
         setattr(product, key, value) # product.name = value や product.price = value と同じ
             
     # 3. 変更をコミット（保存）
-    db.commit()
+    await db.commit()
+    catalog_cache.bump()
     # 4. 更新後のデータをリフレッシュして返す
-    db.refresh(product)
+    await db.refresh(product)
     
     # save_data(data) <- 古いコードを削除
     return {"message": "Product information updated successfully", "product": product}
 
-    # --- ★★★ 顧客向けの新しいAPI（自分の注文履歴） ★★★ ---
-@app.get("/orders/me")
-async def read_user_orders(
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db) # ★ DBセッションを追加
-):
-    '''ログイン中のユーザーの注文履歴を取得する（ハイブリッド版）'''
-    db_yaml = load_data() # ★ デリバリー注文のためにYAMLはまだ残す
-    user_id = current_user.id
-
-    # --- デリバリー注文はまだYAMLから取得 ---
-    user_delivery_orders = [
-        order for order in db_yaml.get("orders", []) if order["user_id"] == user_id
-    ]
-
-    # --- ★ 焙煎豆注文をDBから取得（SQLAlchemy版） ---
-    # .all() で取得したSQLAlchemyモデルのリストは、FastAPIが自動でJSONに変換してくれます
-    user_bean_orders = db.query(BeanOrderModel).filter(BeanOrderModel.user_id == user_id).all()
-
-    return {
-        "delivery_orders": user_delivery_orders,
-        "bean_orders": user_bean_orders
-    }
     # --- モデル定義のエリアに、更新用のモデルを追加 ---
 # (ファイルの上部、他のclass BaseModelの定義が並んでいるところに追加してください)
 
@@ -1060,13 +2380,13 @@ class UserUpdate(BaseModel):
 async def update_user_me(
     user_update: UserUpdate, 
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db) # ★ DBセッションを追加
+    db: AsyncSession = Depends(get_async_db) # ★ DBセッションを追加
 ):
     '''ログイン中のユーザーの情報を更新する（SQLAlchemy版）'''
     # data = load_data() <- 古いコードを削除
     
     # 1. データベースから現在のユーザーを探す (IDで探すのが確実)
-    user = db.query(UserModel).filter(UserModel.id == current_user.id).first()
+    user = await db.get(UserModel, current_user.id)
             
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
@@ -1077,9 +2397,11 @@ async def update_user_me(
         setattr(user, key, value)
         
     # 3. 変更をコミット（保存）
-    db.commit()
+    await db.commit()
     # 4. 更新後のデータをリフレッシュ
-    db.refresh(user)
+    await db.refresh(user)
+    # キャッシュに残っている古いユーザー情報を捨てる
+    principal_cache.invalidate_user(user.id)
     
 # ... (update_user_me 関数の最後) ...
     # 5. Pydanticモデル(User)に詰め替えて返す
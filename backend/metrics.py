@@ -0,0 +1,256 @@
+# metrics.py
+# リクエストとDBの計測値を集計し、Prometheus のテキスト形式で /metrics に出すモジュール
+#
+# - MetricsMiddleware: ルートごとのリクエスト数 (ステータス別)、レイテンシのヒストグラム、処理中の件数、
+#   1リクエストあたりのDB時間を記録します
+# - instrument_engine(): SQL の実行時間を、実行中のリクエストの RequestStats に足し込みます
+# - pool_class_with_wait_metrics(): コネクションプールから接続を借りるまでの待ち時間を記録します
+# - レスポンスには X-DB-Queries (SQLの実行回数) と X-DB-Time (DB時間のミリ秒) ヘッダーを付けます
+#   (N+1 の検出とクエリ数の上限チェックは query_budget.py)
+#
+# ルートは "/admin/bean_orders/{order_id}" のようなテンプレートで集計するので、
+# ラベルの種類がIDの数だけ増えることはありません (どのルートにも一致しないものは "unmatched")。
+# 集計は辞書とリストの加算だけなので、本番で常に有効にしておいても負荷はほぼありません。
+
+import bisect
+import collections
+import contextvars
+import threading
+import time
+
+from sqlalchemy import event
+
+# 秒単位のバケット (Prometheus の histogram_quantile で p50/p95/p99 を出す)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class RequestStats:
+    '''1リクエスト分の計測値 (ContextVar 経由で SQLAlchemy のイベントから更新する)'''
+    __slots__ = ("db_seconds", "queries", "statements", "exempt_queries")
+
+    def __init__(self):
+        self.db_seconds = 0.0
+        self.queries = 0
+        self.statements = collections.Counter()  # SQL文 -> 実行回数 (N+1 の検出用)
+        self.exempt_queries = 0  # クエリ予算の検査から外したSQLの実行回数 (statements には入れない)
+
+
+# 処理中のリクエストの RequestStats (リクエストの外で実行されたSQLでは None)
+current_request_stats = contextvars.ContextVar("current_request_stats", default=None)
+# True の間に実行したSQLは、クエリ予算と N+1 の検査で数えない (query_budget.exempt_from_query_budget)
+query_budget_exempt = contextvars.ContextVar("query_budget_exempt", default=False)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最後は +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._requests = {}      # (method, route, status) -> 件数
+        self._latency = {}       # (method, route) -> Histogram
+        self._db_time = {}       # (method, route) -> Histogram
+        self._pool_wait = {}     # engine名 -> Histogram
+        self._engines = {}       # engine名 -> Engine (貸出中の接続数を出すため)
+        self._gauge_sources = []  # (prefix, 辞書を返す関数)
+        self.in_flight = 0
+
+    def _histogram(self, table, key):
+        histogram = table.get(key)
+        if histogram is None:
+            histogram = table[key] = Histogram(self.buckets)
+        return histogram
+
+    def request_started(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def request_finished(self, method, route, status_code, seconds, db_seconds):
+        key = (method, route)
+        with self._lock:
+            self.in_flight -= 1
+            status_key = (method, route, str(status_code))
+            self._requests[status_key] = self._requests.get(status_key, 0) + 1
+            self._histogram(self._latency, key).observe(seconds)
+            self._histogram(self._db_time, key).observe(db_seconds)
+
+    def observe_pool_wait(self, engine_name, seconds):
+        with self._lock:
+            self._histogram(self._pool_wait, engine_name).observe(seconds)
+
+    def register_engine(self, engine_name, engine):
+        # dispose() でプールが作り直されても追えるように、プールではなくエンジンを覚えておく
+        self._engines[engine_name] = engine
+
+    def add_gauge_source(self, prefix, source):
+        '''
+        source() が返す辞書の数値を {prefix}_{キー} のゲージとして出す
+        (password_pool.metrics() や principal_cache.stats() をそのまま渡せる)
+        '''
+        self._gauge_sources.append((prefix, source))
+
+    # --- Prometheus テキスト形式 ---
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            lines += _header("http_requests_total", "counter", "Total HTTP requests by route and status.")
+            for (method, route, status_code), count in sorted(self._requests.items()):
+                lines.append(f"http_requests_total{_labels(method=method, route=route, status=status_code)} {count}")
+
+            lines += _header("http_requests_in_flight", "gauge", "HTTP requests currently being processed.")
+            lines.append(f"http_requests_in_flight {self.in_flight}")
+
+            lines += self._render_histograms(
+                "http_request_duration_seconds", "Request latency by route.",
+                self._latency, lambda key: {"method": key[0], "route": key[1]})
+            lines += self._render_histograms(
+                "http_request_db_seconds", "Time spent executing SQL per request.",
+                self._db_time, lambda key: {"method": key[0], "route": key[1]})
+            lines += self._render_histograms(
+                "db_pool_checkout_wait_seconds", "Time spent waiting for a pooled connection.",
+                self._pool_wait, lambda key: {"engine": key})
+
+        lines += _header("db_pool_checked_out", "gauge", "Connections currently checked out of the pool.")
+        for engine_name, engine in self._engines.items():
+            lines.append(f"db_pool_checked_out{_labels(engine=engine_name)} {engine.pool.checkedout()}")
+
+        for prefix, source in self._gauge_sources:
+            for key, value in source().items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines += _header(f"{prefix}_{key}", "gauge", f"{prefix} {key}")
+                    lines.append(f"{prefix}_{key} {value}")
+        return "\n".join(lines) + "\n"
+
+    def _render_histograms(self, name, help_text, table, labels_for):
+        lines = _header(name, "histogram", help_text)
+        for key, histogram in sorted(table.items()):
+            labels = labels_for(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels(**labels, le=repr(bound))} {cumulative}")
+            lines.append(f"{name}_bucket{_labels(**labels, le='+Inf')} {histogram.count}")
+            lines.append(f"{name}_sum{_labels(**labels)} {histogram.sum:.6f}")
+            lines.append(f"{name}_count{_labels(**labels)} {histogram.count}")
+        return lines
+
+
+def _header(name, metric_type, help_text):
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+
+
+def _labels(**labels):
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels.items()) + "}"
+
+
+class MetricsMiddleware:
+    '''
+    ASGI ミドルウェア (BaseHTTPMiddleware だと ContextVar がエンドポイントに伝わらないため素の ASGI で書く)。
+    ストリーミングのレスポンスは、最後まで送り終わった時点の時間を記録する
+    '''
+    def __init__(self, app, registry: MetricsRegistry, query_checker=None):
+        '''
+        query_checker: リクエストの処理後に (route, RequestStats) で呼ばれる関数
+            (query_budget.QueryBudgetChecker)。例外を投げるとそのリクエストはエラーになる
+        '''
+        self.app = app
+        self.registry = registry
+        self.query_checker = query_checker
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = current_request_stats.set(stats)
+        status_code = 500  # レスポンスを返す前に例外が起きた場合
+
+        checked_queries = None
+
+        async def send_with_status(message):
+            nonlocal status_code, checked_queries
+            if message["type"] == "http.response.start":
+                # レスポンスを返し始める前に検査する (テストモードの例外は、ステータスを送る前なら 500 になる)
+                if self.query_checker is not None:
+                    checked_queries = stats.queries
+                    self.query_checker(scope.get("route"), stats)
+                status_code = message["status"]
+                # ストリーミングのレスポンスでは、ヘッダーを送る時点までの値になる
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-db-queries", str(stats.queries).encode()),
+                    (b"x-db-time", f"{stats.db_seconds * 1000:.2f}".encode()),
+                ]
+            await send(message)
+
+        self.registry.request_started()
+        started_at = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+            # ストリーミングのレスポンスで、返し始めたあとにもSQLを実行した分をもう一度検査する
+            if self.query_checker is not None and stats.queries != checked_queries:
+                self.query_checker(scope.get("route"), stats)
+        finally:
+            elapsed = time.perf_counter() - started_at
+            # ルーティング後は scope["route"] に一致したルートが入っている
+            route = scope.get("route")
+            self.registry.request_finished(
+                scope["method"], getattr(route, "path", "unmatched"), status_code, elapsed, stats.db_seconds,
+            )
+            current_request_stats.reset(token)
+
+
+def instrument_engine(engine):
+    '''
+    SQL の実行回数と実行時間をリクエストの RequestStats に足し込むように登録する。
+    非同期エンジンの場合は async_engine.sync_engine を渡してください
+    '''
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # 1つの接続で同時に実行されるSQLは1つなので、開始時刻は1つ覚えておけばよい
+        # (エラーになったSQLの開始時刻は、次のSQLで上書きされる)
+        conn.info["query_started_at"] = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_started_at"]
+        stats = current_request_stats.get()
+        if stats is not None:
+            stats.db_seconds += elapsed
+            stats.queries += 1
+            if query_budget_exempt.get():
+                stats.exempt_queries += 1
+            else:
+                stats.statements[statement] += 1
+
+    return engine
+
+
+def pool_class_with_wait_metrics(base_class, registry: MetricsRegistry, engine_name: str):
+    '''
+    接続を借りるまでの待ち時間を記録するプールクラスを作る (create_engine の poolclass に渡す)。
+    SQLAlchemy のプールイベントには「借りる前」のフックがないため、connect() を包む
+    '''
+    class WaitTimedPool(base_class):
+        def connect(self):
+            started_at = time.perf_counter()
+            try:
+                return super().connect()
+            finally:
+                registry.observe_pool_wait(engine_name, time.perf_counter() - started_at)
+
+    WaitTimedPool.__name__ = f"WaitTimed{base_class.__name__}"
+    return WaitTimedPool
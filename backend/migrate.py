@@ -1,18 +1,45 @@
 # migrate.py
+#
+# 使い方 (backend ディレクトリで):
+#   python migrate.py                      … 1件ずつ確認して追加する従来のモード
+#   python migrate.py --bulk               … 大量データ用の一括モード (下の migrate_data_bulk を参照)
+#   python migrate.py --bulk --resume      … 一括モードを前回中断したところから再開
+#   python migrate.py --bulk --batch-size 5000 --yaml export.yaml
+
+import argparse
+import itertools
+import time
+
+import yaml
+from sqlalchemy import Column, Integer, MetaData, String, Table, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 # 1. main.py から必要なもの（すべてのモデル！）をインポートします
 from main import (
+    Base,
     SessionLocal, 
+    engine,
     UserModel, 
     ProductModel, 
     BeanOrderModel,       
     BeanOrderItemModel,   
     BeanInventoryModel,   # ★ 追加
     OrderModel,           # ★ 追加
-    load_data
+    bean_order_id_allocator,
+    order_id_allocator,
+    rebuild_sales_summary,
+    rebuild_slot_counts,
 )
 
-def migrate_data():
+YAML_PATH = "coffee_app.yaml"
+
+
+def load_data(path=YAML_PATH):
+    '''YAMLファイルを丸ごと読み込む (従来モード用)'''
+    with open(path, "r", encoding="utf-8") as f:
+        return yaml.safe_load(f) or {}
+
+def migrate_data(yaml_path=YAML_PATH):
     """
     coffee_app.yaml からデータを読み込み、
     coffee.db データベースに移行するスクリプト。
@@ -21,7 +48,7 @@ def migrate_data():
     # 2. YAMLファイルから全データを読み込みます
     print("YAMLデータを読み込み中...")
     try:
-        data = load_data()
+        data = load_data(yaml_path)
         users_data = data.get("users", [])
         products_data = data.get("products", [])
         bean_orders_data = data.get("bean_orders", [])
@@ -60,6 +87,7 @@ def migrate_data():
         # 6. 焙煎豆の注文データを移行します (変更なし)
         print(f"-> {len(bean_orders_data)} 件の焙煎豆の注文データを移行します...")
         migrated_count = 0
+        migrated_bean_order_ids = []
         for order_yaml in bean_orders_data:
             existing = db.query(BeanOrderModel).filter(BeanOrderModel.order_id == order_yaml["order_id"]).first()
             if not existing:
@@ -73,6 +101,7 @@ def migrate_data():
                             product_id=prod_id,
                             quantity=item_yaml["quantity"]
                         ))
+                migrated_bean_order_ids.append(order_yaml["order_id"])
                 migrated_count += 1
         print(f"   ... {migrated_count} 件の新規焙煎豆注文を追加しました。")
         
@@ -95,6 +124,7 @@ def migrate_data():
         # 8. デリバリー注文データを移行します
         print(f"-> {len(orders_data)} 件のデリバリー注文を移行します...")
         migrated_count = 0
+        migrated_order_ids = []
         for order in orders_data:
             existing = db.query(OrderModel).filter(OrderModel.id == order["id"]).first()
             if not existing:
@@ -102,12 +132,17 @@ def migrate_data():
                 bean_exists = db.query(BeanInventoryModel).filter(BeanInventoryModel.name == order["beans"]).first()
                 if bean_exists:
                     db.add(OrderModel(**order))
+                    migrated_order_ids.append(order["id"])
                     migrated_count += 1
                 else:
                     print(f"   ... 警告: 注文ID {order['id']} の豆 '{order['beans']}' が在庫にないため、スキップします。")
         print(f"   ... {migrated_count} 件の新規デリバリー注文を追加しました。")
         # --- ★★★ ここまで追加 ★★★ ---
 
+        # ★ アプリが同じ注文IDを払い出さないように、IDシーケンスを進めておく
+        db.flush()
+        _advance_id_sequences(db, migrated_order_ids, migrated_bean_order_ids)
+
         # 9. 変更をデータベースに保存（コミット）します
         db.commit()
         print("🎉 データ移行が正常に完了しました！ (コミット完了)")
@@ -122,6 +157,305 @@ def migrate_data():
         db.close()
         print("データベースセッションを閉じました。")
 
-# このスクリプトが直接実行された時だけ、migrate_data()関数を実行する
+# --- ★★★ 一括モード (大量データ用) ★★★ ---
+#
+# 従来モードは1行ごとに SELECT ... first() で存在確認し、1行ずつ add() するため、
+# 過去データを丸ごと移行すると数分かかります。一括モードでは:
+#   - YAMLをストリームとして読み、1件ずつ取り出す (ファイル全体をメモリに載せない)
+#   - batch_size 件ごとに、既存のキーを IN クエリ1回でまとめて確認する
+#   - 新しい行だけを executemany でまとめて INSERT する
+#   - バッチごとにコミットし、同じトランザクションで進捗 (チェックポイント) を保存する
+#     → 途中で落ちても --resume で続きから再開できる
+#   - 最後に1秒あたりの処理件数を表示する
+
+checkpoint_metadata = MetaData()
+migration_checkpoints = Table(
+    "migration_checkpoints", checkpoint_metadata,
+    Column("section", String, primary_key=True), # "users", "orders" など
+    Column("items_done", Integer, nullable=False), # このセクションで処理済みの件数
+)
+
+
+# libyaml (C実装) があれば使う。純Python版より10倍以上速い
+_YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def _compose_from_events(loader, event):
+    '''
+    イベント列から1つ分のノードを組み立てる (CSafeLoader は compose_node を公開していないため自前で行う)。
+    エイリアス (&, *) は移行データでは使わないので対応しない。
+    '''
+    if isinstance(event, yaml.ScalarEvent):
+        tag = event.tag if event.tag not in (None, "!") else loader.resolve(yaml.ScalarNode, event.value, event.implicit)
+        return yaml.ScalarNode(tag, event.value, style=event.style)
+    if isinstance(event, yaml.SequenceStartEvent):
+        tag = event.tag if event.tag not in (None, "!") else loader.resolve(yaml.SequenceNode, None, event.implicit)
+        children = []
+        while not loader.check_event(yaml.SequenceEndEvent):
+            children.append(_compose_from_events(loader, loader.get_event()))
+        loader.get_event()
+        return yaml.SequenceNode(tag, children)
+    if isinstance(event, yaml.MappingStartEvent):
+        tag = event.tag if event.tag not in (None, "!") else loader.resolve(yaml.MappingNode, None, event.implicit)
+        pairs = []
+        while not loader.check_event(yaml.MappingEndEvent):
+            key = _compose_from_events(loader, loader.get_event())
+            pairs.append((key, _compose_from_events(loader, loader.get_event())))
+        loader.get_event()
+        return yaml.MappingNode(tag, pairs)
+    raise ValueError(f"unsupported YAML event: {event}")
+
+
+def _skip_node(loader):
+    '''今の位置にあるノード (スカラー・リスト・辞書) をオブジェクトを作らずに読み飛ばす'''
+    depth = 0
+    while True:
+        event = loader.get_event()
+        if isinstance(event, (yaml.SequenceStartEvent, yaml.MappingStartEvent)):
+            depth += 1
+        elif isinstance(event, (yaml.SequenceEndEvent, yaml.MappingEndEvent)):
+            depth -= 1
+        if depth == 0:
+            return
+
+
+def iter_yaml_sections(path, sections):
+    '''
+    YAMLファイルをストリームとして読み、トップレベルのキーが sections に含まれるものについて
+    (キー, 要素) を1件ずつ返す。値がリストなら要素ごと、それ以外なら値を1回だけ返す。
+    ほかのキーはオブジェクトを作らずに読み飛ばす。
+    '''
+    with open(path, "r", encoding="utf-8") as f:
+        loader = _YamlLoader(f)
+        try:
+            loader.get_event()  # StreamStart
+            if loader.check_event(yaml.StreamEndEvent):
+                return
+            loader.get_event()  # DocumentStart
+            loader.get_event()  # MappingStart
+            while not loader.check_event(yaml.MappingEndEvent):
+                key = loader.construct_object(_compose_from_events(loader, loader.get_event()))
+                if key not in sections:
+                    _skip_node(loader)
+                    continue
+                if loader.check_event(yaml.SequenceStartEvent):
+                    loader.get_event()
+                    while not loader.check_event(yaml.SequenceEndEvent):
+                        node = _compose_from_events(loader, loader.get_event())
+                        yield key, loader.construct_object(node, deep=True)
+                        loader.constructed_objects.clear() # 作ったオブジェクトを溜め込まない
+                    loader.get_event()
+                else:
+                    yield key, loader.construct_object(_compose_from_events(loader, loader.get_event()), deep=True)
+                    loader.constructed_objects.clear()
+        finally:
+            loader.dispose()
+
+
+def iter_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _existing_keys(db, column, keys):
+    '''keys のうち、すでにDBにあるものを IN クエリ1回で調べて set で返す'''
+    if not keys:
+        return set()
+    return set(db.execute(select(column).where(column.in_(keys))).scalars())
+
+
+def _insert_rows(db, model, rows):
+    '''executemany でまとめて追加する (主キーが重複した行は無視)'''
+    if not rows:
+        return 0
+    result = db.execute(sqlite_insert(model.__table__).on_conflict_do_nothing(), rows)
+    return result.rowcount
+
+
+def _bean_order_number(order_id):
+    '''"bo-00000012" (古い形式は "bo-012") のような焙煎豆の注文IDの番号 (その形式でなければ None)'''
+    prefix, _, number = str(order_id).partition("-")
+    return int(number) if prefix == "bo" and number.isdigit() else None
+
+
+def _advance_id_sequences(db, order_ids=(), bean_order_ids=()):
+    '''
+    IDを指定して入れた注文の分だけ、アプリの注文IDのシーケンス (id_sequences) を進める。
+    進めないと、アプリがあとで同じIDを払い出して注文が IntegrityError (500) になる。
+    注文の INSERT と同じトランザクションで呼ぶこと
+    '''
+    if order_ids:
+        order_id_allocator.advance_past(db, max(order_ids) + 1)
+    numbers = [n for n in map(_bean_order_number, bean_order_ids) if n is not None]
+    if numbers:
+        bean_order_id_allocator.advance_past(db, max(numbers) + 1)
+
+
+def _column_values(model, record):
+    '''YAMLのレコードから、テーブルに存在する列だけを取り出す'''
+    columns = model.__table__.columns.keys()
+    return {key: value for key, value in record.items() if key in columns}
+
+
+class BulkMigrator:
+    def __init__(self, yaml_path, batch_size, resume):
+        self.yaml_path = yaml_path
+        self.batch_size = batch_size
+        self.resume = resume
+        self.report = [] # (セクション名, 読んだ件数, 追加した件数, 秒数)
+
+    def run(self):
+        Base.metadata.create_all(bind=engine)
+        checkpoint_metadata.create_all(bind=engine)
+        if not self.resume:
+            with engine.begin() as conn:
+                conn.execute(migration_checkpoints.delete())
+
+        started_at = time.perf_counter()
+        # 1回目: 在庫 (settings.bean_inventory) だけを読む。注文の豆の確認に使うので先に必要
+        self.migrate_inventory()
+        with SessionLocal() as db:
+            self.inventory_names = set(db.execute(select(BeanInventoryModel.name)).scalars())
+
+        # 2回目: 残りのセクションをファイルの順番どおりに1回で読む
+        handlers = {
+            "users": self.users_batch,
+            "products": self.products_batch,
+            "orders": self.orders_batch,
+            "bean_orders": self.bean_orders_batch,
+        }
+        records = iter_yaml_sections(self.yaml_path, set(handlers))
+        for section, section_records in itertools.groupby(records, key=lambda pair: pair[0]):
+            self.migrate_section(section, (record for _, record in section_records), handlers[section])
+        elapsed = time.perf_counter() - started_at
+
+        # 最後まで終わったのでチェックポイントを消す
+        with engine.begin() as conn:
+            conn.execute(migration_checkpoints.delete())
+        self.print_report(elapsed)
+
+    def _load_checkpoint(self, db, section):
+        return db.execute(
+            select(migration_checkpoints.c.items_done).where(migration_checkpoints.c.section == section)
+        ).scalar() or 0
+
+    def _save_checkpoint(self, db, section, items_done):
+        stmt = sqlite_insert(migration_checkpoints).values(section=section, items_done=items_done)
+        db.execute(stmt.on_conflict_do_update(
+            index_elements=[migration_checkpoints.c.section], set_={"items_done": items_done}
+        ))
+
+    def migrate_section(self, section, records, handle_batch):
+        '''records をバッチごとに handle_batch(db, batch) で処理し、バッチごとにコミットする'''
+        started_at = time.perf_counter()
+        read_count = inserted_count = 0
+        with SessionLocal() as db:
+            done = self._load_checkpoint(db, section)
+            if done:
+                print(f"-> {section}: 前回の続き ({done} 件目の次) から再開します")
+            # 処理済みの分は読み飛ばす
+            for batch in iter_batches(itertools.islice(records, done, None), self.batch_size):
+                inserted_count += handle_batch(db, batch)
+                read_count += len(batch)
+                done += len(batch)
+                # データの追加とチェックポイントの更新を同じトランザクションでコミット
+                self._save_checkpoint(db, section, done)
+                db.commit()
+                print(f"   ... {section}: {done} 件処理 (新規 {inserted_count} 件)")
+        self.report.append((section, read_count, inserted_count, time.perf_counter() - started_at))
+
+    def users_batch(self, db, records):
+        existing = _existing_keys(db, UserModel.email, [r["email"] for r in records])
+        rows = [_column_values(UserModel, r) for r in records if r["email"] not in existing]
+        return _insert_rows(db, UserModel, rows)
+
+    def products_batch(self, db, records):
+        existing = _existing_keys(db, ProductModel.id, [r["id"] for r in records])
+        rows = [_column_values(ProductModel, r) for r in records if r["id"] not in existing]
+        return _insert_rows(db, ProductModel, rows)
+
+    def migrate_inventory(self):
+        '''settings.bean_inventory (豆の名前 → 在庫数) を移行する。件数が少ないので1バッチで処理'''
+        started_at = time.perf_counter()
+        settings = next((value for _, value in iter_yaml_sections(self.yaml_path, {"settings"})), None) or {}
+        inventory = settings.get("bean_inventory", {}) or {}
+        with SessionLocal() as db:
+            existing = _existing_keys(db, BeanInventoryModel.name, list(inventory))
+            rows = [{"name": name, "stock": stock} for name, stock in inventory.items() if name not in existing]
+            inserted = _insert_rows(db, BeanInventoryModel, rows)
+            db.commit()
+        self.report.append(("bean_inventory", len(inventory), inserted, time.perf_counter() - started_at))
+
+    def orders_batch(self, db, records):
+        existing = _existing_keys(db, OrderModel.id, [r["id"] for r in records])
+        rows = []
+        for r in records:
+            if r["id"] in existing:
+                continue
+            if r["beans"] not in self.inventory_names:
+                print(f"   ... 警告: 注文ID {r['id']} の豆 '{r['beans']}' が在庫にないため、スキップします。")
+                continue
+            rows.append(_column_values(OrderModel, r))
+        inserted = _insert_rows(db, OrderModel, rows)
+        _advance_id_sequences(db, order_ids=[row["id"] for row in rows])
+        return inserted
+
+    def bean_orders_batch(self, db, records):
+        existing = _existing_keys(db, BeanOrderModel.order_id, [r["order_id"] for r in records])
+        order_rows, item_rows = [], []
+        for r in records:
+            if r["order_id"] in existing:
+                continue
+            order_rows.append(_column_values(BeanOrderModel, r))
+            for item in r.get("items", []) or []:
+                prod_id = item.get("product_id", item.get("id"))
+                if prod_id:
+                    item_rows.append({
+                        "bean_order_id": r["order_id"],
+                        "product_id": prod_id,
+                        "quantity": item["quantity"],
+                    })
+        inserted = _insert_rows(db, BeanOrderModel, order_rows)
+        _insert_rows(db, BeanOrderItemModel, item_rows)
+        _advance_id_sequences(db, bean_order_ids=[row["order_id"] for row in order_rows])
+        return inserted
+
+    def print_report(self, elapsed):
+        print("\n🎉 一括移行が完了しました")
+        print(f"{'section':<16}{'read':>10}{'inserted':>10}{'sec':>9}{'rows/s':>12}")
+        total_read = 0
+        for section, read_count, inserted, seconds in self.report:
+            rate = read_count / seconds if seconds > 0 else 0
+            print(f"{section:<16}{read_count:>10}{inserted:>10}{seconds:>9.2f}{rate:>12.0f}")
+            total_read += read_count
+        rate = total_read / elapsed if elapsed > 0 else 0
+        print(f"{'total':<16}{total_read:>10}{'':>10}{elapsed:>9.2f}{rate:>12.0f}")
+
+
+def migrate_data_bulk(yaml_path=YAML_PATH, batch_size=1000, resume=False):
+    '''coffee_app.yaml から coffee.db へ一括モードで移行する'''
+    BulkMigrator(yaml_path, batch_size, resume).run()
+
+
+# このスクリプトが直接実行された時だけ、移行を実行する
 if __name__ == "__main__":
-    migrate_data()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="coffee_app.yaml のデータを coffee.db に移行する")
+    parser.add_argument("--bulk", action="store_true", help="大量データ用の一括モードで移行する")
+    parser.add_argument("--batch-size", type=int, default=1000, help="一括モードで1回にコミットする件数")
+    parser.add_argument("--resume", action="store_true", help="一括モードを前回のチェックポイントから再開する")
+    parser.add_argument("--yaml", default=YAML_PATH, help="読み込むYAMLファイル")
+    args = parser.parse_args()
+
+    if args.bulk:
+        migrate_data_bulk(args.yaml, args.batch_size, args.resume)
+    else:
+        migrate_data(args.yaml)
+    # 移行した注文から売上の日次集計 (/admin/stats 用) と時間枠の予約数を作り直す
+    rebuild_sales_summary()
+    rebuild_slot_counts()
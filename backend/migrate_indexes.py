@@ -0,0 +1,24 @@
+# migrate_indexes.py
+# 既存の coffee.db に、モデルで定義したインデックスを追加するスクリプト
+# (何度実行しても安全です。アプリ起動時にも同じ処理が自動で実行されます)
+#
+# 使い方 (backend ディレクトリで):
+#   python migrate_indexes.py
+
+from main import Base, engine, ensure_indexes
+
+
+def migrate_indexes():
+    # テーブル自体がまだ無い場合に備えて先に作成する
+    Base.metadata.create_all(bind=engine)
+    created = ensure_indexes()
+    if created:
+        print(f"🎉 {len(created)} 件のインデックスを作成しました:")
+        for name in created:
+            print(f"   - {name}")
+    else:
+        print("すべてのインデックスは作成済みです。")
+
+
+if __name__ == "__main__":
+    migrate_indexes()
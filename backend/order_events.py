@@ -0,0 +1,175 @@
+# order_events.py
+# 新しい注文やステータスの変更を管理画面に送るための、プロセス内の pub/sub (Server-Sent Events 用)
+#
+# 管理画面は /admin/all_orders を取り直して新しい注文を探していたので、そのたびに1ページ分の注文を
+# すべてダウンロードしていました。GET /admin/orders/stream に接続しておくと、
+# 注文の作成・ステータスの変更があったときに、その1件分の差分だけが届きます。
+#
+# - publish() はイベントを1回だけ SSE の形式 (id / event / data の行) のバイト列にして、
+#   直近 history_size 件の履歴と、接続中の購読者ごとのバッファに入れます
+# - 購読者のバッファは buffer_size 件まで。読み出しが追いつかない (遅い) クライアントは、
+#   ほかの購読者や注文の処理を待たせないように、バッファがいっぱいになった時点で切断します
+# - 再接続のときに Last-Event-ID を送ると、それより後のイベントを履歴から送り直します。
+#   履歴に残っていない (古すぎる、またはサーバーが再起動した) 場合は reset イベントを送るので、
+#   クライアントは一覧を取り直してください
+#
+# イベントIDは「起動ごとのID-通し番号」の形式です (再起動後に古いIDで続きを読まないように)。
+# 注意: 購読者と履歴はプロセスごとなので、ワーカーが複数あると、ほかのワーカーで作られた注文は届きません。
+# publish() / subscribe() はイベントループのスレッドから呼んでください (スレッドセーフではありません)。
+
+import asyncio
+import json
+import os
+import time
+from collections import deque
+
+
+class TooManySubscribers(Exception):
+    '''購読者の数が上限に達している'''
+
+
+class Subscription:
+    def __init__(self, broker, replay):
+        self._broker = broker
+        self._replay = replay  # 接続直後に送るフレーム (ready / reset、または履歴からの送り直し)
+        self._queue = asyncio.Queue()
+        self.closed = False
+        self.overflowed = False
+
+    async def frames(self, heartbeat_seconds: float):
+        '''
+        送信するフレーム (bytes) を順に返す非同期ジェネレーター。
+        heartbeat_seconds の間イベントがなければ、接続を保つためのコメント行を返す
+        '''
+        try:
+            for frame in self._replay:
+                yield frame
+            self._replay = None
+            while True:
+                if self.closed and self._queue.empty():
+                    return
+                try:
+                    frame = await asyncio.wait_for(self._queue.get(), heartbeat_seconds)
+                except asyncio.TimeoutError:
+                    yield b": ping\n\n"
+                    continue
+                if frame is None:  # close() の合図
+                    return
+                yield frame
+        finally:
+            self._broker.unsubscribe(self)
+
+    def _put(self, frame, buffer_size) -> bool:
+        if self._queue.qsize() >= buffer_size:
+            return False
+        self._queue.put_nowait(frame)
+        return True
+
+    def close(self):
+        self.closed = True
+        self._queue.put_nowait(None)
+
+
+class OrderEventBroker:
+    def __init__(self, dumps=json.dumps, history_size: int = 1000, buffer_size: int = 100,
+                 max_subscribers: int = 50, retry_ms: int = 3000):
+        '''
+        dumps: イベントのデータをJSONにする関数 (str でも bytes でもよい。改行を含まないこと)
+        history_size: 再接続 (Last-Event-ID) のために覚えておく直近のイベント数
+        buffer_size: 購読者ごとに溜めておけるイベント数 (超えたらその購読者を切断する)
+        retry_ms: 切断されたときにクライアント (EventSource) が再接続するまでの待ち時間
+        '''
+        self._dumps = dumps
+        self.history_size = history_size
+        self.buffer_size = buffer_size
+        self.max_subscribers = max_subscribers
+        self.retry_ms = retry_ms
+        self.boot_id = format(int(time.time() * 1000), "x")
+        self._seq = 0
+        self._history = deque(maxlen=history_size)  # (通し番号, フレーム)
+        self._subscribers = set()
+        self.published = 0
+        self.dropped_subscribers = 0
+
+    @property
+    def last_event_id(self) -> str:
+        return f"{self.boot_id}-{self._seq}"
+
+    def publish(self, event_type: str, data):
+        '''イベントを履歴に追加し、接続中の購読者全員に送る'''
+        self._seq += 1
+        frame = self._frame(self.last_event_id, event_type, data)
+        self._history.append((self._seq, frame))
+        self.published += 1
+        for subscription in list(self._subscribers):
+            if not subscription._put(frame, self.buffer_size):
+                # 読み出しが追いつかないクライアントは切断する (再接続すれば履歴から続きを受け取れる)
+                subscription.overflowed = True
+                self.dropped_subscribers += 1
+                self.unsubscribe(subscription)
+                subscription.close()
+
+    def subscribe(self, last_event_id: str = None) -> Subscription:
+        '''
+        購読を開始する。last_event_id (再接続時の Last-Event-ID) があれば、その後のイベントから送る。
+        購読者が上限に達していれば TooManySubscribers を投げる
+        '''
+        if len(self._subscribers) >= self.max_subscribers:
+            raise TooManySubscribers()
+        replay = [f"retry: {self.retry_ms}\n".encode()]
+        missed = self._events_after(last_event_id) if last_event_id else None
+        if missed is None:
+            # 初回の接続、または続きを送れない場合は、現在のIDだけを知らせる (reset なら一覧を取り直してもらう)
+            event_type = "reset" if last_event_id else "ready"
+            replay.append(self._frame(self.last_event_id, event_type, {}))
+        else:
+            replay += missed
+        subscription = Subscription(self, replay)
+        self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self._subscribers.discard(subscription)
+
+    def close(self):
+        '''アプリ終了時に呼ぶ (接続中のストリームをすべて終わらせる)'''
+        for subscription in list(self._subscribers):
+            self.unsubscribe(subscription)
+            subscription.close()
+
+    def stats(self):
+        return {
+            "subscribers": len(self._subscribers),
+            "published": self.published,
+            "dropped_subscribers": self.dropped_subscribers,
+            "history": len(self._history),
+        }
+
+    # --- 以下は内部用 ---
+    def _events_after(self, last_event_id: str):
+        '''last_event_id より後のフレームのリスト (履歴から送れなければ None)'''
+        boot_id, _, seq = last_event_id.rpartition("-")
+        if boot_id != self.boot_id or not seq.isdigit():
+            return None
+        seq = int(seq)
+        if seq > self._seq:
+            return None
+        oldest = self._history[0][0] if self._history else self._seq + 1
+        if seq + 1 < oldest:
+            return None  # 履歴から押し出された分がある
+        return [frame for event_seq, frame in self._history if event_seq > seq]
+
+    def _frame(self, event_id, event_type, data) -> bytes:
+        payload = self._dumps(data)
+        if isinstance(payload, str):
+            payload = payload.encode()
+        return b"id: %s\nevent: %s\ndata: %s\n\n" % (event_id.encode(), event_type.encode(), payload)
+
+
+def create_broker_from_env(dumps=json.dumps):
+    return OrderEventBroker(
+        dumps,
+        history_size=int(os.getenv("ORDER_EVENTS_HISTORY", 1000)),
+        buffer_size=int(os.getenv("ORDER_EVENTS_BUFFER", 100)),
+        max_subscribers=int(os.getenv("ORDER_EVENTS_MAX_SUBSCRIBERS", 50)),
+    )
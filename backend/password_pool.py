@@ -0,0 +1,108 @@
+# password_pool.py
+# bcrypt のハッシュ化・照合をイベントループの外 (専用のスレッドプール) で実行するためのモジュール
+#
+# bcrypt は1回あたり数百msのCPUを使うので、async def の中で直接呼ぶと
+# その間ほかのリクエストがすべて止まってしまいます。
+# ここではワーカー数と待ち行列の長さに上限を設け、上限を超えた場合は
+# 待たせずにすぐ PasswordPoolSaturated を投げます (main.py 側で 503 に変換)。
+
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PasswordPoolSaturated(Exception):
+    '''ワーカーも待ち行列も埋まっていて、これ以上受け付けられないときの例外'''
+
+
+class PasswordHashPool:
+    def __init__(self, max_workers: int, max_queue: int):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="bcrypt")
+        self._lock = threading.Lock()
+        # 実行中 + 待機中のジョブ数
+        self._in_flight = 0
+        self._running = 0
+        # メトリクス
+        self._completed = 0
+        self._rejected = 0
+        self._failed = 0
+        self._queue_wait_total = 0.0
+        self._run_time_total = 0.0
+
+    async def run(self, fn, *args):
+        '''fn(*args) をプールで実行して結果を返す。満杯なら PasswordPoolSaturated を投げる'''
+        with self._lock:
+            if self._in_flight >= self.max_workers + self.max_queue:
+                self._rejected += 1
+                raise PasswordPoolSaturated()
+            self._in_flight += 1
+
+        submitted_at = time.perf_counter()
+
+        def job():
+            started_at = time.perf_counter()
+            with self._lock:
+                self._running += 1
+                self._queue_wait_total += started_at - submitted_at
+            try:
+                result = fn(*args)
+            except Exception:
+                with self._lock:
+                    self._failed += 1
+                raise
+            else:
+                with self._lock:
+                    self._completed += 1
+                return result
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._run_time_total += time.perf_counter() - started_at
+
+        def release(_):
+            # ジョブが終わったとき (または始まる前に取り消されたとき) に数を戻す。
+            # 待っているリクエストが切断されても、始まった bcrypt はスレッドで最後まで動くので、
+            # await の後で戻すと上限を超えてジョブを受け付けてしまう
+            with self._lock:
+                self._in_flight -= 1
+
+        try:
+            future = self._executor.submit(job)
+        except RuntimeError:
+            # shutdown 後
+            release(None)
+            raise
+        future.add_done_callback(release)
+        return await asyncio.wrap_future(future)
+
+    def metrics(self):
+        '''プールの現在の状態と累計値を辞書で返す'''
+        with self._lock:
+            finished = self._completed + self._failed
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "running": self._running,
+                "queued": self._in_flight - self._running,
+                "completed": self._completed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+                "avg_queue_wait_ms": round(self._queue_wait_total / finished * 1000, 2) if finished else 0.0,
+                "avg_run_time_ms": round(self._run_time_total / finished * 1000, 2) if finished else 0.0,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def create_pool_from_env():
+    '''環境変数からプールの設定を読み込んで作成する'''
+    default_workers = min(4, os.cpu_count() or 1)
+    return PasswordHashPool(
+        max_workers=int(os.getenv("PASSWORD_HASH_WORKERS", default_workers)),
+        max_queue=int(os.getenv("PASSWORD_HASH_MAX_QUEUE", 32)),
+    )
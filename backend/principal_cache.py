@@ -0,0 +1,125 @@
+# principal_cache.py
+# 認証済みユーザー (get_current_user の結果) をトークンごとに覚えておくキャッシュ
+#
+# 同じトークンでの2回目以降のリクエストでは jwt.decode も DB検索も行いません。
+# - TTL: 設定値とトークンの有効期限 (exp) の短いほうまで有効
+# - LRU: 上限件数を超えたら、最後に使われたのが一番古いものから捨てる
+# - ユーザー情報が変わったら invalidate_user() でそのユーザーの全トークン分を消す
+# - DBから読む前に generation() を取っておき、put() に渡す。読んでいる間に invalidate_user() された
+#   ユーザーは (読んだ値が古いかもしれないので) キャッシュに入れない。入れると TTL の間ずっと古い情報を返してしまう
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class PrincipalCache:
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        # token -> (user, user_id, expires_at)
+        self._entries = OrderedDict()
+        # user_id -> {token, ...} (ユーザー単位で消すための逆引き)
+        self._tokens_by_user = {}
+        # invalidate_user() のたびに1つ進める世代と、ユーザーごとの最後に消した世代
+        self._generation = 0
+        self._invalidated_generation = {}  # user_id -> 世代
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.stale_puts = 0
+
+    def generation(self) -> int:
+        '''現在の世代。ユーザーをDBから読む前に取り、put() の generation に渡す'''
+        with self._lock:
+            return self._generation
+
+    def get(self, token: str):
+        '''キャッシュにあればユーザーを返す。なければ (または期限切れなら) None'''
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                self.misses += 1
+                return None
+            user, user_id, expires_at = entry
+            if expires_at <= now:
+                self._remove(token, user_id)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return user
+
+    def put(self, token: str, user, user_id: int, token_exp=None, generation=None):
+        '''
+        ユーザーをキャッシュに入れる。token_exp (UNIX時刻) を過ぎたら使わない。
+        generation (DBから読む前の generation()) より後にそのユーザーが invalidate_user() されていたら入れない
+        '''
+        expires_at = time.time() + self.ttl_seconds
+        if token_exp is not None:
+            expires_at = min(expires_at, float(token_exp))
+        with self._lock:
+            if generation is not None and self._invalidated_generation.get(user_id, -1) > generation:
+                self.stale_puts += 1
+                return
+            if token in self._entries:
+                self._remove(token, self._entries[token][1])
+            self._entries[token] = (user, user_id, expires_at)
+            self._tokens_by_user.setdefault(user_id, set()).add(token)
+            while len(self._entries) > self.max_entries:
+                old_token, (_, old_user_id, _) = self._entries.popitem(last=False)
+                self._discard_token(old_token, old_user_id)
+                self.evictions += 1
+
+    def invalidate_user(self, user_id: int):
+        '''ユーザー情報 (名前やロール) が変わったときに、そのユーザーのキャッシュをすべて消す'''
+        with self._lock:
+            self._generation += 1
+            self._invalidated_generation[user_id] = self._generation
+            for token in self._tokens_by_user.pop(user_id, set()):
+                self._entries.pop(token, None)
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tokens_by_user.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "stale_puts": self.stale_puts,
+            }
+
+    # --- 以下はロックを取った状態で呼ぶ内部用 ---
+    def _remove(self, token, user_id):
+        self._entries.pop(token, None)
+        self._discard_token(token, user_id)
+
+    def _discard_token(self, token, user_id):
+        tokens = self._tokens_by_user.get(user_id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[user_id]
+
+
+def create_cache_from_env():
+    '''環境変数からキャッシュの設定を読み込んで作成する'''
+    return PrincipalCache(
+        max_entries=int(os.getenv("PRINCIPAL_CACHE_MAX_ENTRIES", 10000)),
+        ttl_seconds=float(os.getenv("PRINCIPAL_CACHE_TTL_SECONDS", 300)),
+    )
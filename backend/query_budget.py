@@ -0,0 +1,100 @@
+# query_budget.py
+# エンドポイントごとのSQL実行回数の上限 (クエリ予算) と N+1 の検出
+#
+# エンドポイントに @query_budget(4) のように上限を宣言しておくと、リクエストの処理後に
+# metrics.RequestStats の実行回数と比べます。また、予算の宣言がなくても、
+# 同じ形のSQL (パラメーター違いは同じ形とみなす) が repeat_limit 回以上実行されたら
+# N+1 (ループの中で遅延ロードなど) の疑いとして扱います。
+#
+# 検査はレスポンスを返し始める時点 (ステータスとヘッダーを送る前) に行います。
+# ストリーミングのレスポンスで、返し始めたあとにSQLを実行した場合は、送り終わったあとにもう一度検査します。
+#
+# - 通常: 違反したルートごとに1回だけ警告を表示します (レスポンスはそのまま)
+# - テストモード (環境変数 QUERY_BUDGET_STRICT=1): QueryBudgetExceeded を投げてリクエストをエラー (500) にします
+#   TestClient はサーバー側の例外をそのまま投げるので、テストが失敗します
+#
+# 冪等キーの処理待ちのポーリング (idempotency.py) のように、回数が待ち時間で決まるSQLは
+# with exempt_from_query_budget(): の中で実行すると、予算とN+1の検査で数えません。
+#
+# 使い方:
+#   @app.get("/orders/me")
+#   @query_budget(4)
+#   async def read_user_orders(...):
+
+import contextlib
+import os
+import re
+
+from metrics import query_budget_exempt
+
+# IN (?, ?, ?) や VALUES (?, ?), (?, ?) は個数が違っても同じ形とみなす
+_PLACEHOLDER_LIST = re.compile(r"\((?:\?, )*\?\)(?:, \((?:\?, )*\?\))*")
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def query_budget(max_queries: int):
+    '''エンドポイント関数に、1リクエストあたりのSQL実行回数の上限を宣言するデコレーター'''
+    def decorator(endpoint):
+        endpoint.query_budget = max_queries
+        return endpoint
+    return decorator
+
+
+@contextlib.contextmanager
+def exempt_from_query_budget():
+    '''この中で実行したSQLを、クエリ予算と N+1 の検査で数えない (X-DB-Queries などの計測には含める)'''
+    token = query_budget_exempt.set(True)
+    try:
+        yield
+    finally:
+        query_budget_exempt.reset(token)
+
+
+def statement_shape(statement: str) -> str:
+    return _PLACEHOLDER_LIST.sub("(?)", " ".join(statement.split()))
+
+
+class QueryBudgetChecker:
+    def __init__(self, strict: bool = False, repeat_limit: int = 5):
+        self.strict = strict
+        self.repeat_limit = repeat_limit
+        self._warned = set()
+
+    def problems(self, route, stats):
+        '''違反内容のリスト (問題がなければ空)'''
+        problems = []
+        budget = getattr(getattr(route, "endpoint", None), "query_budget", None)
+        queries = stats.queries - stats.exempt_queries
+        if budget is not None and queries > budget:
+            problems.append(f"{queries} queries (budget {budget})")
+
+        shapes = {}
+        for statement, count in stats.statements.items():
+            shape = statement_shape(statement)
+            shapes[shape] = shapes.get(shape, 0) + count
+        for shape, count in shapes.items():
+            if count >= self.repeat_limit:
+                problems.append(f"same statement executed {count} times (possible N+1): {shape[:200]}")
+        return problems
+
+    def __call__(self, route, stats):
+        problems = self.problems(route, stats)
+        if not problems:
+            return
+        path = getattr(route, "path", "unmatched")
+        if self.strict:
+            raise QueryBudgetExceeded(f"{path}: " + "; ".join(problems))
+        if path not in self._warned:
+            self._warned.add(path)
+            print(f"⚠️ クエリ予算の違反 {path}: " + "; ".join(problems))
+
+
+def create_checker_from_env():
+    '''環境変数 QUERY_BUDGET_STRICT (1でテストモード) と QUERY_REPEAT_LIMIT から作る'''
+    return QueryBudgetChecker(
+        strict=os.getenv("QUERY_BUDGET_STRICT", "0").lower() in ("1", "on", "true"),
+        repeat_limit=int(os.getenv("QUERY_REPEAT_LIMIT", 5)),
+    )
@@ -0,0 +1,62 @@
+# sqlite_tuning.py
+# SQLiteエンジンの設定 (PRAGMA と コネクションプール) をまとめたモジュール
+#
+# SQLiteのデフォルト (rollbackジャーナル / busy_timeoutなし / 毎コミットfsync) のままだと、
+# 注文の書き込みが重なったときに "database is locked" になったり、書き込み中は読み込みも待たされます。
+# ここでは接続ごとに以下の PRAGMA を設定します (すべて環境変数で変更可能)。
+#
+#   journal_mode = WAL      … 書き込み中でも読み込みができる
+#   busy_timeout = 5000     … ロック中はエラーにせず最大5秒待つ
+#   synchronous  = NORMAL   … WALではコミットごとのfsyncを省略しても壊れない
+#   cache_size   = -20000   … ページキャッシュ (負の値はKB単位、約20MB)
+#   mmap_size    = 268435456 … 256MBまでメモリマップで読む
+#   temp_store   = MEMORY   … 一時テーブル・ソートをメモリ上で行う
+
+import os
+
+from sqlalchemy import event
+
+
+def pragmas_from_env():
+    '''環境変数から PRAGMA の設定値を読み込む (SQLITE_TUNING=off で一切設定しない)'''
+    if os.getenv("SQLITE_TUNING", "on").lower() in ("0", "off", "false"):
+        return {}
+    return {
+        "journal_mode": os.getenv("SQLITE_JOURNAL_MODE", "WAL"),
+        "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000)),
+        "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+        "cache_size": int(os.getenv("SQLITE_CACHE_SIZE", -20000)),
+        "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", 268435456)),
+        "temp_store": os.getenv("SQLITE_TEMP_STORE", "MEMORY"),
+    }
+
+
+def pool_options_from_env():
+    '''create_engine / create_async_engine に渡すコネクションプールの設定'''
+    return {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", 10)),
+        "max_overflow": int(os.getenv("DB_POOL_MAX_OVERFLOW", 20)),
+        "pool_timeout": float(os.getenv("DB_POOL_TIMEOUT_SECONDS", 30)),
+    }
+
+
+def apply_sqlite_pragmas(engine, pragmas=None):
+    '''
+    エンジンが新しく接続を作るたびに PRAGMA を実行するように登録する。
+    非同期エンジンの場合は async_engine.sync_engine を渡してください。
+    '''
+    if pragmas is None:
+        pragmas = pragmas_from_env()
+    if not pragmas:
+        return engine
+
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+        finally:
+            cursor.close()
+
+    return engine
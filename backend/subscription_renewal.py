@@ -0,0 +1,281 @@
+# subscription_renewal.py
+# 定期便 (サブスクリプション契約) の一括更新
+#
+# status = 'active' で next_delivery_date が指定日以前の契約ごとに、
+#   1. 焙煎豆の注文 (bean_orders / bean_order_items / order_history) を作成し
+#   2. 商品の在庫を減らし
+#   3. next_delivery_date を次回 (monthly は翌月の同じ日、bi-weekly は14日後) に進めて renewal_count を1増やします
+#   4. 売上の日次集計 (daily_product_sales) に足します
+# 契約は batch_size 件ずつ1トランザクションで処理するので、10万件でも数秒で終わります。
+#
+# - 対象の契約は ix_subscription_contracts_status_next_delivery_date を使って期日順に読みます
+# - 在庫が足りない契約は更新せずに残します (在庫が補充されたあとの実行で更新されます)
+# - 届け先は、契約しているユーザーの直近の焙煎豆の注文の届け先を使います
+#   (契約にもユーザーにも住所の列がないため)。届け先が分からない契約も更新せずに残します
+# - 何回分も期日を過ぎている契約は、注文を1件だけ作り、次回の日付を指定日より後まで進めます
+# - バッチごとに最初に書き込みロックを取る (BEGIN IMMEDIATE) ので、アプリやほかのワーカーと
+#   同時に実行されても、二重に更新したり在庫がマイナスになったりしません
+#   (念のため在庫と契約の更新は「読んだときの値から変わっていないこと」を条件にしたUPDATEにしてあり、
+#   条件に合わなかったバッチはロールバックしてやり直します)
+#
+# 使い方 (backend ディレクトリで):
+#   python subscription_renewal.py                  # 今日までが期日の契約を更新
+#   python subscription_renewal.py --as-of 2025-10-01 --batch-size 2000
+#
+# アプリの中で定期的に実行する場合は、環境変数 SUBSCRIPTION_RENEWAL_INTERVAL_SECONDS を設定してください
+# (main.py の起動時にバックグラウンドタスクとして開始されます)。
+
+import argparse
+import calendar
+import random
+import time
+from datetime import date, datetime, timedelta, timezone
+
+from sqlalchemy import insert, select, tuple_, update, bindparam
+from sqlalchemy.exc import OperationalError
+
+from main import (
+    engine, bean_order_id_allocator, format_bean_order_id, catalog_cache, _reserve_product_stmt, _add_product_sales_stmt,
+    UserModel,
+    BeanOrderModel, BeanOrderItemModel, OrderHistoryModel, ProductModel,
+    SubscriptionContractModel, SubscriptionContractItemModel,
+)
+
+DEFAULT_BATCH_SIZE = 1000
+# 条件付きUPDATEが競合したり、ロックが取れなかったときに同じバッチをやり直す回数
+MAX_BATCH_RETRIES = 5
+
+_contracts = SubscriptionContractModel.__table__
+_advance_contract_stmt = (
+    update(_contracts)
+    .where(
+        _contracts.c.id == bindparam("_id"),
+        _contracts.c.status == "active",
+        _contracts.c.next_delivery_date == bindparam("_old_date"),
+    )
+    .values(next_delivery_date=bindparam("_new_date"), renewal_count=_contracts.c.renewal_count + 1)
+)
+
+
+def _bulk_insert(conn, table, rows):
+    '''
+    rows (列名 -> 値 の辞書のリスト) をドライバーの executemany で直接 INSERT する。
+    SQLAlchemy の executemany は1行ごとのパラメーター処理が重く、10万件規模ではSQLite本体より時間がかかるため。
+    値はSQLiteにそのまま渡せる型にしておくこと (rows にない列は、モデルの default の固定値を入れる)
+    '''
+    columns = list(rows[0])
+    defaults = {
+        column.name: column.default.arg for column in table.columns
+        if column.name not in rows[0] and column.default is not None and column.default.is_scalar
+    }
+    sql = (
+        f"INSERT INTO {table.name} ({', '.join([*columns, *defaults])}) "
+        f"VALUES ({', '.join('?' * (len(columns) + len(defaults)))})"
+    )
+    default_values = tuple(defaults.values())
+    conn.exec_driver_sql(sql, [tuple(row[c] for c in columns) + default_values for row in rows])
+
+
+class RenewalConflict(Exception):
+    '''バッチの処理中にほかの処理が在庫や契約を変更した (やり直す)'''
+
+
+def add_months(d: date, months: int) -> date:
+    '''月を足す (1/31 の翌月は 2/28 のように月末に丸める)'''
+    month_index = d.month - 1 + months
+    year, month = d.year + month_index // 12, month_index % 12 + 1
+    return date(year, month, min(d.day, calendar.monthrange(year, month)[1]))
+
+
+def next_delivery_after(current: date, interval: str, as_of: date):
+    '''as_of より後になるまで interval ずつ進めた日付 (未知の interval なら None)'''
+    if interval == "monthly":
+        step = lambda d: add_months(d, 1)
+    elif interval == "bi-weekly":
+        step = lambda d: d + timedelta(days=14)
+    else:
+        return None
+    d = step(current)
+    while d <= as_of:
+        d = step(d)
+    return d
+
+
+def latest_shipping_addresses(conn, user_ids):
+    '''ユーザーID -> 直近の焙煎豆の注文の届け先 (届け先のある注文がないユーザーは含まない)'''
+    B = BeanOrderModel
+    latest = (
+        select(B.shipping_address)
+        .where(B.user_id == UserModel.id, B.shipping_address != "")
+        .order_by(B.date.desc(), B.order_id.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+    return {
+        user_id: address
+        for user_id, address in conn.execute(select(UserModel.id, latest).where(UserModel.id.in_(user_ids)))
+        if address
+    }
+
+
+def renew_batch(conn, contracts, as_of: date) -> dict:
+    '''
+    1バッチ分の契約を更新し、このバッチの件数 (renewed / skipped_*) を返す (conn のトランザクションの中で呼ぶ)。
+    contracts は (id, user_id, interval, next_delivery_date, renewal_count) の行のリスト。
+    件数はコミットできたときだけ呼び出し側で集計に足すこと (やり直したバッチを二重に数えないように)
+    '''
+    counts = {"renewed": 0, "skipped_out_of_stock": 0, "skipped_invalid": 0, "skipped_no_address": 0}
+    contract_ids = [c.id for c in contracts]
+    # 契約ID -> [(商品ID, 数量), ...] (行オブジェクトより tuple の方が速いので、ここで詰め替える)
+    items_by_contract = {}
+    for contract_id, product_id, quantity in conn.execute(
+        select(SubscriptionContractItemModel.contract_id, SubscriptionContractItemModel.product_id,
+               SubscriptionContractItemModel.quantity)
+        .where(SubscriptionContractItemModel.contract_id.in_(contract_ids))
+    ):
+        items_by_contract.setdefault(contract_id, []).append((product_id, quantity))
+
+    product_ids = {product_id for items in items_by_contract.values() for product_id, _ in items}
+    products = {
+        row.id: row for row in conn.execute(
+            select(ProductModel.id, ProductModel.price, ProductModel.stock).where(ProductModel.id.in_(product_ids))
+        )
+    }
+
+    addresses = latest_shipping_addresses(conn, {c.user_id for c in contracts})
+
+    # 在庫を契約の期日順に割り当て、足りる契約だけを更新対象にする
+    available = {product_id: row.stock or 0 for product_id, row in products.items()}
+    reserved = {}
+    renewals = []
+    for contract in contracts:
+        items = items_by_contract.get(contract.id)
+        new_date = next_delivery_after(date.fromisoformat(contract.next_delivery_date), contract.interval, as_of)
+        if not items or new_date is None or any(product_id not in products for product_id, _ in items):
+            counts["skipped_invalid"] += 1
+            continue
+        if contract.user_id not in addresses:
+            counts["skipped_no_address"] += 1
+            continue
+        if any(available[product_id] < quantity for product_id, quantity in items):
+            counts["skipped_out_of_stock"] += 1
+            continue
+        for product_id, quantity in items:
+            available[product_id] -= quantity
+            reserved[product_id] = reserved.get(product_id, 0) + quantity
+        renewals.append((contract, items, new_date))
+    if not renewals:
+        return counts
+
+    # 在庫を減らす (読んだあとに売れて足りなくなっていたら、バッチごとやり直す)
+    result = conn.execute(_reserve_product_stmt, [
+        {"_product_id": product_id, "_quantity": quantity} for product_id, quantity in reserved.items()
+    ])
+    if result.rowcount != len(reserved):
+        raise RenewalConflict("stock changed")
+
+    result = conn.execute(_advance_contract_stmt, [
+        {"_id": contract.id, "_old_date": contract.next_delivery_date, "_new_date": new_date.isoformat()}
+        for contract, _, new_date in renewals
+    ])
+    if result.rowcount != len(renewals):
+        raise RenewalConflict("contract changed")
+
+    # 注文IDはまとめて確保する (アプリの採番と同じシーケンスなので重複しない)
+    start, _ = bean_order_id_allocator.reserve_range(conn, len(renewals))
+    now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")  # DateTime 列の保存形式
+    orders, order_items, history = [], [], []
+    sales = {}  # 商品ID -> 売上の日次集計に足す行 (バッチ内の注文日はすべて as_of なので商品ごとにまとめる)
+    for n, (contract, items, _) in enumerate(renewals):
+        order_id = format_bean_order_id(start + n)
+        orders.append({
+            "order_id": order_id,
+            "user_id": contract.user_id,
+            "date": as_of.isoformat(),
+            "total_price": sum(products[product_id].price * quantity for product_id, quantity in items),
+            "shipping_address": addresses[contract.user_id],
+            "status": "paid",
+            "internal_notes": f"定期便 契約#{contract.id} ({contract.renewal_count + 1}回目)",
+        })
+        order_items += [
+            {"bean_order_id": order_id, "product_id": product_id, "quantity": quantity}
+            for product_id, quantity in items
+        ]
+        history.append({
+            "order_id": order_id, "timestamp": now, "actor_name": "システム",
+            "action": "定期便の更新で注文が作成されました。",
+        })
+        for product_id, quantity in items:
+            row = sales.setdefault(product_id, {"date": as_of.isoformat(), "product_id": product_id,
+                                                "quantity": 0, "revenue": 0, "order_count": 0})
+            row["quantity"] += quantity
+            row["revenue"] += products[product_id].price * quantity
+            row["order_count"] += 1
+    _bulk_insert(conn, BeanOrderModel.__table__, orders)
+    _bulk_insert(conn, BeanOrderItemModel.__table__, order_items)
+    _bulk_insert(conn, OrderHistoryModel.__table__, history)
+    conn.execute(_add_product_sales_stmt, list(sales.values()))
+    counts["renewed"] = len(renewals)
+    return counts
+
+
+def renew_due_subscriptions(as_of: date = None, batch_size: int = DEFAULT_BATCH_SIZE, bind=None):
+    '''as_of (省略時は今日) までが期日の有効な契約をすべて更新し、件数のレポートを返す'''
+    as_of = as_of or datetime.now(timezone.utc).date()
+    bind = bind or engine
+    report = {"renewed": 0, "skipped_out_of_stock": 0, "skipped_invalid": 0, "skipped_no_address": 0,
+              "batches": 0, "retries": 0}
+    started_at = time.perf_counter()
+
+    # 期日順にキーセットで読み進める (更新しなかった契約を何度も読まないように)
+    last_key = ("", 0)
+    while True:
+        for attempt in range(MAX_BATCH_RETRIES):
+            try:
+                with bind.begin() as conn:
+                    # 読む前に書き込みロックを取る (SQLiteの書き込みは1つずつなので、
+                    # ほかのワーカーの更新と重ならず、読んだ契約と在庫がコミットまで変わらない)
+                    conn.exec_driver_sql("BEGIN IMMEDIATE")
+                    contracts = conn.execute(
+                        select(_contracts.c.id, _contracts.c.user_id, _contracts.c.interval,
+                               _contracts.c.next_delivery_date, _contracts.c.renewal_count)
+                        .where(
+                            _contracts.c.status == "active",
+                            _contracts.c.next_delivery_date <= as_of.isoformat(),
+                            tuple_(_contracts.c.next_delivery_date, _contracts.c.id) > tuple_(*last_key),
+                        )
+                        .order_by(_contracts.c.next_delivery_date, _contracts.c.id)
+                        .limit(batch_size)
+                    ).all()
+                    counts = renew_batch(conn, contracts, as_of) if contracts else {}
+                # コミットできたバッチの件数だけを足す
+                for key, value in counts.items():
+                    report[key] += value
+                break
+            except (RenewalConflict, OperationalError):
+                # ロールバック済み。少し待ってから同じ範囲を読み直す
+                report["retries"] += 1
+                time.sleep(random.uniform(0, 0.05) * (attempt + 1))
+        else:
+            raise RuntimeError(f"定期便の更新が {MAX_BATCH_RETRIES} 回続けて競合しました")
+        if not contracts:
+            break
+        report["batches"] += 1
+        last_key = (contracts[-1].next_delivery_date, contracts[-1].id)
+
+    if report["renewed"]:
+        catalog_cache.bump()  # 在庫が変わったので /products のキャッシュを捨てる
+    report["elapsed_seconds"] = round(time.perf_counter() - started_at, 2)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="期日が来た定期便の契約を一括で更新する")
+    parser.add_argument("--as-of", type=date.fromisoformat, help="この日までが期日の契約を更新する (省略時は今日)")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    from main import ensure_indexes
+    ensure_indexes()
+    report = renew_due_subscriptions(args.as_of, args.batch_size)
+    print(f"🎉 定期便の更新が完了しました: {report}")
@@ -1,7 +1,7 @@
 import { useState, useEffect, useMemo } from 'react';
 import { Link, useNavigate } from 'react-router-dom'; // useNavigateをインポート
 import { toast } from 'react-toastify';
-import { getAllOrders, getAllInventory, updateOrderStatus } from './api';
+import { getAllOrders, getAllInventory, getSalesStats, subscribeOrderEvents, updateOrderStatus } from './api';
 import ProductEditModal from './ProductEditModal.jsx';
 
 // --- Helper Components for Badges ---
@@ -34,8 +34,11 @@ const TypeTag = ({ type }) => {
 // --- Main AdminDashboard Component ---
 export default function AdminDashboard({ token }) {
   const [orders, setOrders] = useState({ delivery_orders: [], bean_orders: [] });
+  const [cursors, setCursors] = useState({ delivery: null, bean: null });
+  const [isLoadingMore, setIsLoadingMore] = useState(false);
   const [roastedBeans, setRoastedBeans] = useState([]);
   const [deliveryBeans, setDeliveryBeans] = useState([]);
+  const [stats, setStats] = useState(null);
   const [isLoading, setIsLoading] = useState(true);
   const [error, setError] = useState(null);
   const [editingProduct, setEditingProduct] = useState(null);
@@ -44,10 +47,14 @@ export default function AdminDashboard({ token }) {
   const fetchData = async () => {
     setIsLoading(true);
     try {
-      const [ordersData, inventoryData] = await Promise.all([getAllOrders(), getAllInventory()]);
+      const [ordersData, inventoryData, statsData] = await Promise.all([
+        getAllOrders(), getAllInventory(), getSalesStats(),
+      ]);
       setOrders(ordersData);
+      setCursors({ delivery: ordersData.next_delivery_cursor, bean: ordersData.next_bean_cursor });
       setRoastedBeans(inventoryData.roasted_beans);
       setDeliveryBeans(inventoryData.delivery_beans);
+      setStats(statsData);
     } catch (err) {
       setError(err.message);
     } finally {
@@ -59,6 +66,59 @@ export default function AdminDashboard({ token }) {
     fetchData();
   }, [token]);
 
+  // 一覧を取り直さずに、サーバーから届いた差分 (新しい注文・ステータスの変更) だけを反映する
+  const applyStatus = (orderType, ids, newStatus) => {
+    const key = orderType === 'delivery' ? 'delivery_orders' : 'bean_orders';
+    const idKey = orderType === 'delivery' ? 'id' : 'order_id';
+    const targets = new Set(ids.map(String));
+    setOrders(prev => ({
+      ...prev,
+      [key]: prev[key].map(o => (targets.has(String(o[idKey])) ? { ...o, status: newStatus } : o)),
+    }));
+  };
+
+  useEffect(() => {
+    const unsubscribe = subscribeOrderEvents((type, data) => {
+      if (type === 'order_created') {
+        const key = data.order_type === 'delivery' ? 'delivery_orders' : 'bean_orders';
+        const idKey = data.order_type === 'delivery' ? 'id' : 'order_id';
+        setOrders(prev => (
+          prev[key].some(o => o[idKey] === data.order[idKey])
+            ? prev
+            : { ...prev, [key]: [data.order, ...prev[key]] }
+        ));
+      } else if (type === 'order_status') {
+        applyStatus(data.order_type, data.ids, data.status);
+      } else if (type === 'reset') {
+        fetchData(); // 取りこぼしがあったので一覧を取り直す
+      }
+    });
+    return unsubscribe;
+  }, [token]);
+
+  // 次のページ (まだ続きがある種別だけ) を取得して末尾に追加する
+  const handleLoadMore = async () => {
+    setIsLoadingMore(true);
+    try {
+      const [deliveryPage, beanPage] = await Promise.all([
+        cursors.delivery ? getAllOrders({ order_type: 'delivery', delivery_cursor: cursors.delivery }) : null,
+        cursors.bean ? getAllOrders({ order_type: 'bean', bean_cursor: cursors.bean }) : null,
+      ]);
+      setOrders(prev => ({
+        delivery_orders: [...prev.delivery_orders, ...(deliveryPage?.delivery_orders || [])],
+        bean_orders: [...prev.bean_orders, ...(beanPage?.bean_orders || [])],
+      }));
+      setCursors({
+        delivery: deliveryPage ? deliveryPage.next_delivery_cursor : null,
+        bean: beanPage ? beanPage.next_bean_cursor : null,
+      });
+    } catch (err) {
+      toast.error(`エラー: ${err.message}`);
+    } finally {
+      setIsLoadingMore(false);
+    }
+  };
+
   const handleSaveSuccess = () => {
     setEditingProduct(null);
     fetchData();
@@ -68,7 +128,8 @@ export default function AdminDashboard({ token }) {
     try {
       await updateOrderStatus(orderId, newStatus, orderType);
       toast.success('ステータスを更新しました。');
-      fetchData();
+      applyStatus(orderType, [orderId], newStatus);
+      setStats(await getSalesStats()); // キャンセルで売上が変わることがある
     } catch (err) {
       toast.error(`エラー: ${err.message}`);
     }
@@ -135,6 +196,29 @@ export default function AdminDashboard({ token }) {
         </nav>
       </section>
 
+      {stats && (
+        <section className="dashboard-section">
+          <h2>売上 ({stats.date_from} 〜 {stats.date_to})</h2>
+          <div className="kpi-grid">
+            <div className="kpi-card">
+              <span className="kpi-label">焙煎豆の売上</span>
+              <span className="kpi-value">{stats.totals.revenue.toLocaleString()}円</span>
+            </div>
+            <div className="kpi-card">
+              <span className="kpi-label">焙煎豆の販売数</span>
+              <span className="kpi-value">{stats.totals.bean_quantity.toLocaleString()}個</span>
+            </div>
+            <div className="kpi-card">
+              <span className="kpi-label">デリバリーの杯数</span>
+              <span className="kpi-value">{stats.totals.delivery_cups.toLocaleString()}杯</span>
+            </div>
+          </div>
+          {stats.products.length > 0 && (
+            <p>売上1位: {stats.products[0].name || stats.products[0].product_id} ({stats.products[0].revenue.toLocaleString()}円)</p>
+          )}
+        </section>
+      )}
+
       <section className="dashboard-section">
         <h2>すべての注文</h2>
         <div style={{ overflowX: 'auto' }}>
@@ -180,6 +264,11 @@ export default function AdminDashboard({ token }) {
             </tbody>
           </table>
         </div>
+        {(cursors.delivery || cursors.bean) && (
+          <button onClick={handleLoadMore} disabled={isLoadingMore} style={{ marginTop: '1rem' }}>
+            {isLoadingMore ? '読み込み中...' : 'さらに読み込む'}
+          </button>
+        )}
       </section>
 
       <section className="dashboard-section">
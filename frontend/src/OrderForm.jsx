@@ -1,10 +1,11 @@
 import { useState, useEffect } from 'react';
 import { toast } from 'react-toastify';
-import { getCurrentUser, getSettings, createOrder } from './api'; // API関数をインポート
+import { getCurrentUser, getSettings, getSlots, createOrder } from './api'; // API関数をインポート
 
 export default function OrderForm({ token }) {
   const [currentUser, setCurrentUser] = useState(null);
   const [beans, setBeans] = useState([]);
+  const [slots, setSlots] = useState([]);
   const [isLoading, setIsLoading] = useState(true);
   const [error, setError] = useState(null);
   
@@ -16,15 +17,23 @@ export default function OrderForm({ token }) {
   useEffect(() => {
     const fetchData = async () => {
       try {
-        const [userData, settingsData] = await Promise.all([
+        const [userData, settingsData, slotsData] = await Promise.all([
           getCurrentUser(),
           getSettings(),
+          getSlots(),
         ]);
         
         setCurrentUser(userData);
         const beanOptions = Object.keys(settingsData.bean_inventory);
         setBeans(beanOptions);
         if (beanOptions.length > 0) setSelectedBean(beanOptions[0]);
+        setSlots(slotsData.slots);
+        // 初期値の時間が満席なら、空いている最初の枠にする
+        const current = slotsData.slots.find(slot => slot.time === '10:00');
+        if (!current || current.remaining === 0) {
+          const firstOpen = slotsData.slots.find(slot => slot.remaining > 0);
+          if (firstOpen) setSelectedTime(firstOpen.time);
+        }
       } catch (err) {
         setError(err.message);
       } finally {
@@ -43,6 +52,8 @@ export default function OrderForm({ token }) {
     } catch (err) {
       toast.error(`エラー: ${err.message}`);
     }
+    // 残りの枠数を最新にする
+    getSlots().then(data => setSlots(data.slots)).catch(() => {});
   };
 
   if (isLoading) return <p>読み込み中...</p>;
@@ -61,7 +72,13 @@ export default function OrderForm({ token }) {
         </div>
         <div className="form-group">
           <label>希望時間:</label>
-          <input type="time" value={selectedTime} onChange={(e) => setSelectedTime(e.target.value)} />
+          <select value={selectedTime} onChange={(e) => setSelectedTime(e.target.value)}>
+            {slots.map(slot => (
+              <option key={slot.time} value={slot.time} disabled={slot.remaining === 0}>
+                {slot.time} {slot.remaining === 0 ? '(満席)' : `(残り${slot.remaining})`}
+              </option>
+            ))}
+          </select>
         </div>
         <div className="form-group">
           <label>サイズ:</label>
@@ -4,6 +4,8 @@ import { getOrderHistory } from './api'; // getOrderHistoryをインポート
 // このコンポーネントはApp.jsxからtokenを受け取る必要があります
 export default function OrderHistoryPage({ token }) {
   const [orders, setOrders] = useState({ delivery_orders: [], bean_orders: [] });
+  const [cursors, setCursors] = useState({ delivery: null, bean: null });
+  const [isLoadingMore, setIsLoadingMore] = useState(false);
   const [isLoading, setIsLoading] = useState(true);
   const [error, setError] = useState(null);
 
@@ -12,6 +14,7 @@ export default function OrderHistoryPage({ token }) {
       try {
         const data = await getOrderHistory();
         setOrders(data);
+        setCursors({ delivery: data.next_delivery_cursor, bean: data.next_bean_cursor });
       } catch (err) {
         setError(err.message);
       } finally {
@@ -22,6 +25,26 @@ export default function OrderHistoryPage({ token }) {
     fetchOrderHistory();
   }, [token]); // tokenが変わることはないですが、依存配列に含めておくのが作法です
 
+  // 続きのページを取得して末尾に追加する
+  const handleLoadMore = async () => {
+    setIsLoadingMore(true);
+    try {
+      const data = await getOrderHistory({ delivery_cursor: cursors.delivery, bean_cursor: cursors.bean });
+      setOrders(prev => ({
+        delivery_orders: cursors.delivery ? [...prev.delivery_orders, ...data.delivery_orders] : prev.delivery_orders,
+        bean_orders: cursors.bean ? [...prev.bean_orders, ...data.bean_orders] : prev.bean_orders,
+      }));
+      setCursors({
+        delivery: cursors.delivery ? data.next_delivery_cursor : null,
+        bean: cursors.bean ? data.next_bean_cursor : null,
+      });
+    } catch (err) {
+      setError(err.message);
+    } finally {
+      setIsLoadingMore(false);
+    }
+  };
+
   if (isLoading) return <p>注文履歴を読み込んでいます...</p>;
   if (error) return <p>エラー: {error}</p>;
 
@@ -71,6 +94,7 @@ export default function OrderHistoryPage({ token }) {
               <tr>
                 <th>注文ID</th>
                 <th>注文日</th>
+                <th>内容</th>
                 <th>合計金額</th>
                 <th>ステータス</th>
               </tr>
@@ -80,6 +104,7 @@ export default function OrderHistoryPage({ token }) {
                 <tr key={order.order_id}>
                   <td>{order.order_id}</td>
                   <td>{order.date}</td>
+                  <td>{(order.items || []).map(item => `${item.product_name || item.product_id} × ${item.quantity}`).join(', ')}</td>
                   <td>{order.total_price}円</td>
                   <td>{order.status}</td>
                 </tr>
@@ -88,6 +113,12 @@ export default function OrderHistoryPage({ token }) {
           </table>
         </section>
       )}
+
+      {(cursors.delivery || cursors.bean) && (
+        <button onClick={handleLoadMore} disabled={isLoadingMore}>
+          {isLoadingMore ? '読み込み中...' : 'さらに読み込む'}
+        </button>
+      )}
     </div>
   );
 }
\ No newline at end of file
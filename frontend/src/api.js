@@ -92,16 +92,49 @@ export function getProducts() {
   return fetchWithAuth('/products');
 }
 
+/**
+ * デリバリーの時間枠ごとの定員と残りを取得するAPI
+ * @param {string} [date] - YYYY-MM-DD (省略時は今日)
+ * @returns {Promise<any>} - {date, slot_minutes, slots: [{time, capacity, booked, remaining}]}
+ */
+export function getSlots(date) {
+  return fetchWithAuth(date ? `/slots?date=${date}` : '/slots');
+}
+
+/**
+ * 注文を作成するAPIを Idempotency-Key 付きで送信する共通関数
+ * 通信エラー (Wi-Fi の切断など) のときは同じキーで再送するので、最初の送信が届いていても注文は二重にならない
+ * @param {string} url
+ * @param {object} orderData
+ * @param {number} retries - 通信エラーのときに再送する回数
+ * @returns {Promise<any>}
+ */
+async function postOrder(url, orderData, retries = 3) {
+  const idempotencyKey = crypto.randomUUID
+    ? crypto.randomUUID()
+    : `${Date.now()}-${Math.random().toString(36).slice(2)}`; // HTTP (非セキュアコンテキスト) 用
+  for (let attempt = 0; ; attempt++) {
+    try {
+      return await fetchWithAuth(url, {
+        method: 'POST',
+        headers: { 'Idempotency-Key': idempotencyKey },
+        body: JSON.stringify(orderData),
+      });
+    } catch (err) {
+      // fetch 自体の失敗 (TypeError) だけ再送する。在庫不足などのエラーはそのまま返す
+      if (!(err instanceof TypeError) || attempt >= retries) throw err;
+      await new Promise(resolve => setTimeout(resolve, 1000 * 2 ** attempt));
+    }
+  }
+}
+
 /**
  * デリバリー注文を作成するAPI
  * @param {object} orderData
  * @returns {Promise<any>}
  */
 export function createOrder(orderData) {
-  return fetchWithAuth('/orders', {
-    method: 'POST',
-    body: JSON.stringify(orderData),
-  });
+  return postOrder('/orders', orderData);
 }
 
 /**
@@ -110,18 +143,19 @@ export function createOrder(orderData) {
  * @returns {Promise<any>}
  */
 export function createBeanOrder(orderData) {
-  return fetchWithAuth('/bean_orders', {
-    method: 'POST',
-    body: JSON.stringify(orderData),
-  });
+  return postOrder('/bean_orders', orderData);
 }
 
 /**
- * 注文履歴を取得するAPI
- * @returns {Promise<any>}
+ * 注文履歴を新しい順に1ページ分取得するAPI
+ * @param {object} params - {limit, delivery_cursor, bean_cursor}
+ * @returns {Promise<any>} - {delivery_orders, bean_orders, next_delivery_cursor, next_bean_cursor}
  */
-export function getOrderHistory() {
-  return fetchWithAuth('/orders/me');
+export function getOrderHistory(params = {}) {
+  const query = new URLSearchParams(
+    Object.entries(params).filter(([, value]) => value !== undefined && value !== null && value !== '')
+  ).toString();
+  return fetchWithAuth(query ? `/orders/me?${query}` : '/orders/me');
 }
 
 /**
@@ -133,11 +167,86 @@ export function getAllInventory() {
 }
 
 /**
- * 全ての注文を取得するAPI (管理者用)
- * @returns {Promise<any>}
+ * 期間内の売上の集計を取得するAPI (管理者用)
+ * @param {object} params - {date_from, date_to} (YYYY-MM-DD。省略時は直近30日)
+ * @returns {Promise<any>} - {date_from, date_to, totals, daily, products, beans}
+ */
+export function getSalesStats(params = {}) {
+  const query = new URLSearchParams(
+    Object.entries(params).filter(([, value]) => value !== undefined && value !== null && value !== '')
+  ).toString();
+  return fetchWithAuth(query ? `/admin/stats?${query}` : '/admin/stats');
+}
+
+/**
+ * 注文を新しい順に1ページ分取得するAPI (管理者用)
+ * @param {object} params - {order_type, status, date_from, date_to, user_id, limit, delivery_cursor, bean_cursor}
+ * @returns {Promise<any>} - {delivery_orders, bean_orders, next_delivery_cursor, next_bean_cursor}
+ */
+export function getAllOrders(params = {}) {
+  const query = new URLSearchParams(
+    Object.entries(params).filter(([, value]) => value !== undefined && value !== null && value !== '')
+  ).toString();
+  return fetchWithAuth(query ? `/admin/all_orders?${query}` : '/admin/all_orders');
+}
+
+/**
+ * 新しい注文とステータスの変更を Server-Sent Events で受け取る (管理者用)
+ * EventSource は Authorization ヘッダーを付けられないので、fetch のストリームを読んで解析する。
+ * 切断されたら、最後に受け取ったイベントID (Last-Event-ID) を付けて自動で再接続する。
+ * @param {function} onEvent - (type, data) で呼ばれる。type は 'order_created' / 'order_status' / 'reset'
+ *   ('reset' のときは取りこぼしがあるので、一覧を取り直すこと)
+ * @returns {function} - 受信を止める関数
  */
-export function getAllOrders() {
-  return fetchWithAuth('/admin/all_orders');
+export function subscribeOrderEvents(onEvent) {
+  const controller = new AbortController();
+  let lastEventId = null;
+  let retryMs = 3000;
+
+  const handleFrame = (frame) => {
+    let id = null, type = 'message', data = '';
+    for (const line of frame.split('\n')) {
+      if (line.startsWith(':')) continue; // 接続維持用のコメント
+      const sep = line.indexOf(':');
+      const field = sep === -1 ? line : line.slice(0, sep);
+      const value = sep === -1 ? '' : line.slice(sep + 1).replace(/^ /, '');
+      if (field === 'id') id = value;
+      else if (field === 'event') type = value;
+      else if (field === 'data') data += value;
+      else if (field === 'retry' && /^\d+$/.test(value)) retryMs = Number(value);
+    }
+    if (id !== null) lastEventId = id;
+    if (data && type !== 'ready') onEvent(type, JSON.parse(data));
+  };
+
+  const connect = async () => {
+    while (!controller.signal.aborted) {
+      try {
+        const headers = { 'Authorization': `Bearer ${localStorage.getItem('coffee_token')}` };
+        if (lastEventId) headers['Last-Event-ID'] = lastEventId;
+        const response = await fetch(`${BASE_URL}/admin/orders/stream`, { headers, signal: controller.signal });
+        if (!response.ok) throw new Error(response.statusText);
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        for (;;) {
+          const { value, done } = await reader.read();
+          if (done) break;
+          buffer += decoder.decode(value, { stream: true });
+          let end;
+          while ((end = buffer.indexOf('\n\n')) !== -1) {
+            handleFrame(buffer.slice(0, end));
+            buffer = buffer.slice(end + 2);
+          }
+        }
+      } catch (err) {
+        if (controller.signal.aborted) return;
+      }
+      await new Promise(resolve => setTimeout(resolve, retryMs));
+    }
+  };
+  connect();
+  return () => controller.abort();
 }
 
 /**